@@ -0,0 +1,176 @@
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from api.models import Friendship
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover - numpy is optional
+    numpy = None
+
+
+def _intersect(a, b):
+    if numpy is not None and a and b:
+        return numpy.intersect1d(
+            numpy.frombuffer(a, dtype=numpy.int64),
+            numpy.frombuffer(b, dtype=numpy.int64),
+            assume_unique=True,
+        ).tolist()
+    if len(a) > len(b):
+        a, b = b, a
+    other = set(b)
+    return [x for x in a if x in other]
+
+
+class AdjacencyIndex:
+
+    '''
+        In-process friend graph: one sorted int64 array of friend ids per user.
+        Mutual friends are array intersections (vectorised with numpy when it is
+        installed). The index is built on first use, kept in sync with this
+        process's committed Friendship writes through signals, and rebuilt after
+        MUTUAL_FRIENDS['INDEX_TTL'] seconds to pick up other workers' writes.
+        Rebuilds read the table in a background thread and swap the new graph
+        in, replaying the edges added or removed meanwhile, so lookups keep
+        using the old one.
+    '''
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._first_build = threading.Lock()
+        self._adjacency = {}
+        self._loaded_at = None
+        self._building = False
+        # (add, user_id, friend_id) of edges changed while a rebuild reads the table
+        self._changes = []
+
+    def _build(self):
+        adjacency = {}
+        for user_id, friend_id in Friendship.objects.values_list('user_id', 'friend_id').iterator():
+            adjacency.setdefault(user_id, set()).add(friend_id)
+            adjacency.setdefault(friend_id, set()).add(user_id)
+        return {uid: array('q', sorted(ids)) for uid, ids in adjacency.items()}
+
+    def _rebuild(self):
+        # runs without the lock: lookups and signal updates go on meanwhile
+        try:
+            adjacency = self._build()
+        except BaseException:
+            with self._lock:
+                self._building = False
+                self._changes = []
+            raise
+        with self._lock:
+            self._adjacency = adjacency
+            for add, user_id, friend_id in self._changes:
+                self._apply(add, user_id, friend_id)
+            self._changes = []
+            self._building = False
+            self._loaded_at = time.monotonic()
+
+    def _rebuild_in_background(self):
+        try:
+            self._rebuild()
+        finally:
+            connection.close()
+
+    def _ensure_loaded(self):
+        '''
+            Build the graph in the calling thread the first time (concurrent first
+            callers wait for that build); once it is older than ttl, start a
+            background rebuild and keep using it meanwhile.
+        '''
+        if self._loaded_at is None:
+            with self._first_build:
+                if self._loaded_at is None:
+                    with self._lock:
+                        self._building = True
+                    self._rebuild()
+            return
+        with self._lock:
+            if not self._building and time.monotonic() - self._loaded_at > self.ttl:
+                self._building = True
+                threading.Thread(
+                    target=self._rebuild_in_background, name='adjacency-index-rebuild', daemon=True
+                ).start()
+
+    def _insert(self, user_id, friend_id):
+        ids = self._adjacency.setdefault(user_id, array('q'))
+        i = bisect_left(ids, friend_id)
+        if i == len(ids) or ids[i] != friend_id:
+            ids.insert(i, friend_id)
+
+    def _discard(self, user_id, friend_id):
+        ids = self._adjacency.get(user_id)
+        if ids is None:
+            return
+        i = bisect_left(ids, friend_id)
+        if i < len(ids) and ids[i] == friend_id:
+            del ids[i]
+
+    def _apply(self, add, user_id, friend_id):
+        if add:
+            self._insert(user_id, friend_id)
+            self._insert(friend_id, user_id)
+        else:
+            self._discard(user_id, friend_id)
+            self._discard(friend_id, user_id)
+
+    def _change(self, add, user_id, friend_id):
+        with self._lock:
+            if self._building:
+                self._changes.append((add, user_id, friend_id))
+            if self._loaded_at is not None:
+                self._apply(add, user_id, friend_id)
+
+    def add_edge(self, user_id, friend_id):
+        '''
+            Record a new friendship once the current transaction commits, so a
+            rolled back one never shows up.
+        '''
+        transaction.on_commit(lambda: self._change(True, user_id, friend_id))
+
+    def remove_edge(self, user_id, friend_id):
+        transaction.on_commit(lambda: self._change(False, user_id, friend_id))
+
+    def reset(self):
+        with self._lock:
+            self._adjacency = {}
+            self._loaded_at = None
+            self._changes = []
+
+    def mutual_friends(self, viewer_id, other_ids):
+        '''
+            Map each id in ``other_ids`` to the sorted list of friend ids it
+            shares with ``viewer_id``.
+        '''
+        self._ensure_loaded()
+        with self._lock:
+            empty = array('q')
+            mine = self._adjacency.get(viewer_id, empty)
+            return {
+                other_id: _intersect(mine, self._adjacency.get(other_id, empty))
+                for other_id in other_ids
+            }
+
+    def memory_usage(self):
+        self._ensure_loaded()
+        with self._lock:
+            array_bytes = sum(sys.getsizeof(ids) for ids in self._adjacency.values())
+            return {
+                'users': len(self._adjacency),
+                'edges': sum(len(ids) for ids in self._adjacency.values()) // 2,
+                'array_bytes': array_bytes,
+                'total_bytes': array_bytes + sys.getsizeof(self._adjacency),
+                'vectorized': numpy is not None,
+            }
+
+
+adjacency_index = AdjacencyIndex(settings.MUTUAL_FRIENDS['INDEX_TTL'])
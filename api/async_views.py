@@ -0,0 +1,216 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+import rest_framework.status as status
+
+from api.models import User, FriendRequest, Friendship
+from api.email_filter import email_filter
+from api.events import EventStreamRenderer, event_stream_response, user_channel
+from api.export import aexport_graph
+from api.pagination import CountedPagination, KeysetPagination, PendingRequestPagination
+from api.search import search_users
+from api.views import (
+    SearchUserView, ListPendingRequestView, ListAllFriends, FriendRequestView, ManageFriendRequestView,
+    ExportGraphView, FriendRequestEventsView, event_request_params, events_response, export_response,
+    manage_friend_request,
+)
+from utils.async_views import AsyncAPIView
+from utils.pubsub import get_hub
+from utils.response_cache import cache_response, user_graph_version, users_version
+
+
+# Coroutine versions of the views in api.views, routed instead of them when
+# ASYNC_VIEWS is on (ASGI deployments). They inherit permissions, rate-limit scopes
+# and query budgets from their sync counterparts and return the same responses.
+
+
+class AsyncSearchUserView(AsyncAPIView, SearchUserView):
+
+    """
+    Async API endpoint to search for users by email or name.
+    """
+
+    @cache_response('search-user', users_version)
+    async def get(self, request):
+
+        """
+        Async version of SearchUserView.get. The name search backend (pg_trgm or the
+        in-process index) is synchronous and runs in a worker thread.
+        """
+
+        keyword = request.query_params.get('keyword') or request.data.get('keyword')
+        if not keyword:
+            return Response(data={'message': 'keyword is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            validate_email(keyword)
+            users = []
+            if await sync_to_async(email_filter.might_exist)(keyword):
+                users = [email async for email in User.objects.filter(email=keyword, is_active=True).values_list('email', flat=True)]
+        except ValidationError:
+            users = await sync_to_async(search_users)(keyword)
+
+        paginator = PageNumberPagination()
+        paginator.page_size = settings.USER_SEARCH['PAGE_SIZE']
+        result_page = paginator.paginate_queryset(users, request)
+        return paginator.get_paginated_response(result_page)
+
+
+class AsyncListPendingRequestView(AsyncAPIView, ListPendingRequestView):
+
+    """
+    Async API endpoint to list pending friend requests received by the authenticated user.
+    """
+
+    @cache_response('list-requests', user_graph_version)
+    async def get(self, request):
+
+        """
+        Async version of ListPendingRequestView.get.
+        """
+
+        paginator = PendingRequestPagination()
+
+        def fetch(after, before, limit):
+            return FriendRequest.objects.pending_rows(request.user, after=after, before=before)[:limit]
+
+        rows = await paginator.apaginate_rows(fetch, request)
+        count = await sync_to_async(getattr)(request.user, 'pending_in_count')
+        return paginator.get_paginated_response([email for _, _, email in rows], count)
+
+
+class AsyncListAllFriends(AsyncAPIView, ListAllFriends):
+
+    """
+    Async API endpoint to list all friends of the authenticated user.
+    """
+
+    @cache_response('lists-friends', user_graph_version)
+    async def get(self, request):
+
+        """
+        Async version of ListAllFriends.get. Page-number mode goes through DRF's
+        synchronous paginator (counter plus slice) in a worker thread.
+        """
+
+        if request.query_params.get('mode') == 'cursor':
+            paginator = KeysetPagination()
+
+            def fetch(after, before, limit):
+                return Friendship.objects.friend_rows(request.user, after=after, before=before, limit=limit)
+
+            rows = await paginator.apaginate_rows(fetch, request)
+            return paginator.get_paginated_response({'lists': [email for _, email in rows]})
+
+        paginator = CountedPagination()
+        count = await sync_to_async(getattr)(request.user, 'friend_count')
+
+        result_page = await sync_to_async(paginator.paginate_counted)(
+            Friendship.objects.friend_rows(request.user), count, request
+        )
+        return paginator.get_paginated_response({'lists': [email for _, email in result_page]})
+
+
+class AsyncFriendRequestView(AsyncAPIView, FriendRequestView):
+
+    """
+    Async API endpoint for sending friend requests.
+    """
+
+    async def post(self, request):
+
+        """
+        Async version of FriendRequestView.post.
+        """
+
+        to = request.data.get('to_email')
+        # validate_email raises TypeError, not ValidationError, on non-strings
+        if not isinstance(to, str):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        try:
+            validate_email(to)
+        except ValidationError:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if not await sync_to_async(email_filter.might_exist)(to):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        if await FriendRequest.objects.asend(request.user.id, to) is None:
+            if not await User.objects.filter(email=to).aexists():
+                return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(data={'request sent successfully' : to}, status=status.HTTP_200_OK)
+
+
+class AsyncManageFriendRequestView(AsyncAPIView, ManageFriendRequestView):
+
+    """
+    Async API endpoint to manage friend requests received by the authenticated user.
+    """
+
+    async def post(self, request):
+
+        """
+        Async version of ManageFriendRequestView.post. The accept/befriend/suggestion
+        transaction runs as one unit in a worker thread, since transactions cannot
+        span async ORM calls.
+        """
+
+        accept = request.data.get('accept')
+        sender_email = request.data.get('sender')
+
+        sender_id = await sync_to_async(manage_friend_request)(request.user.id, sender_email, accept)
+        if sender_id is None:
+            return Response(data={'message': 'Invalid email address'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(data={'accept-status' : accept}, status=status.HTTP_200_OK)
+
+
+class AsyncExportGraphView(AsyncAPIView, ExportGraphView):
+
+    """
+    Async API endpoint streaming the authenticated user's social graph as NDJSON.
+    """
+
+    async def get(self, request):
+
+        """
+        Async version of ExportGraphView.get, streaming from an async generator so the
+        ASGI handler does not buffer the whole export.
+        """
+
+        return export_response(aexport_graph(request.user), request.user)
+
+
+class AsyncFriendRequestEventsView(AsyncAPIView, FriendRequestEventsView):
+
+    """
+    Async API endpoint pushing changes to the authenticated user's friend requests.
+    """
+
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, EventStreamRenderer]
+
+    async def get(self, request):
+
+        """
+        Async version of FriendRequestEventsView.get. Clients sending
+        "Accept: text/event-stream" (EventSource) get a server-sent event stream
+        instead, resuming after Last-Event-ID. A waiting client is one pending
+        coroutine: no thread, query or poll.
+        """
+
+        try:
+            last_id, timeout = event_request_params(request)
+        except ValueError:
+            return Response(data={'message': 'last_event_id and timeout must be numbers'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if isinstance(request.accepted_renderer, EventStreamRenderer):
+            return event_stream_response(request.user.id, last_id)
+
+        channel = user_channel(request.user.id)
+        if last_id is None:
+            return Response(data={'events': [], 'last_event_id': await get_hub().alast_id(channel)}, status=status.HTTP_200_OK)
+        events = await get_hub().await_since(channel, last_id, timeout)
+        return events_response(events, last_id)
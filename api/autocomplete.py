@@ -0,0 +1,292 @@
+import heapq
+import logging
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+
+from api.models import User
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(text):
+    '''
+        Case-folded, accent-stripped text with runs of whitespace collapsed.
+    '''
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(text.casefold().split())
+
+
+def terms_for(name, email, max_length):
+    '''
+        Index terms of a user: every word of the name, the full name (so multi-word
+        prefixes like "alice k" match) and the email, each cut to max_length.
+    '''
+    name = normalize(name)
+    terms = set(name.split())
+    if ' ' in name:
+        terms.add(name)
+    if email:
+        terms.add(normalize(email))
+    return sorted({term[:max_length] for term in terms if term})
+
+
+class PrefixIndex:
+
+    '''
+        In-process autocomplete index of active users: one sorted list of
+        normalized terms with a parallel int64 array of user ids, so a prefix
+        query is a bisect followed by a scan of the matching range.
+
+        Built in a background thread on first use, kept current by the User
+        post_save/post_delete signals and rebuilt after AUTOCOMPLETE['INDEX_TTL']
+        seconds to pick up other workers' writes. Builds read the table without
+        the lock and swap the new index in, replaying the signal updates made
+        meanwhile, so lookups keep using the old one, or a database prefix query
+        until the first build is in. Lookups copy the matching range under the
+        lock and rank it outside. Terms are capped at MAX_TERM_LENGTH
+        characters; when the table would need more than MAX_ENTRIES terms the
+        index is not built and lookups stay on the database query. An oversized
+        table is scanned again only once it has fewer active users.
+    '''
+
+    def __init__(self, ttl, max_entries, max_term_length):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_term_length = max_term_length
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._terms = []
+        self._ids = array('q')
+        self._users = {}
+        self._loaded_at = None
+        self._oversized = False
+        self._oversized_users = None
+        self._building = False
+        # (pk, user or None) of signal updates made while a rebuild reads the table
+        self._changes = []
+
+    def _build(self):
+        entries = []
+        users = {}
+        for pk, name, email in User.objects.filter(is_active=True).values_list('id', 'name', 'email').iterator():
+            terms = terms_for(name, email, self.max_term_length)
+            entries.extend((term, pk) for term in terms)
+            users[pk] = (name, email, terms)
+            if len(entries) > self.max_entries:
+                return None
+        entries.sort()
+        return [term for term, _ in entries], array('q', (pk for _, pk in entries)), users
+
+    def _rebuild(self, generation):
+        # runs without the lock: lookups and signal updates go on meanwhile
+        try:
+            built = active = None
+            if self._oversized_users is not None:
+                active = User.objects.filter(is_active=True).count()
+            if active is None or active < self._oversized_users:
+                built = self._build()
+                if built is None:
+                    active = User.objects.filter(is_active=True).count()
+        except BaseException:
+            with self._lock:
+                if generation == self._generation:
+                    self._building = False
+                    self._changes = []
+            raise
+        with self._lock:
+            if generation != self._generation:
+                # reset() ran meanwhile
+                return
+            if built is None:
+                self._terms, self._ids, self._users = [], array('q'), {}
+                self._oversized = True
+                self._oversized_users = active
+            else:
+                self._terms, self._ids, self._users = built
+                self._oversized = False
+                self._oversized_users = None
+                for pk, user in self._changes:
+                    self._apply(pk, user)
+            self._changes = []
+            self._building = False
+            self._loaded_at = time.monotonic()
+
+    def _rebuild_in_background(self, generation):
+        try:
+            self._rebuild(generation)
+        except Exception:
+            logger.exception('prefix index build failed')
+        finally:
+            connection.close()
+
+    def _refresh(self):
+        '''
+            Under the lock: start a background rebuild when nothing is loaded or
+            the index is older than ttl.
+        '''
+        if self._building:
+            return
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+            self._building = True
+            threading.Thread(
+                target=self._rebuild_in_background, args=(self._generation,),
+                name='prefix-index-rebuild', daemon=True,
+            ).start()
+
+    def load(self):
+        '''
+            Build the index in the calling thread unless one is loaded or being
+            built.
+        '''
+        with self._lock:
+            if self._loaded_at is not None or self._building:
+                return
+            self._building = True
+            generation = self._generation
+        self._rebuild(generation)
+
+    def _position(self, term, pk):
+        i = bisect_left(self._terms, term)
+        while i < len(self._terms) and self._terms[i] == term and self._ids[i] < pk:
+            i += 1
+        return i
+
+    def _insert(self, pk, name, email):
+        terms = terms_for(name, email, self.max_term_length)
+        for term in terms:
+            i = self._position(term, pk)
+            self._terms.insert(i, term)
+            self._ids.insert(i, pk)
+        self._users[pk] = (name, email, terms)
+
+    def _remove(self, pk):
+        user = self._users.pop(pk, None)
+        if user is None:
+            return
+        for term in user[2]:
+            i = self._position(term, pk)
+            if i < len(self._terms) and self._terms[i] == term and self._ids[i] == pk:
+                del self._terms[i]
+                del self._ids[i]
+
+    def _apply(self, pk, user):
+        self._remove(pk)
+        if user is not None and user.is_active:
+            self._insert(pk, user.name, user.email)
+
+    def _change(self, pk, user):
+        if self._building:
+            self._changes.append((pk, user))
+        if self._loaded_at is not None and not self._oversized:
+            self._apply(pk, user)
+
+    def update(self, user):
+        with self._lock:
+            self._change(user.pk, user)
+
+    def remove(self, pk):
+        with self._lock:
+            self._change(pk, None)
+
+    def reset(self):
+        with self._lock:
+            # a build started before the reset is discarded when it finishes
+            self._generation += 1
+            self._building = False
+            self._terms = []
+            self._ids = array('q')
+            self._users = {}
+            self._loaded_at = None
+            self._oversized = False
+            self._oversized_users = None
+            self._changes = []
+
+    def complete(self, prefix, limit, budget_ms):
+        '''
+            The ``limit`` users whose name, a word of it, or email starts with
+            ``prefix``, as (id, name, email) tuples ranked by the length of their
+            shortest matching term, then term order. The whole matching range is
+            ranked unless the scan runs past ``budget_ms``; the second return
+            value says whether it was cut short.
+        '''
+        term = normalize(prefix)[:self.max_term_length]
+        if not term:
+            return [], False
+
+        with self._lock:
+            self._refresh()
+            if self._loaded_at is None or self._oversized:
+                terms = None
+            else:
+                # signal updates insert into the lists in place, so copy the range
+                start = bisect_left(self._terms, term)
+                end = bisect_left(self._terms, term + '\U0010ffff', start)
+                terms, ids = self._terms[start:end], self._ids[start:end]
+        if terms is None:
+            return self._complete_from_database(prefix, limit), False
+
+        deadline = time.perf_counter() + budget_ms / 1000
+        matches = {}
+        truncated = False
+        for i, (match, pk) in enumerate(zip(terms, ids)):
+            if pk not in matches or len(match) < matches[pk][0]:
+                matches[pk] = (len(match), i)
+            if i % 256 == 255 and time.perf_counter() > deadline:
+                truncated = True
+                break
+
+        ranked = heapq.nsmallest(limit, matches, key=matches.get)
+        with self._lock:
+            users = [(pk, self._users.get(pk)) for pk in ranked]
+        # users removed since the copy are left out
+        return [(pk, user[0], user[1]) for pk, user in users if user is not None], truncated
+
+    def _complete_from_database(self, prefix, limit):
+        '''
+            Prefix query on the raw input rather than the accent-stripped term,
+            so "Émi" finds "Émile"; "emi" finds "emile" as well, but not "Émile".
+        '''
+        prefixes = {' '.join(prefix.split()), normalize(prefix)}
+        condition = Q()
+        for value in prefixes:
+            condition |= Q(name__istartswith=value) | Q(email__istartswith=value)
+        return list(
+            User.objects.filter(condition, is_active=True)
+            .order_by('name', 'id')
+            .values_list('id', 'name', 'email')[:limit]
+        )
+
+    def memory_usage(self):
+        self.load()
+        with self._lock:
+            term_bytes = sys.getsizeof(self._terms) + sum(sys.getsizeof(term) for term in self._terms)
+            ids_bytes = self._ids.buffer_info()[1] * self._ids.itemsize
+            user_bytes = sys.getsizeof(self._users) + sum(
+                sys.getsizeof(name) + sys.getsizeof(email) + sys.getsizeof(terms)
+                for name, email, terms in self._users.values()
+            )
+            return {
+                'users': len(self._users),
+                'entries': len(self._terms),
+                'oversized': self._oversized,
+                'term_bytes': term_bytes,
+                'id_bytes': ids_bytes,
+                'user_bytes': user_bytes,
+                'total_bytes': term_bytes + ids_bytes + user_bytes,
+            }
+
+
+prefix_index = PrefixIndex(
+    settings.AUTOCOMPLETE['INDEX_TTL'],
+    settings.AUTOCOMPLETE['MAX_ENTRIES'],
+    settings.AUTOCOMPLETE['MAX_TERM_LENGTH'],
+)
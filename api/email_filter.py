@@ -0,0 +1,417 @@
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+
+from api.models import User
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+# magic, bit count, hash count, emails added, last log sequence applied
+HEADER = struct.Struct('<8sQQQQ')
+HEADER_SIZE = 64
+MAGIC = b'EMLBLOM2'
+
+SEQUENCE_KEY = 'email_filter:sequence'
+# emails per log entry, which keeps entries well under memcached's 1MB item limit
+ENTRY_SIZE = 1000
+# seconds a published entry may stay unwritten before it counts as evicted
+MISSING_GRACE = 5
+
+
+def normalize_email(email):
+    '''
+        Case-folded email, so a miss also rules out RegisterUser's iexact match.
+    '''
+    return (email or '').strip().casefold()
+
+
+def filter_size(capacity, error_rate):
+    '''
+        (bits, hashes) of a Bloom filter holding capacity items at error_rate
+        false positives.
+    '''
+    bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    bits += -bits % 8
+    return bits, max(1, round(bits / capacity * math.log(2)))
+
+
+class BloomFilter:
+
+    '''
+        Bloom filter over a writable buffer (bytearray or mmap), with k positions
+        derived from one blake2b digest by double hashing.
+    '''
+
+    def __init__(self, buffer, bits, hashes, offset=0):
+        self.buffer = buffer
+        self.bits = bits
+        self.hashes = hashes
+        self.offset = offset
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.buffer[self.offset + position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, item):
+        return all(self.buffer[self.offset + position // 8] & (1 << (position % 8)) for position in self._positions(item))
+
+
+def write_filter(path, emails, capacity, error_rate, sequence):
+    '''
+        Build a filter file from emails, current as of log ``sequence``, and
+        atomically replace path with it. Workers mapping the old file notice the
+        new inode and remap. Returns (bits, hashes, count).
+    '''
+    bits, hashes = filter_size(capacity, error_rate)
+    buffer = bytearray(HEADER_SIZE + bits // 8)
+    bloom = BloomFilter(buffer, bits, hashes, offset=HEADER_SIZE)
+    count = 0
+    for email in emails:
+        bloom.add(normalize_email(email))
+        count += 1
+    HEADER.pack_into(buffer, 0, MAGIC, bits, hashes, count, sequence)
+
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(buffer)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return bits, hashes, count
+
+
+def _log():
+    return caches[settings.EMAIL_FILTER['CACHE']]
+
+
+def _entry_key(sequence):
+    return f'email_filter:added:{sequence}'
+
+
+def current_sequence():
+    return _log().get(SEQUENCE_KEY) or 0
+
+
+def publish_emails(emails):
+    '''
+        Append emails of new or renamed users to the log in EMAIL_FILTER['CACHE']
+        that filters catch up from. The User post_save receiver publishes on
+        commit; bulk inserts bypassing it must call this once they commit.
+    '''
+    emails = [normalize_email(email) for email in emails]
+    if not emails:
+        return
+    chunks = [emails[i:i + ENTRY_SIZE] for i in range(0, len(emails), ENTRY_SIZE)]
+    cache = _log()
+    cache.add(SEQUENCE_KEY, 0, timeout=None)
+    try:
+        last = cache.incr(SEQUENCE_KEY, len(chunks))
+    except ValueError:
+        # evicted between add() and incr()
+        cache.add(SEQUENCE_KEY, 0, timeout=None)
+        last = cache.incr(SEQUENCE_KEY, len(chunks))
+    first = last - len(chunks) + 1
+    cache.set_many(
+        {_entry_key(first + i): chunk for i, chunk in enumerate(chunks)},
+        timeout=settings.EMAIL_FILTER['TTL'],
+    )
+
+
+class EmailFilter:
+
+    '''
+        Bloom filter of every user's normalized email, consulted before email
+        lookups: a definite miss means no such user and needs no query.
+
+        Without EMAIL_FILTER['PATH'] each process builds its own copy and
+        rebuilds it after TTL seconds. With a path, all workers on a host map the
+        same file (built by `manage.py rebuild_email_filter`, or by the first
+        worker to need it) and set bits in it under a file lock. Builds read the
+        table in a background thread; until the first one is done every lookup
+        answers "may exist" and the caller queries as it would without a filter.
+
+        Emails of users added since a build come from a log of at most LOG_SIZE
+        entries in EMAIL_FILTER['CACHE'] (see publish_emails), so a miss costs
+        one cache read and no query. A miss is only answered outright once the
+        filter has applied every published entry: while an entry is missing
+        lookups answer "may exist", and a filter whose next entry stays missing
+        for MISSING_GRACE seconds, or further behind than the log reaches, is
+        rebuilt. The log has to
+        live in a cache shared by every process that adds users. Deleted users
+        stay in the filter as false positives.
+    '''
+
+    def __init__(self, path, capacity, error_rate, ttl, log_size):
+        self.path = path
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.ttl = ttl
+        self.log_size = log_size
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._bloom = None
+        self._mmap = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # a build started before the reset is discarded when it finishes
+            self._generation += 1
+            self._bloom = None
+            self._mmap = None
+            self._inode = None
+            self._sequence = 0
+            self._loaded_at = None
+            self._building = False
+            self._missing = None
+
+    @contextmanager
+    def _file_lock(self):
+        if not self.path or fcntl is None:
+            yield
+            return
+        with open(f'{self.path}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _build(self):
+        bits, hashes = filter_size(self.capacity, self.error_rate)
+        bloom = BloomFilter(bytearray(bits // 8), bits, hashes)
+        count = 0
+        for email in User.objects.values_list('email', flat=True).iterator():
+            bloom.add(normalize_email(email))
+            count += 1
+        if count > self.capacity:
+            logger.warning('email filter holds %d emails, above its capacity of %d', count, self.capacity)
+        return bloom
+
+    def _file_sequence(self):
+        '''
+            The log sequence of the file at path, or None when there is no usable
+            file or the log no longer reaches back to it.
+        '''
+        try:
+            with open(self.path, 'rb') as f:
+                magic, _, _, _, sequence = HEADER.unpack(f.read(HEADER.size))
+        except (FileNotFoundError, struct.error):
+            return None
+        if magic != MAGIC or not 0 <= current_sequence() - sequence <= self.log_size:
+            return None
+        return sequence
+
+    def _rebuild(self, generation, behind=None):
+        # runs without the lock: lookups go on with the old filter meanwhile
+        try:
+            if self.path:
+                with self._file_lock():
+                    stored = self._file_sequence()
+                    # another worker may have rewritten the file since ``behind`` was seen
+                    if stored is None or behind is not None and stored < behind:
+                        # read before the table, so entries published meanwhile are replayed
+                        sequence = current_sequence()
+                        write_filter(
+                            self.path, User.objects.values_list('email', flat=True).iterator(),
+                            self.capacity, self.error_rate, sequence,
+                        )
+                built = None
+            else:
+                sequence = current_sequence()
+                built = self._build()
+            with self._lock:
+                if generation == self._generation:
+                    if self.path:
+                        self._open_mapping()
+                    else:
+                        self._bloom, self._sequence = built, sequence
+                    self._loaded_at = time.monotonic()
+        finally:
+            with self._lock:
+                if generation == self._generation:
+                    self._building = False
+
+    def _rebuild_in_background(self, generation, behind):
+        try:
+            self._rebuild(generation, behind)
+        except Exception:
+            logger.exception('email filter build failed')
+        finally:
+            connection.close()
+
+    def _start_rebuild(self, behind=None):
+        if not self._building:
+            self._building = True
+            threading.Thread(
+                target=self._rebuild_in_background, args=(self._generation, behind),
+                name='email-filter-rebuild', daemon=True,
+            ).start()
+
+    def _open_mapping(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        with open(self.path, 'r+b') as f:
+            self._inode = os.fstat(f.fileno()).st_ino
+            self._mmap = mmap.mmap(f.fileno(), 0)
+        magic, bits, hashes, _, _ = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f'{self.path} is not an email filter file')
+        self._bloom = BloomFilter(self._mmap, bits, hashes, offset=HEADER_SIZE)
+
+    def _replaced(self):
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except FileNotFoundError:
+            return True
+
+    def _refresh(self):
+        '''
+            Under the lock: remap a replaced shared file, and start a background
+            build when there is nothing to map yet or the per-process filter is
+            older than ttl.
+        '''
+        if self.path:
+            if self._bloom is None or self._replaced():
+                try:
+                    self._open_mapping()
+                    self._loaded_at = time.monotonic()
+                except (FileNotFoundError, ValueError):
+                    self._start_rebuild()
+        elif self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+            self._start_rebuild()
+
+    def _get_sequence(self):
+        # a shared file records how far every worker has brought it
+        if self._mmap is not None:
+            return HEADER.unpack_from(self._mmap, 0)[4]
+        return self._sequence
+
+    def _add_emails(self, emails, sequence=None):
+        for email in emails:
+            self._bloom.add(normalize_email(email))
+        if self._mmap is not None:
+            _, bits, hashes, count, stored = HEADER.unpack_from(self._mmap, 0)
+            HEADER.pack_into(self._mmap, 0, MAGIC, bits, hashes, count + len(emails), max(stored, sequence or 0))
+        elif sequence is not None:
+            self._sequence = sequence
+
+    def _catch_up(self):
+        '''
+            Under the lock, with a filter loaded: add the emails published since
+            its sequence. Returns False when the log cannot bring it up to date.
+        '''
+        with self._file_lock():
+            applied = self._get_sequence()
+            latest = current_sequence()
+            if latest == applied:
+                return True
+            if not 0 < latest - applied <= self.log_size:
+                # the log was lost, or has moved on further than it keeps
+                self._start_rebuild()
+                return False
+            keys = [_entry_key(sequence) for sequence in range(applied + 1, latest + 1)]
+            found = _log().get_many(keys)
+            emails = []
+            for sequence, key in enumerate(keys, applied + 1):
+                if key not in found:
+                    self._add_emails(emails, sequence - 1)
+                    self._entry_missing(sequence)
+                    return False
+                emails.extend(found[key])
+            self._add_emails(emails, latest)
+            return True
+
+    def _entry_missing(self, sequence):
+        # published but not written yet, or evicted once it stays missing
+        now = time.monotonic()
+        if self._missing is None or self._missing[0] != sequence:
+            self._missing = (sequence, now)
+        elif now - self._missing[1] > MISSING_GRACE:
+            self._start_rebuild(behind=sequence)
+
+    def might_exist(self, email):
+        '''
+            False only when no user has this email (case-insensitively); True when
+            one may, or when the filter is disabled or not built yet.
+        '''
+        if not settings.EMAIL_FILTER['ENABLED']:
+            return True
+        email = normalize_email(email)
+        with self._lock:
+            self._refresh()
+            if self._bloom is None:
+                return True
+            if email in self._bloom:
+                return True
+            current = self._catch_up()
+            return not current or email in self._bloom
+
+    def sync(self):
+        '''
+            Build the filter in the calling thread unless one is loaded, then add
+            every email published since.
+        '''
+        with self._lock:
+            generation = self._generation
+            loaded = self._bloom is not None
+        if not loaded:
+            self._rebuild(generation)
+        with self._lock:
+            if self._bloom is not None:
+                self._catch_up()
+
+    def add(self, email):
+        with self._lock:
+            if self._bloom is not None:
+                with self._file_lock():
+                    if self.path and self._replaced():
+                        self._open_mapping()
+                    self._add_emails([email])
+
+    def stats(self):
+        self.sync()
+        with self._lock:
+            bloom = self._bloom
+            set_bits = int.from_bytes(bloom.buffer[bloom.offset:], 'little').bit_count()
+            fill = set_bits / bloom.bits
+            return {
+                'path': self.path,
+                'bits': bloom.bits,
+                'hashes': bloom.hashes,
+                'bytes': bloom.bits // 8,
+                'fill_ratio': round(fill, 4),
+                'false_positive_rate': round(fill ** bloom.hashes, 6),
+                'sequence': self._get_sequence(),
+            }
+
+
+email_filter = EmailFilter(
+    settings.EMAIL_FILTER['PATH'],
+    settings.EMAIL_FILTER['CAPACITY'],
+    settings.EMAIL_FILTER['ERROR_RATE'],
+    settings.EMAIL_FILTER['TTL'],
+    settings.EMAIL_FILTER['LOG_SIZE'],
+)
@@ -0,0 +1,89 @@
+import json
+import time
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer
+
+from utils.pubsub import get_hub
+
+
+def user_channel(user_id):
+    return f'user:{user_id}'
+
+
+def publish_friend_request_events(action, pairs):
+    '''
+        Tell both sides of each (sender_id, receiver_id) pair that a request between
+        them was sent, accepted, rejected or expired. Events carry ids only; clients
+        refetch list-requests/ or lists-friends/ for details.
+
+        The FriendRequest manager methods publish through friend_requests_changed
+        and ORM saves and deletes through post_save/post_delete ("sent" on create,
+        "rejected" when a pending request is deleted). ORM updates and bulk_create
+        (e.g. generate_social_graph) publish nothing.
+    '''
+    hub = get_hub()
+    for sender_id, receiver_id in pairs:
+        data = {'sender_id': sender_id, 'receiver_id': receiver_id}
+        hub.publish(user_channel(receiver_id), f'friend_request.{action}', data)
+        hub.publish(user_channel(sender_id), f'friend_request.{action}', data)
+
+
+def event_data(event):
+    return {'id': event.id, 'type': event.type, 'data': event.data}
+
+
+def format_sse(event):
+    return f'id: {event.id}\nevent: {event.type}\ndata: {json.dumps(event.data, separators=(",", ":"))}\n\n'
+
+
+async def event_stream(user_id, last_id):
+
+    '''
+        Server-sent events for one user, as an async generator for ASGI.
+
+        Starts with the events after last_id (or from now), then waits on the hub,
+        sending a comment line every EVENTS['HEARTBEAT'] seconds so proxies keep the
+        connection open. Ends after STREAM_SECONDS; EventSource reconnects with
+        Last-Event-ID and resumes where it stopped.
+    '''
+
+    config = settings.EVENTS
+    hub = get_hub()
+    channel = user_channel(user_id)
+    if last_id is None:
+        last_id = await hub.alast_id(channel)
+
+    yield f'retry: {config["RETRY_MS"]}\n\n'
+    deadline = time.monotonic() + config['STREAM_SECONDS']
+    while (remaining := deadline - time.monotonic()) > 0:
+        events = await hub.await_since(channel, last_id, min(config['HEARTBEAT'], remaining))
+        if not events:
+            yield ': keepalive\n\n'
+            continue
+        last_id = events[-1].id
+        yield ''.join(format_sse(event) for event in events)
+
+
+def event_stream_response(user_id, last_id):
+    response = StreamingHttpResponse(event_stream(user_id, last_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # stop nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+class EventStreamRenderer(BaseRenderer):
+
+    '''
+        Lets content negotiation accept "Accept: text/event-stream"; the view
+        returns the stream itself.
+    '''
+
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data).encode()
@@ -0,0 +1,98 @@
+import json
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Exists, OuterRef
+
+from api.models import FriendRequest, FriendRequestArchive, Friendship
+
+
+def _sections(user_id):
+    '''
+        (record type, queryset, row -> dict) for every part of a user's graph, each
+        read as narrow values_list rows.
+    '''
+    sections = [
+        ('friend', Friendship.objects.filter(user_id=user_id).values_list('friend_id', 'friend__email'),
+         lambda row: {'id': row[0], 'email': row[1]}),
+    ]
+    if not settings.FRIENDSHIP_SYMMETRIC:
+        # a pair stored in both directions, e.g. by backfill_friendship_edges, was
+        # listed above already
+        incoming = Friendship.objects.filter(friend_id=user_id).filter(~Exists(
+            Friendship.objects.filter(user=OuterRef('friend'), friend=OuterRef('user'))
+        ))
+        sections.append(
+            ('friend', incoming.values_list('user_id', 'user__email'),
+             lambda row: {'id': row[0], 'email': row[1]}),
+        )
+    # requests moved to FriendRequestArchive by compact_friend_requests were all accepted
+    sections += [
+        ('sent_request',
+         FriendRequest.objects.filter(sender_id=user_id)
+         .values_list('receiver_id', 'receiver__email', 'accepted', 'created_at'),
+         lambda row: {'id': row[0], 'email': row[1], 'accepted': row[2], 'created_at': row[3].isoformat()}),
+        ('sent_request',
+         FriendRequestArchive.objects.filter(sender_id=user_id)
+         .values_list('receiver_id', 'receiver__email', 'created_at'),
+         lambda row: {'id': row[0], 'email': row[1], 'accepted': True, 'created_at': row[2].isoformat()}),
+        ('received_request',
+         FriendRequest.objects.filter(receiver_id=user_id)
+         .values_list('sender_id', 'sender__email', 'accepted', 'created_at'),
+         lambda row: {'id': row[0], 'email': row[1], 'accepted': row[2], 'created_at': row[3].isoformat()}),
+        ('received_request',
+         FriendRequestArchive.objects.filter(receiver_id=user_id)
+         .values_list('sender_id', 'sender__email', 'created_at'),
+         lambda row: {'id': row[0], 'email': row[1], 'accepted': True, 'created_at': row[2].isoformat()}),
+    ]
+    return sections
+
+
+def _line(record_type, record):
+    return json.dumps({'type': record_type, **record}, separators=(',', ':')) + '\n'
+
+
+def _take(rows, count):
+    return list(islice(rows, count))
+
+
+def _header(user):
+    return _line('user', {'id': user.pk, 'email': user.email}).encode()
+
+
+def export_graph(user, chunk_size=None):
+
+    '''
+        Yield a user's friends, sent requests and received requests (archived ones
+        included) as NDJSON bytes.
+
+        The header line is yielded before any query runs, so the first byte goes out
+        immediately. Each section is read with .iterator(chunk_size) (a server-side
+        cursor where the backend supports it) and written one chunk at a time, so
+        memory stays bounded by chunk_size rows whatever the graph size.
+    '''
+
+    chunk_size = chunk_size or settings.GRAPH_EXPORT['CHUNK_SIZE']
+    yield _header(user)
+    for record_type, queryset, to_record in _sections(user.pk):
+        rows = queryset.iterator(chunk_size=chunk_size)
+        while chunk := _take(rows, chunk_size):
+            yield ''.join(_line(record_type, to_record(row)) for row in chunk).encode()
+
+
+async def aexport_graph(user, chunk_size=None):
+
+    '''
+        export_graph() as an async generator for ASGI, where a synchronous iterator
+        would be consumed in full before streaming.
+    '''
+
+    chunk_size = chunk_size or settings.GRAPH_EXPORT['CHUNK_SIZE']
+    yield _header(user)
+    for record_type, queryset, to_record in _sections(user.pk):
+        # QuerySet.aiterator() runs values_list queries on the event loop in
+        # Django 4.2, so chunks of the sync iterator are pulled in a worker thread
+        rows = queryset.iterator(chunk_size=chunk_size)
+        while chunk := await sync_to_async(_take)(rows, chunk_size):
+            yield ''.join(_line(record_type, to_record(row)) for row in chunk).encode()
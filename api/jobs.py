@@ -0,0 +1,175 @@
+import logging
+import random
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from api.models import Job
+from api.suggestions import on_friendship_created
+
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+
+
+def job(name):
+    '''
+        Register the decorated function as the handler of jobs called name. It is
+        called with the job's payload as keyword arguments.
+    '''
+    def register(func):
+        _handlers[name] = func
+        return func
+    return register
+
+
+def enqueue(name, payload=None, key=None, delay=0):
+
+    '''
+        Queue a job for `manage.py run_jobs`. Inside a transaction the job row
+        commits (or rolls back) with the work that queued it. ``key`` makes the
+        call idempotent: a second job with the same key is not queued. Returns the
+        job id, or None for a duplicate.
+
+        With JOBS['RUN_INLINE'] the handler runs in this process once the current
+        transaction commits instead, for development and tests without a worker.
+    '''
+
+    if name not in _handlers:
+        raise KeyError(f'no job handler registered for {name!r}')
+    if settings.JOBS['RUN_INLINE']:
+        transaction.on_commit(lambda: _handlers[name](**(payload or {})))
+        return None
+    return Job.objects.enqueue(name, payload, key=key, delay=delay)
+
+
+def enqueue_many(name, payloads):
+    '''
+        Queue one job per payload with a single bulk INSERT (no idempotency keys).
+    '''
+    if name not in _handlers:
+        raise KeyError(f'no job handler registered for {name!r}')
+    if settings.JOBS['RUN_INLINE']:
+        for payload in payloads:
+            transaction.on_commit(lambda payload=payload: _handlers[name](**payload))
+        return
+    Job.objects.bulk_create([
+        Job(name=name, payload=payload, max_attempts=settings.JOBS['MAX_ATTEMPTS']) for payload in payloads
+    ])
+
+
+def backoff(attempts):
+    '''
+        Seconds before retry number ``attempts``: exponential from
+        JOBS['RETRY_DELAY'], capped at MAX_RETRY_DELAY, with up to 10% jitter so
+        jobs that failed together do not retry together.
+    '''
+    delay = min(settings.JOBS['RETRY_DELAY'] * 2 ** (attempts - 1), settings.JOBS['MAX_RETRY_DELAY'])
+    return delay * (1 + random.random() / 10)
+
+
+class LeaseExpired(Exception):
+    pass
+
+
+def _finish(job, status, **fields):
+    '''
+        Record the outcome of a claimed job, only while this worker's lease still
+        holds: the job is running with the run_at it was claimed with. Returns
+        whether it did.
+    '''
+    return Job.objects.filter(pk=job.pk, status=Job.RUNNING, run_at=job.run_at).update(
+        status=status, updated_at=timezone.now(), **fields
+    ) == 1
+
+
+def run_job(job):
+
+    '''
+        Run one claimed job. The handler and the job's completion commit in one
+        transaction, which rolls back when the lease expired and another worker
+        took the job over, so a handler whose effects are confined to the
+        database runs to completion exactly once even if a worker dies or stalls
+        midway. On an exception the job is retried after backoff() until it has
+        used max_attempts. Returns True on success.
+    '''
+
+    handler = _handlers.get(job.name)
+    if handler is None or job.attempts > job.max_attempts:
+        # unknown name, or a lease that expired on the last attempt
+        error = f'no job handler registered for {job.name!r}' if handler is None else job.last_error
+        _finish(job, Job.FAILED, last_error=error)
+        return False
+
+    try:
+        with transaction.atomic():
+            handler(**job.payload)
+            if not _finish(job, Job.DONE, last_error=''):
+                raise LeaseExpired
+        return True
+    except LeaseExpired:
+        logger.warning('job %s (%s) lease expired before it finished, its work was rolled back', job.pk, job.name)
+        return False
+    except Exception:
+        error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            logger.exception('job %s (%s) failed after %d attempts', job.pk, job.name, job.attempts)
+            _finish(job, Job.FAILED, last_error=error)
+        else:
+            logger.warning('job %s (%s) failed, attempt %d of %d', job.pk, job.name, job.attempts, job.max_attempts)
+            _finish(job, Job.QUEUED, last_error=error, run_at=timezone.now() + timedelta(seconds=backoff(job.attempts)))
+        return False
+
+
+def work(batch_size=None, lease=None, poll_interval=None, burst=False, stop=None):
+
+    '''
+        Claim and run jobs until ``stop`` (a threading/multiprocessing Event) is
+        set, sleeping poll_interval seconds whenever the queue is empty. With
+        ``burst`` return once no job is due. Returns (succeeded, failed).
+    '''
+
+    config = settings.JOBS
+    batch_size = batch_size or config['BATCH_SIZE']
+    lease = lease or config['LEASE']
+    poll_interval = config['POLL_INTERVAL'] if poll_interval is None else poll_interval
+
+    succeeded = failed = 0
+    while stop is None or not stop.is_set():
+        jobs = Job.objects.claim(batch_size, lease)
+        if not jobs:
+            if burst:
+                break
+            if stop is not None:
+                stop.wait(poll_interval)
+            else:
+                time.sleep(poll_interval)
+            continue
+        for claimed in jobs:
+            if run_job(claimed):
+                succeeded += 1
+            else:
+                failed += 1
+    return succeeded, failed
+
+
+def purge(older_than):
+    '''
+        Delete jobs that finished (done or failed) more than older_than seconds
+        ago, which also frees their idempotency keys.
+    '''
+    cutoff = timezone.now() - timedelta(seconds=older_than)
+    return Job.objects.filter(status__in=[Job.DONE, Job.FAILED], updated_at__lt=cutoff).delete()[0]
+
+
+# handlers
+
+
+@job('friendship_created')
+def update_suggestions(user_id, friend_id):
+    on_friendship_created(user_id, friend_id)
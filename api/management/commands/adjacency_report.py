@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from api.adjacency import adjacency_index
+
+
+class Command(BaseCommand):
+
+    help = 'Load the mutual-friends adjacency index and report its memory footprint, for sizing workers.'
+
+    def handle(self, *args, **options):
+        usage = adjacency_index.memory_usage()
+        self.stdout.write(f"users:        {usage['users']}")
+        self.stdout.write(f"edges:        {usage['edges']}")
+        self.stdout.write(f"array bytes:  {usage['array_bytes']}")
+        self.stdout.write(f"total bytes:  {usage['total_bytes']}")
+        self.stdout.write(f"vectorized:   {usage['vectorized']}")
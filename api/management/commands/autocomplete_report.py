@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from api.autocomplete import prefix_index
+
+
+class Command(BaseCommand):
+
+    help = 'Load the autocomplete prefix index and report its memory footprint, for sizing workers.'
+
+    def handle(self, *args, **options):
+        usage = prefix_index.memory_usage()
+        self.stdout.write(f"users:        {usage['users']}")
+        self.stdout.write(f"entries:      {usage['entries']}")
+        self.stdout.write(f"term bytes:   {usage['term_bytes']}")
+        self.stdout.write(f"id bytes:     {usage['id_bytes']}")
+        self.stdout.write(f"user bytes:   {usage['user_bytes']}")
+        self.stdout.write(f"total bytes:  {usage['total_bytes']}")
+        self.stdout.write(f"oversized:    {usage['oversized']}")
@@ -0,0 +1,75 @@
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from api.models import Friendship, User, recount_counters
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Insert the missing reverse edge of every Friendship row so the table can be '
+        'read in FRIENDSHIP_SYMMETRIC mode. Walks the rows without a reverse edge in '
+        'primary-key batches, each in its own short transaction, up to the last one, '
+        'and can resume from a checkpoint. Run it again after switching '
+        'FRIENDSHIP_SYMMETRIC on to cover rows written one-way in the meantime.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help='Seconds to pause between batches to limit load')
+        parser.add_argument('--start-after', type=int, default=None,
+                            help='Resume after this Friendship id')
+        parser.add_argument('--checkpoint', default=None,
+                            help='File storing the last processed id between runs')
+
+    def handle(self, *args, **options):
+        checkpoint = Path(options['checkpoint']) if options['checkpoint'] else None
+        last_id = options['start_after']
+        if last_id is None and checkpoint and checkpoint.exists():
+            last_id = int(checkpoint.read_text().strip() or 0)
+        last_id = last_id or 0
+
+        # reverse edges inserted by this run have their reverse, so the walk
+        # skips them and ends at the last row still missing one, including rows
+        # added while it runs
+        one_way = Friendship.objects.filter(~Exists(
+            Friendship.objects.filter(user=OuterRef('friend'), friend=OuterRef('user'))
+        ))
+
+        scanned = 0
+        started = time.monotonic()
+        while True:
+            rows = list(
+                one_way.filter(id__gt=last_id)
+                .order_by('id')
+                .values_list('id', 'user_id', 'friend_id')[:options['batch_size']]
+            )
+            if not rows:
+                break
+
+            with transaction.atomic():
+                Friendship.objects.bulk_create(
+                    [Friendship(user_id=friend_id, friend_id=user_id) for _, user_id, friend_id in rows],
+                    ignore_conflicts=True,
+                )
+                # bulk_create skips the signals adjusting friend_count
+                recount_counters(User.objects.filter(id__in={uid for _, user_id, friend_id in rows for uid in (user_id, friend_id)}))
+
+            last_id = rows[-1][0]
+            scanned += len(rows)
+            if checkpoint:
+                checkpoint.write_text(str(last_id))
+            self.stdout.write(f'processed up to id {last_id} ({scanned} rows)')
+
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'backfill complete: {scanned} reverse edges added in {elapsed:.1f}s'
+        ))
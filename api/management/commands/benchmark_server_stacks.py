@@ -0,0 +1,155 @@
+import importlib.util
+import json
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+
+STACKS = {
+    # sync views under gunicorn's threaded workers
+    'wsgi': {
+        'module': 'gunicorn',
+        'args': lambda o: [
+            'social_media_main.wsgi:application', '--bind', f"127.0.0.1:{o['port']}",
+            '--workers', str(o['workers']), '--threads', str(o['threads']), '--worker-class', 'gthread',
+        ],
+        'env': {'ASYNC_VIEWS': 'false'},
+    },
+    # api.async_views under uvicorn's event loop
+    'asgi': {
+        'module': 'uvicorn',
+        'args': lambda o: [
+            'social_media_main.asgi:application', '--host', '127.0.0.1', '--port', str(o['port']),
+            '--workers', str(o['workers']), '--no-access-log',
+        ],
+        'env': {'ASYNC_VIEWS': 'true'},
+    },
+}
+
+
+def _pin(cpus):
+    def preexec():
+        if cpus and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+    return preexec
+
+
+def _wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise CommandError(f'server exited with status {process.returncode}')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise CommandError(f'server did not listen on port {port} within {timeout}s')
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Compare the sync views under WSGI (gunicorn gthread) with api.async_views under '
+        'ASGI (uvicorn) at equal CPU: both servers get the same worker count and are '
+        'pinned to the same CPUs, then run_benchmarks drives each over HTTP at the same '
+        'concurrency. Requires gunicorn and uvicorn to be installed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stacks', nargs='+', choices=sorted(STACKS), default=['wsgi', 'asgi'])
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--threads', type=int, default=8, help='gunicorn threads per worker')
+        parser.add_argument('--cpus', default='0', help='Comma-separated CPU ids both servers are pinned to')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--endpoints', nargs='+', default=None)
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--output-dir', default=None, help='Keep each stack\'s results JSON here')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Print the server and benchmark commands without running them')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1 or options['threads'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--workers, --threads and --concurrency must be positive')
+        try:
+            cpus = {int(cpu) for cpu in options['cpus'].split(',') if cpu.strip()}
+        except ValueError:
+            raise CommandError(f"--cpus expects comma-separated CPU ids, got {options['cpus']!r}")
+
+        if options['dry_run']:
+            self._print_plan(options, cpus)
+            return
+
+        for stack in options['stacks']:
+            if importlib.util.find_spec(STACKS[stack]['module']) is None:
+                raise CommandError(f"{STACKS[stack]['module']} is required for the {stack} stack")
+
+        output_dir = Path(options['output_dir'] or tempfile.mkdtemp(prefix='stack-bench-'))
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+        results = {}
+        for stack in options['stacks']:
+            self.stdout.write(self.style.MIGRATE_HEADING(f'{stack}:'))
+            results[stack] = output_dir / f'{stack}.json'
+            process = subprocess.Popen(
+                self._server_command(stack, options),
+                env={**os.environ, **STACKS[stack]['env']},
+                preexec_fn=_pin(cpus),
+            )
+            try:
+                _wait_for_port(options['port'], process)
+                call_command('run_benchmarks', stdout=self.stdout, **self._benchmark_options(options, results[stack]))
+            finally:
+                process.terminate()
+                process.wait(timeout=30)
+
+        if len(results) == 2:
+            baseline, other = (json.loads(path.read_text()) for path in results.values())
+            self.stdout.write(self.style.MIGRATE_HEADING(f"\n{' vs '.join(reversed(list(results)))}:"))
+            for endpoint, result in other['results'].items():
+                before = baseline['results'].get(endpoint)
+                if not before or not result:
+                    continue
+                self.stdout.write(
+                    f"{endpoint:<16} throughput {result['throughput_rps']} vs {before['throughput_rps']} req/s  "
+                    f"p99 {result['p99_ms']} vs {before['p99_ms']} ms"
+                )
+        self.stdout.write(f'results in {output_dir}')
+
+    def _server_command(self, stack, options):
+        return [sys.executable, '-m', STACKS[stack]['module'], *STACKS[stack]['args'](options)]
+
+    def _benchmark_options(self, options, output):
+        benchmark = {
+            'base_url': f"http://127.0.0.1:{options['port']}",
+            'requests': options['requests'],
+            'concurrency': options['concurrency'],
+            'output': str(output),
+        }
+        if options['endpoints']:
+            benchmark['endpoints'] = options['endpoints']
+        return benchmark
+
+    def _print_plan(self, options, cpus):
+        output_dir = Path(options['output_dir'] or '<temporary directory>')
+        for stack in options['stacks']:
+            module = STACKS[stack]['module']
+            self.stdout.write(self.style.MIGRATE_HEADING(f'{stack}:'))
+            if importlib.util.find_spec(module) is None:
+                self.stdout.write(self.style.WARNING(f'  {module} is not installed'))
+            environment = ' '.join(f'{key}={value}' for key, value in STACKS[stack]['env'].items())
+            self.stdout.write(f'  server:    {environment} {shlex.join(self._server_command(stack, options))}')
+            self.stdout.write(f"  cpus:      {','.join(map(str, sorted(cpus))) or 'any'}")
+            arguments = []
+            for key, value in self._benchmark_options(options, output_dir / f'{stack}.json').items():
+                arguments += [f"--{key.replace('_', '-')}", *map(str, value if isinstance(value, list) else [value])]
+            self.stdout.write(f'  benchmark: run_benchmarks {shlex.join(arguments)}')
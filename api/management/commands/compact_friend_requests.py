@@ -0,0 +1,81 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+
+    help = ('Apply FRIEND_REQUEST_RETENTION: delete pending friend requests older than PENDING_TTL_DAYS '
+            'and move requests accepted more than ARCHIVE_AFTER_DAYS ago to FriendRequestArchive. '
+            'Walks the table in primary-key chunks, each locked only for its own short transaction.')
+
+    def add_arguments(self, parser):
+        config = settings.FRIEND_REQUEST_RETENTION
+        parser.add_argument('--pending-ttl-days', type=int, default=config['PENDING_TTL_DAYS'],
+                            help='Expire pending requests older than this; 0 skips expiry')
+        parser.add_argument('--archive-after-days', type=int, default=config['ARCHIVE_AFTER_DAYS'],
+                            help='Archive requests accepted longer ago than this; 0 archives all accepted ones')
+        parser.add_argument('--no-archive', action='store_true',
+                            help='Only expire pending requests')
+        parser.add_argument('--batch-size', type=int, default=config['BATCH_SIZE'],
+                            help='Ids per chunk')
+        parser.add_argument('--max-rate', type=float, default=config['MAX_ROWS_PER_SECOND'],
+                            help='Sleep between chunks to stay under this many changed rows per second')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Count the rows that would change and exit')
+
+    def handle(self, *args, **options):
+        from api.models import FriendRequest
+
+        now = timezone.now()
+        ttl = options['pending_ttl_days']
+        expire_before = now - timedelta(days=ttl) if ttl else None
+        archive_before = None if options['no_archive'] else now - timedelta(days=options['archive_after_days'])
+
+        if options['dry_run']:
+            expired = archived = 0
+            if expire_before is not None:
+                expired = FriendRequest.objects.filter(accepted=False, created_at__lt=expire_before).count()
+            if archive_before is not None:
+                archived = FriendRequest.objects.filter(accepted=True, updated_at__lt=archive_before).count()
+            self.stdout.write(f'would expire {expired} and archive {archived} requests')
+            return
+
+        bounds = FriendRequest.objects.aggregate(low=Min('id'), high=Max('id'))
+        if bounds['low'] is None:
+            self.stdout.write('no friend requests to process')
+            return
+
+        batch_size = max(options['batch_size'], 1)
+        max_rate = options['max_rate']
+        started = time.monotonic()
+        expired = archived = 0
+        for low in range(bounds['low'], bounds['high'] + 1, batch_size):
+            high = low + batch_size
+            if expire_before is not None:
+                expired += len(FriendRequest.objects.expire_pending(low, high, expire_before))
+            if archive_before is not None:
+                archived += FriendRequest.objects.archive_accepted(low, high, archive_before)
+
+            elapsed = time.monotonic() - started
+            if max_rate:
+                # the pause lets replicas and concurrent writers catch up
+                pause = (expired + archived) / max_rate - elapsed
+                if pause > 0:
+                    time.sleep(pause)
+                    elapsed += pause
+            if options['verbosity'] > 1:
+                self.stdout.write(
+                    f'ids < {high}: expired {expired}, archived {archived} '
+                    f'({(expired + archived) / max(elapsed, 1e-6):.0f} rows/s)'
+                )
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'expired {expired} and archived {archived} requests in {elapsed:.1f}s '
+            f'({(expired + archived) / max(elapsed, 1e-6):.0f} rows/s)'
+        ))
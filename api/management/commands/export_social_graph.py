@@ -0,0 +1,37 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.export import export_graph
+from api.models import User
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Stream a user's friends, sent requests and received requests as NDJSON to a file "
+        'or stdout, with the same format and constant memory use as the export/ endpoint.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('email')
+        parser.add_argument('--output', default=None, help='File to write (default: stdout)')
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help="Rows per server-side cursor fetch (default: GRAPH_EXPORT['CHUNK_SIZE'])")
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(email=options['email']).only('id', 'email').first()
+        if user is None:
+            raise CommandError(f"no user with email {options['email']}")
+
+        handle = open(options['output'], 'wb') if options['output'] else sys.stdout.buffer
+        try:
+            written = 0
+            for chunk in export_graph(user, options['chunk_size']):
+                handle.write(chunk)
+                written += len(chunk)
+        finally:
+            if options['output']:
+                handle.close()
+        if options['output']:
+            self.stdout.write(self.style.SUCCESS(f"wrote {written} bytes to {options['output']}"))
@@ -0,0 +1,132 @@
+import random
+import time
+from itertools import accumulate
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.email_filter import publish_emails
+from api.models import FriendRequest, Friendship, User, recount_counters
+from utils.response_cache import USERS_VERSION, bump_versions
+
+
+FIRST_NAMES = [
+    'Aarav', 'Aisha', 'Alex', 'Amelia', 'Ana', 'Arjun', 'Ben', 'Carlos', 'Chen', 'Chloe',
+    'Daniel', 'Elena', 'Fatima', 'Hana', 'Ibrahim', 'Isla', 'Jack', 'Kenji', 'Laila', 'Leo',
+    'Lucas', 'Maria', 'Mei', 'Mohammed', 'Nadia', 'Noah', 'Olivia', 'Omar', 'Priya', 'Rashid',
+    'Sara', 'Sofia', 'Tariq', 'Yusuf', 'Zara',
+]
+LAST_NAMES = [
+    'Ahmed', 'Ali', 'Brown', 'Chen', 'Costa', 'Davis', 'Fernandez', 'Garcia', 'Gupta', 'Hassan',
+    'Ito', 'Jones', 'Khan', 'Kim', 'Kowalski', 'Lee', 'Martin', 'Mensah', 'Meyer', 'Nguyen',
+    'Okafor', 'Patel', 'Rossi', 'Sato', 'Silva', 'Singh', 'Smith', 'Taylor', 'Wang', 'Wilson',
+]
+
+BENCHMARK_PASSWORD = 'benchmark-password'
+
+
+def benchmark_email(index):
+    return f'bench{index}@example.com'
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Generate a synthetic social graph for benchmarking: users with realistic names, '
+        'power-law friendship degrees and pending FriendRequest backlogs. Every user gets '
+        f'the password "{BENCHMARK_PASSWORD}" and the email bench<N>@example.com.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--avg-degree', type=float, default=20.0,
+                            help='Mean number of friends per user')
+        parser.add_argument('--alpha', type=float, default=2.1,
+                            help='Pareto shape of the degree distribution (lower = heavier tail)')
+        parser.add_argument('--pending-ratio', type=float, default=0.2,
+                            help='Fraction of users with a pending-request backlog')
+        parser.add_argument('--pending-max', type=int, default=50,
+                            help='Upper bound of a single user\'s pending backlog')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+        started = time.monotonic()
+
+        # one hash shared by every user keeps generation fast
+        password = make_password(BENCHMARK_PASSWORD)
+        offset = User.objects.filter(email__startswith='bench', email__endswith='@example.com').count()
+        users = [
+            User(
+                email=benchmark_email(offset + i),
+                name=f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+                password=password,
+            )
+            for i in range(options['users'])
+        ]
+        with transaction.atomic():
+            User.objects.bulk_create(users, batch_size=batch_size)
+        # bulk_create skips the post_save receivers: let email filters and
+        # cached searches in other processes see the new users
+        publish_emails([user.email for user in users])
+        bump_versions(USERS_VERSION)
+        ids = [user.pk for user in users]
+        if None in ids:
+            # backend cannot return primary keys from a bulk insert
+            ids = list(User.objects.filter(email__in=[user.email for user in users]).values_list('id', flat=True))
+        self.stdout.write(f'users: {len(ids)} in {time.monotonic() - started:.1f}s')
+
+        edges = self._power_law_edges(rng, ids, options['avg_degree'], options['alpha'])
+        rows = [Friendship(user_id=a, friend_id=b) for a, b in edges]
+        if settings.FRIENDSHIP_SYMMETRIC:
+            rows += [Friendship(user_id=b, friend_id=a) for a, b in edges]
+        with transaction.atomic():
+            Friendship.objects.bulk_create(rows, batch_size=batch_size, ignore_conflicts=True)
+        self.stdout.write(f'friendships: {len(edges)} in {time.monotonic() - started:.1f}s')
+
+        requests = []
+        seen = set(edges)
+        for receiver in rng.sample(ids, int(len(ids) * options['pending_ratio'])):
+            for sender in rng.sample(ids, min(rng.randint(1, options['pending_max']), len(ids))):
+                pair = (min(sender, receiver), max(sender, receiver))
+                if sender != receiver and pair not in seen:
+                    seen.add(pair)
+                    requests.append(FriendRequest(sender_id=sender, receiver_id=receiver))
+        with transaction.atomic():
+            FriendRequest.objects.bulk_create(requests, batch_size=batch_size, ignore_conflicts=True)
+        self.stdout.write(f'pending requests: {len(requests)} in {time.monotonic() - started:.1f}s')
+
+        # bulk_create skips the signals adjusting the User counters
+        for start in range(0, len(ids), batch_size):
+            with transaction.atomic():
+                recount_counters(User.objects.filter(id__in=ids[start:start + batch_size]))
+        self.stdout.write(f'counters: {len(ids)} users in {time.monotonic() - started:.1f}s')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'generated {len(ids)} users, {len(edges)} friendships and {len(requests)} pending '
+            f'requests in {time.monotonic() - started:.1f}s'
+        ))
+
+    def _power_law_edges(self, rng, ids, avg_degree, alpha):
+        '''
+            Chung-Lu style sampling: each user draws a Pareto weight and edge
+            endpoints are picked proportionally to it, giving a heavy-tailed
+            degree distribution with the requested mean.
+        '''
+        if len(ids) < 2:
+            return set()
+        weights = [rng.paretovariate(alpha - 1) for _ in ids]
+        cum_weights = list(accumulate(weights))
+        target = int(len(ids) * avg_degree / 2)
+        edges = set()
+        attempts = 0
+        while len(edges) < target and attempts < target * 3:
+            attempts += 1
+            a, b = rng.choices(ids, cum_weights=cum_weights, k=2)
+            if a != b:
+                edges.add((min(a, b), max(a, b)))
+        return edges
@@ -0,0 +1,204 @@
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from api.email_filter import publish_emails
+from api.models import Friendship, User, recount_counters
+from utils.response_cache import USERS_VERSION, bump_versions
+
+
+def _init_worker():
+    if not apps.ready:
+        django.setup()
+
+
+def _hash(password):
+    return make_password(password)
+
+
+def _read_records(path):
+    '''
+        Yield dicts from a .csv (with header) or .ndjson/.jsonl file.
+    '''
+    path = Path(path)
+    with path.open(newline='', encoding='utf-8') as handle:
+        if path.suffix == '.csv':
+            yield from csv.DictReader(handle)
+        elif path.suffix in ('.ndjson', '.jsonl'):
+            for line in handle:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise CommandError(f'{path}: expected a .csv, .ndjson or .jsonl file')
+
+
+def _batches(records, size):
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Stream users and friendships from CSV or NDJSON into the database. Passwords '
+        'are hashed in a process pool and rows inserted with bulk_create in large '
+        'batches; progress is checkpointed so an interrupted import can resume.\n\n'
+        'Users: email, name, and password (raw) or password_hash (already hashed).\n'
+        'Friendships: user_email, friend_email.\n'
+        'Records without an email, and friendships naming an unknown user, are skipped '
+        'and counted in the report.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', help='CSV/NDJSON file of users')
+        parser.add_argument('--friendships', help='CSV/NDJSON file of friendships')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Password hashing processes (default: CPU count)')
+        parser.add_argument('--checkpoint', default=None,
+                            help='JSON file recording how many records of each file are done')
+
+    def handle(self, *args, **options):
+        if not options['users'] and not options['friendships']:
+            raise CommandError('pass --users and/or --friendships')
+
+        self.checkpoint_path = Path(options['checkpoint']) if options['checkpoint'] else None
+        self.checkpoint = {}
+        if self.checkpoint_path and self.checkpoint_path.exists():
+            self.checkpoint = json.loads(self.checkpoint_path.read_text())
+
+        if options['users']:
+            workers = options['workers'] or os.cpu_count() or 1
+            with ProcessPoolExecutor(workers, initializer=_init_worker) as pool:
+                self._import('users', options['users'], options['batch_size'],
+                             lambda batch: self._insert_users(batch, workers, pool))
+        if options['friendships']:
+            self._import('friendships', options['friendships'], options['batch_size'],
+                         self._insert_friendships)
+            self.stdout.write('run rebuild_friend_suggestions to refresh suggestions for imported friendships')
+
+    def _save_checkpoint(self, phase, done):
+        self.checkpoint[phase] = done
+        if self.checkpoint_path:
+            self.checkpoint_path.write_text(json.dumps(self.checkpoint))
+
+    def _import(self, phase, path, batch_size, insert):
+        done = self.checkpoint.get(phase, 0)
+        records = islice(_read_records(path), done, None)
+        if done:
+            self.stdout.write(f'{phase}: resuming after {done} records')
+
+        read = inserted = skipped = 0
+        started = time.monotonic()
+        for batch in _batches(records, batch_size):
+            batch_inserted, batch_skipped = insert(batch)
+            inserted += batch_inserted
+            skipped += batch_skipped
+            read += len(batch)
+            self._save_checkpoint(phase, done + read)
+            elapsed = max(time.monotonic() - started, 1e-6)
+            self.stdout.write(f'{phase}: {done + read} records read, {read / elapsed:.0f} records/s')
+
+        elapsed = max(time.monotonic() - started, 1e-6)
+        self.stdout.write(self.style.SUCCESS(
+            f'{phase}: {read} records read, {inserted} rows inserted, {skipped} records skipped in {elapsed:.1f}s '
+            f'({read / elapsed:.0f} records/s)'
+        ))
+
+    def _insert_users(self, batch, workers, pool):
+        '''
+            Insert the batch's new users; returns (rows inserted, records skipped).
+        '''
+        records = [record for record in batch if record.get('email')]
+        emails = [User.objects.normalize_email(record['email']) for record in records]
+        # skipping known emails up front also avoids re-hashing them on resume
+        existing = set(User.objects.filter(email__in=emails).values_list('email', flat=True))
+        pending = {}
+        for email, record in zip(emails, records):
+            if email not in existing:
+                pending.setdefault(email, record)
+
+        raw = [record.get('password') for record in pending.values() if not record.get('password_hash')]
+        hashed = iter(pool.map(_hash, raw, chunksize=max(len(raw) // (workers * 4), 1)))
+
+        users = []
+        for email, record in pending.items():
+            users.append(User(
+                email=email,
+                name=record.get('name') or '',
+                password=record.get('password_hash') or next(hashed),
+            ))
+
+        with transaction.atomic():
+            User.objects.bulk_create(users, ignore_conflicts=True)
+            # ignore_conflicts drops rows another import inserted meanwhile, and
+            # leaves the pks unset on some backends: count what is there now
+            inserted = User.objects.filter(email__in=emails).count() - len(existing)
+        # bulk_create skips the post_save receivers: let email filters and
+        # cached searches in other processes see the new users
+        publish_emails([user.email for user in users])
+        bump_versions(USERS_VERSION)
+        return inserted, len(batch) - len(records)
+
+    def _insert_friendships(self, batch):
+        '''
+            Insert the batch's new friendships; returns (rows inserted, records
+            skipped).
+        '''
+        records = [
+            (User.objects.normalize_email(record['user_email']), User.objects.normalize_email(record['friend_email']))
+            for record in batch if record.get('user_email') and record.get('friend_email')
+        ]
+        emails = {email for record in records for email in record}
+        ids = dict(User.objects.filter(email__in=emails).values_list('email', 'id'))
+
+        pairs = set()
+        skipped = len(batch) - len(records)
+        for user_email, friend_email in records:
+            user_id, friend_id = ids.get(user_email), ids.get(friend_email)
+            if user_id and friend_id and user_id != friend_id:
+                pairs.add((user_id, friend_id))
+            else:
+                skipped += 1
+
+        # skip pairs already stored in either direction
+        involved = {uid for pair in pairs for uid in pair}
+        existing = set(
+            Friendship.objects.filter(user_id__in=involved, friend_id__in=involved)
+            .values_list('user_id', 'friend_id')
+        )
+        stored = len(existing)
+        edges = []
+        for user_id, friend_id in sorted(pairs):
+            if (user_id, friend_id) in existing or (friend_id, user_id) in existing:
+                continue
+            existing.add((user_id, friend_id))
+            edges.append(Friendship(user_id=user_id, friend_id=friend_id))
+            if settings.FRIENDSHIP_SYMMETRIC:
+                edges.append(Friendship(user_id=friend_id, friend_id=user_id))
+
+        if not edges:
+            return 0, skipped
+        affected = {uid for edge in edges for uid in (edge.user_id, edge.friend_id)}
+        with transaction.atomic():
+            Friendship.objects.bulk_create(edges, ignore_conflicts=True)
+            inserted = Friendship.objects.filter(user_id__in=involved, friend_id__in=involved).count() - stored
+            # bulk_create skips the signals adjusting friend_count and dropping
+            # the cached friend lists
+            recount_counters(User.objects.filter(id__in=affected))
+            bump_versions(*affected)
+        return inserted, skipped
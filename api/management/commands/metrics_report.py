@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from utils import metrics
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Print the api metrics in Prometheus text format, merged over every worker '
+        'writing to METRICS["DIR"]. Without a directory only this process\'s (empty) '
+        'metrics exist; scrape /metrics instead.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clear', action='store_true',
+                            help='Delete the per-process files instead; run before the workers start')
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            metrics.clear()
+            self.stdout.write(f'cleared {settings.METRICS["DIR"] or "(no METRICS_DIR set)"}')
+            return
+        self.stdout.write(metrics.render(), ending='')
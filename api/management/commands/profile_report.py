@@ -0,0 +1,53 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from utils.profiling import format_collapsed, stack_store
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Print the request stacks sampled by ProfilingMiddleware in collapsed format '
+        '(pipe into flamegraph.pl, or load into speedscope). Workers publish their samples '
+        'to PROFILING["CACHE"] every FLUSH_INTERVAL seconds, which must be a cache shared '
+        'between processes (not locmem).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url-name', help='Only this endpoint, without the url name as root frame')
+        parser.add_argument('--output', help='Write the collapsed stacks to this file instead of stdout')
+        parser.add_argument('--summary', action='store_true',
+                            help='Print samples per endpoint and the hottest leaf functions instead')
+        parser.add_argument('--top', type=int, default=10, help='Leaf functions listed per endpoint with --summary')
+        parser.add_argument('--reset', action='store_true', help='Discard the samples after reporting')
+
+    def handle(self, *args, **options):
+        if not stack_store.shared:
+            raise CommandError(
+                f'PROFILING["CACHE"] ({stack_store.cache_alias!r}) is process-local, so this command '
+                'cannot see the samples of the server workers; point it at a shared cache (e.g. redis).'
+            )
+        stacks = stack_store.collect()
+
+        if options['summary']:
+            for url_name, counts in sorted(stacks.items()):
+                if options['url_name'] and url_name != options['url_name']:
+                    continue
+                total = sum(counts.values())
+                self.stdout.write(f'{url_name}: {total} samples')
+                leaves = Counter()
+                for stack, count in counts.items():
+                    leaves[stack.rpartition(';')[2]] += count
+                for leaf, count in leaves.most_common(options['top']):
+                    self.stdout.write(f'  {count / total:6.1%}  {leaf}')
+        elif options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(format_collapsed(stacks, options['url_name']))
+            self.stdout.write(f'wrote {options["output"]}')
+        else:
+            self.stdout.write(format_collapsed(stacks, options['url_name']), ending='')
+
+        if options['reset']:
+            stack_store.reset()
+            self.stdout.write('samples discarded')
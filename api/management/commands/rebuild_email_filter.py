@@ -0,0 +1,47 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.email_filter import EmailFilter, current_sequence, write_filter
+from api.models import User
+
+
+class Command(BaseCommand):
+
+    help = (
+        "Rebuild the shared email filter file (EMAIL_FILTER['PATH']) from the User table and "
+        'swap it in atomically; workers mapping the old file switch to the new one on their '
+        'next lookup. Sized for at least twice the current user count.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=None, help="Defaults to EMAIL_FILTER['PATH']")
+        parser.add_argument('--capacity', type=int, default=None,
+                            help="Defaults to the larger of EMAIL_FILTER['CAPACITY'] and twice the user count")
+        parser.add_argument('--error-rate', type=float, default=None)
+
+    def handle(self, *args, **options):
+        config = settings.EMAIL_FILTER
+        path = options['path'] or config['PATH']
+        if not path:
+            raise CommandError("EMAIL_FILTER['PATH'] is not set; per-process filters are built on first use")
+
+        capacity = options['capacity'] or max(config['CAPACITY'], 2 * User.objects.count())
+        error_rate = options['error_rate'] or config['ERROR_RATE']
+
+        started = time.monotonic()
+        # read before the table, so users added meanwhile are replayed from the log
+        sequence = current_sequence()
+        _, _, count = write_filter(
+            path, User.objects.values_list('email', flat=True).iterator(), capacity, error_rate, sequence
+        )
+        email_filter = EmailFilter(path, capacity, error_rate, config['TTL'], config['LOG_SIZE'])
+        email_filter.sync()
+        stats = email_filter.stats()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"wrote {count} emails to {path} in {time.monotonic() - started:.1f}s: "
+            f"{stats['bytes']} bytes, {stats['hashes']} hashes, "
+            f"estimated false positive rate {stats['false_positive_rate']}"
+        ))
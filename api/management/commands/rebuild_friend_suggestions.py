@@ -0,0 +1,70 @@
+import multiprocessing
+import time
+from functools import lru_cache
+
+import django
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Max, Min
+
+
+def _init_worker():
+    # forked children must not share the parent's database sockets
+    if not apps.ready:
+        django.setup()
+    connections.close_all()
+
+
+def _rebuild_shard(bounds):
+    from api.models import Friendship, User
+    from api.suggestions import compute_suggestions, store_suggestions
+
+    low, high = bounds
+    friend_ids = lru_cache(maxsize=50000)(lambda uid: frozenset(Friendship.objects.friend_ids(uid)))
+
+    rebuilt = 0
+    user_ids = User.objects.filter(id__gte=low, id__lt=high).order_by('id').values_list('id', flat=True)
+    for user_id in user_ids.iterator():
+        store_suggestions(user_id, compute_suggestions(user_id, friend_ids))
+        rebuilt += 1
+    connections.close_all()
+    return rebuilt
+
+
+class Command(BaseCommand):
+
+    help = 'Recompute every stored FriendSuggestion from the Friendship graph, sharded by user id.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Worker processes; each handles whole user-id shards')
+        parser.add_argument('--shards', type=int, default=None,
+                            help='Number of user-id ranges (default: 4 per worker)')
+
+    def handle(self, *args, **options):
+        from api.models import User
+
+        bounds = User.objects.aggregate(low=Min('id'), high=Max('id'))
+        if bounds['low'] is None:
+            self.stdout.write('no users to process')
+            return
+
+        workers = max(options['workers'], 1)
+        shard_count = options['shards'] or workers * 4
+        low, high = bounds['low'], bounds['high'] + 1
+        step = max((high - low + shard_count - 1) // shard_count, 1)
+        shards = [(start, min(start + step, high)) for start in range(low, high, step)]
+
+        started = time.monotonic()
+        if workers == 1:
+            rebuilt = sum(map(_rebuild_shard, shards))
+        else:
+            connections.close_all()
+            with multiprocessing.Pool(workers, initializer=_init_worker) as pool:
+                rebuilt = sum(pool.imap_unordered(_rebuild_shard, shards))
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'rebuilt suggestions for {rebuilt} users over {len(shards)} shards in {elapsed:.1f}s'
+        ))
@@ -0,0 +1,61 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Min
+
+
+class Command(BaseCommand):
+
+    help = ('Recompute the denormalized User counters (friend_count, pending_in_count, '
+            'pending_out_count) from the underlying rows and repair any that drifted.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Users per id range; each range is locked and fixed in its own transaction')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report drifted counters without writing them')
+
+    def handle(self, *args, **options):
+        from api.models import User, counted_values
+
+        bounds = User.objects.aggregate(low=Min('id'), high=Max('id'))
+        if bounds['low'] is None:
+            self.stdout.write('no users to process')
+            return
+
+        batch_size = max(options['batch_size'], 1)
+        started = time.monotonic()
+        checked = drifted = 0
+        for start in range(bounds['low'], bounds['high'] + 1, batch_size):
+            with transaction.atomic():
+                # row locks make the counter writes of concurrent requests wait
+                # until the range is fixed, so no adjustment lands in between
+                users = list(
+                    User.objects.select_for_update()
+                    .filter(id__gte=start, id__lt=start + batch_size)
+                    .only('id', *User.COUNTER_FIELDS)
+                    .annotate(**counted_values())
+                )
+                stale = []
+                for user in users:
+                    changed = False
+                    for field in User.COUNTER_FIELDS:
+                        actual = getattr(user, f'actual_{field}')
+                        if getattr(user, field) != actual:
+                            if options['verbosity'] > 1:
+                                self.stdout.write(f'user {user.id}: {field} {getattr(user, field)} -> {actual}')
+                            setattr(user, field, actual)
+                            changed = True
+                    if changed:
+                        stale.append(user)
+                checked += len(users)
+                drifted += len(stale)
+                if stale and not options['dry_run']:
+                    User.objects.bulk_update(stale, User.COUNTER_FIELDS)
+
+        elapsed = time.monotonic() - started
+        verb = 'found' if options['dry_run'] else 'repaired'
+        self.stdout.write(self.style.SUCCESS(
+            f'checked {checked} users, {verb} {drifted} with drifted counters in {elapsed:.1f}s'
+        ))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from utils import response_cache
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Report response cache hit/miss counters per endpoint. Counters live in the '
+        'RESPONSE_CACHE backend, so a process-local (locmem) backend only reports its own process.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Zero the counters after reporting')
+
+    def handle(self, *args, **options):
+        for scope, counts in response_cache.stats().items():
+            total = counts['hit'] + counts['miss']
+            ratio = f"{counts['hit'] / total:.1%}" if total else '-'
+            self.stdout.write(f"{scope:<16} hits {counts['hit']:>8}  misses {counts['miss']:>8}  hit ratio {ratio}")
+        if options['reset']:
+            response_cache.reset_stats()
+            self.stdout.write('counters reset')
@@ -0,0 +1,274 @@
+import json
+import random
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Queue
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+
+from api.management.commands.generate_social_graph import BENCHMARK_PASSWORD
+from api.models import FriendRequest, User, UserActivityConstraints
+from api.serializers import CustomTokenObtainPairSerializer
+from utils.instrumentation import record_queries
+
+
+ENDPOINTS = ['search-user', 'lists-friends', 'list-requests', 'send-request', 'manage-requests', 'login']
+
+# send-request allowance given to the sampled users, far above RATE_LIMITS' 3/m
+BENCHMARK_REQUEST_LIMIT = 1_000_000
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+class BenchmarkContext:
+
+    '''
+        Users, tokens and pending requests the scenarios draw from.
+    '''
+
+    def __init__(self, sample_size, rng):
+        self.rng = rng
+        users = list(
+            User.objects.filter(email__startswith='bench').order_by('?')
+            .values_list('id', 'email', 'name')[:sample_size]
+        )
+        if not users:
+            raise CommandError('no benchmark users found; run generate_social_graph first')
+        self.users = users
+        self.tokens = {}
+        for user in User.objects.filter(id__in=[u[0] for u in users]):
+            token = CustomTokenObtainPairSerializer.get_token(user)
+            self.tokens[user.id] = str(token.access_token)
+
+        self.pending = Queue()
+        for receiver_id, sender_email in (
+            FriendRequest.objects.filter(receiver_id__in=self.tokens, accepted=False)
+            .values_list('receiver_id', 'sender__email')[:10000]
+        ):
+            self.pending.put((receiver_id, sender_email))
+        self._lock = threading.Lock()
+
+    def raise_request_limits(self, limit):
+        '''
+            Give every sampled user a request_limit override of ``limit``, so the
+            send-request scenario measures the view rather than 429s. Saving the
+            rows drops the cached overrides; a server driven over HTTP has to
+            share RATE_LIMIT_CACHE with this process to see them.
+        '''
+        for user_id in self.tokens:
+            UserActivityConstraints.objects.update_or_create(user_id=user_id, defaults={'request_limit': limit})
+
+    def random_user(self):
+        with self._lock:
+            return self.rng.choice(self.users)
+
+    def request_for(self, endpoint):
+        '''
+            (method, path, payload, user_id) for one call of the scenario.
+        '''
+        user_id, email, name = self.random_user()
+        if endpoint == 'search-user':
+            keyword = name.split()[0] if name else email
+            return 'get', f'/api/search-user/?keyword={keyword}', None, user_id
+        if endpoint == 'lists-friends':
+            return 'get', '/api/lists-friends/?mode=cursor', None, user_id
+        if endpoint == 'list-requests':
+            return 'get', '/api/list-requests/', None, user_id
+        if endpoint == 'send-request':
+            _, target, _ = self.random_user()
+            return 'post', '/api/send-request/', {'to_email': target}, user_id
+        if endpoint == 'manage-requests':
+            try:
+                receiver_id, sender_email = self.pending.get_nowait()
+            except Empty:
+                return 'post', '/api/manage-requests/', {'sender': email, 'accept': False}, user_id
+            with self._lock:
+                accept = self.rng.random() < 0.5
+            return 'post', '/api/manage-requests/', {'sender': sender_email, 'accept': accept}, receiver_id
+        if endpoint == 'login':
+            return 'post', '/api/login/', {'email': email, 'password': BENCHMARK_PASSWORD}, None
+        raise CommandError(f'unknown endpoint {endpoint}')
+
+
+class InProcessDriver:
+
+    def __init__(self, context):
+        self.context = context
+        self.local = threading.local()
+
+    def call(self, method, path, payload, user_id):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            # the test client's default "testserver" host is not in ALLOWED_HOSTS
+            host = next((h.lstrip('.') for h in settings.ALLOWED_HOSTS if h != '*'), 'localhost')
+            client = self.local.client = Client(HTTP_HOST=host)
+        headers = {}
+        if user_id is not None:
+            headers['HTTP_AUTHORIZATION'] = f'Bearer {self.context.tokens[user_id]}'
+        with record_queries() as recorder:
+            started = time.perf_counter()
+            if method == 'get':
+                response = client.get(path, **headers)
+            else:
+                response = client.post(path, json.dumps(payload), content_type='application/json', **headers)
+            elapsed = time.perf_counter() - started
+        return elapsed, response.status_code, recorder.count
+
+
+class HttpDriver:
+
+    def __init__(self, context, base_url):
+        self.context = context
+        self.base_url = base_url.rstrip('/')
+
+    def call(self, method, path, payload, user_id):
+        headers = {'Content-Type': 'application/json'}
+        if user_id is not None:
+            headers['Authorization'] = f'Bearer {self.context.tokens[user_id]}'
+        data = json.dumps(payload).encode() if method == 'post' else None
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method.upper())
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                status, response_headers = response.status, response.headers
+        except urllib.error.HTTPError as error:
+            status, response_headers = error.code, error.headers
+        elapsed = time.perf_counter() - started
+        queries = response_headers.get('X-DB-Query-Count')
+        return elapsed, status, int(queries) if queries is not None else None
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Benchmark the api endpoints in-process (Django test client) or over HTTP at a '
+        'given concurrency. Reports p50/p95/p99 latency, throughput and queries per '
+        'request, writes JSON results and can compare them with an earlier run.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=ENDPOINTS)
+        parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint')
+        parser.add_argument('--concurrency', type=int, default=1)
+        parser.add_argument('--warmup', type=int, default=10, help='Unmeasured requests per endpoint')
+        parser.add_argument('--base-url', default=None,
+                            help='Drive a running server over HTTP instead of in-process')
+        parser.add_argument('--sample-users', type=int, default=200)
+        parser.add_argument('--output', default=None, help='Write results as JSON to this file')
+        parser.add_argument('--compare', default=None, help='Earlier results JSON to diff against')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--request-limit', type=int, default=BENCHMARK_REQUEST_LIMIT,
+                            help='send-request limit per rate period for the sampled users; '
+                                 '0 keeps their configured limits')
+
+    def handle(self, *args, **options):
+        context = BenchmarkContext(options['sample_users'], random.Random(options['seed']))
+        if options['request_limit'] and 'send-request' in options['endpoints']:
+            context.raise_request_limits(options['request_limit'])
+        driver = HttpDriver(context, options['base_url']) if options['base_url'] else InProcessDriver(context)
+
+        results = {}
+        for endpoint in options['endpoints']:
+            self._run(driver, context, endpoint, options['warmup'], 1)
+            results[endpoint] = self._run(driver, context, endpoint, options['requests'], options['concurrency'])
+            self._print(endpoint, results[endpoint])
+
+        report = {
+            'commit': self._commit(),
+            'mode': 'http' if options['base_url'] else 'in-process',
+            'concurrency': options['concurrency'],
+            'requests': options['requests'],
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                json.dump(report, handle, indent=2)
+            self.stdout.write(f"results written to {options['output']}")
+        if options['compare']:
+            with open(options['compare']) as handle:
+                self._compare(json.load(handle), report)
+
+    def _run(self, driver, context, endpoint, total, concurrency):
+        if total <= 0:
+            return None
+        shares = [total // concurrency + (1 if i < total % concurrency else 0) for i in range(concurrency)]
+
+        def worker(count):
+            samples = []
+            try:
+                for _ in range(count):
+                    samples.append(driver.call(*context.request_for(endpoint)))
+            finally:
+                connections.close_all()
+            return samples
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as pool:
+            samples = [sample for chunk in pool.map(worker, shares) for sample in chunk]
+        wall = time.perf_counter() - started
+
+        # latencies and query counts cover successful requests only: a 429 or 400
+        # returns before the view's real work and would flatter the numbers
+        succeeded = [sample for sample in samples if 200 <= sample[1] < 300]
+        latencies = sorted(elapsed * 1000 for elapsed, _, _ in succeeded)
+        queries = [count for _, _, count in succeeded if count is not None]
+        return {
+            'requests': len(samples),
+            'non_2xx': len(samples) - len(succeeded),
+            'throughput_rps': round(len(samples) / wall, 2),
+            'p50_ms': self._round(percentile(latencies, 0.50)),
+            'p95_ms': self._round(percentile(latencies, 0.95)),
+            'p99_ms': self._round(percentile(latencies, 0.99)),
+            'mean_queries': round(sum(queries) / len(queries), 2) if queries else None,
+            'statuses': dict(Counter(str(status) for _, status, _ in samples)),
+        }
+
+    def _round(self, value):
+        return None if value is None else round(value, 3)
+
+    def _print(self, endpoint, result):
+        self.stdout.write(
+            f"{endpoint:<16} {result['throughput_rps']:>9} req/s  p50 {result['p50_ms']!s:>8} ms  "
+            f"p95 {result['p95_ms']!s:>8} ms  p99 {result['p99_ms']!s:>8} ms  "
+            f"queries {result['mean_queries']}  statuses {result['statuses']}"
+        )
+        if result['non_2xx']:
+            self.stdout.write(self.style.WARNING(
+                f"{endpoint:<16} {result['non_2xx']} of {result['requests']} requests failed "
+                f"and are left out of the latencies and query counts"
+            ))
+
+    def _compare(self, baseline, report):
+        self.stdout.write(f"\ncompared with {baseline.get('commit') or 'baseline'}:")
+        for endpoint, result in report['results'].items():
+            before = baseline.get('results', {}).get(endpoint)
+            if not before:
+                continue
+            deltas = []
+            for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps'):
+                if before.get(key) and result[key] is not None:
+                    deltas.append(f'{key} {(result[key] - before[key]) / before[key] * 100:+.1f}%')
+            self.stdout.write(f"{endpoint:<16} {'  '.join(deltas)}")
+
+    def _commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,91 @@
+import multiprocessing
+import signal
+import threading
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+
+def _work(options, stop):
+    from api.jobs import work
+
+    try:
+        return work(
+            batch_size=options['batch_size'], lease=options['lease'], poll_interval=options['poll_interval'],
+            burst=options['burst'], stop=stop,
+        )
+    finally:
+        connections.close_all()
+
+
+def _work_process(options, stop, results):
+    # forked children must not share the parent's database sockets
+    if not apps.ready:
+        django.setup()
+    connections.close_all()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    outcome = (0, 0)
+    try:
+        outcome = _work(options, stop)
+    finally:
+        results.put(outcome)
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Run queued background jobs (api.jobs) with a pool of worker threads or processes. '
+        'Workers claim due jobs in batches with FOR UPDATE SKIP LOCKED where supported, so '
+        'any number of these commands can run side by side (on SQLite, whose writers lock '
+        'the whole database, concurrent workers mostly retry). Stops on SIGINT/SIGTERM '
+        'after the jobs in hand.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1)
+        parser.add_argument('--pool', choices=['thread', 'process'], default='thread',
+                            help='Threads suit I/O-bound handlers; processes sidestep the GIL')
+        parser.add_argument('--batch-size', type=int, default=None, help="Defaults to JOBS['BATCH_SIZE']")
+        parser.add_argument('--lease', type=int, default=None, help="Defaults to JOBS['LEASE']")
+        parser.add_argument('--poll-interval', type=float, default=None, help="Defaults to JOBS['POLL_INTERVAL']")
+        parser.add_argument('--burst', action='store_true', help='Exit once no job is due')
+
+    def handle(self, *args, **options):
+        from api.jobs import purge
+
+        workers = max(options['workers'], 1)
+        if options['pool'] == 'process':
+            stop = multiprocessing.Event()
+            results = multiprocessing.Queue()
+            connections.close_all()
+            pool = [multiprocessing.Process(target=_work_process, args=(options, stop, results)) for _ in range(workers)]
+        else:
+            stop = threading.Event()
+            results = None
+            outcomes = []
+            pool = [threading.Thread(target=lambda: outcomes.append(_work(options, stop))) for _ in range(workers)]
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stop.set())
+        for worker in pool:
+            worker.start()
+        self.stdout.write(f"{workers} {options['pool']} worker(s) running")
+
+        # purge finished jobs now and then while the workers run
+        while not options['burst'] and any(worker.is_alive() for worker in pool):
+            deleted = purge(settings.JOBS['KEEP_FINISHED'])
+            connections.close_all()
+            if deleted:
+                self.stdout.write(f'purged {deleted} finished jobs')
+            stop.wait(600)
+        if results is not None:
+            outcomes = [results.get() for _ in pool]
+        for worker in pool:
+            worker.join()
+
+        succeeded = sum(outcome[0] for outcome in outcomes)
+        failed = sum(outcome[1] for outcome in outcomes)
+        self.stdout.write(self.style.SUCCESS(f'{succeeded} jobs succeeded, {failed} failed'))
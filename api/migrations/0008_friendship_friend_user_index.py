@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-18 19:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_user_name_trgm_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='friendship',
+            index=models.Index(fields=['friend', 'user'], name='api_friendship_friend_user'),
+        ),
+    ]
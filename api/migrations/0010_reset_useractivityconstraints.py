@@ -0,0 +1,24 @@
+from django.db import migrations
+
+
+# the per-minute allowance the old countdown refilled to
+OLD_ALLOWANCE = 3
+
+
+def reset_countdowns(apps, schema_editor):
+    # request_limit used to be a per-minute countdown refilled to OLD_ALLOWANCE;
+    # it is now a per-user override of RATE_LIMITS['send_request']. Rows keep
+    # their limit, only a partly spent countdown goes back to the full allowance
+    UserActivityConstraints = apps.get_model('api', 'UserActivityConstraints')
+    UserActivityConstraints.objects.filter(request_limit__lt=OLD_ALLOWANCE).update(request_limit=OLD_ALLOWANCE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_friendsuggestion'),
+    ]
+
+    operations = [
+        migrations.RunPython(reset_countdowns, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-18 19:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_user_token_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='friendrequest',
+            index=models.Index(condition=models.Q(('accepted', False)), fields=['receiver', '-created_at', '-id', 'sender'], name='api_friendrequest_inbox'),
+        ),
+    ]
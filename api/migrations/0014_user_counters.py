@@ -0,0 +1,43 @@
+# Generated by Django 4.2 on 2026-10-18 20:01
+
+from django.db import migrations, models
+
+from api.models import counted_values
+
+
+def populate_counters(apps, schema_editor):
+    User = apps.get_model('api', 'User')
+    # counted without FRIENDSHIP_SYMMETRIC's shortcut, so the result does not
+    # depend on the mode the migration happens to run under
+    values = counted_values(apps.get_model('api', 'Friendship'), apps.get_model('api', 'FriendRequest'), symmetric=False)
+    User.objects.update(
+        friend_count=values['actual_friend_count'],
+        pending_in_count=values['actual_pending_in_count'],
+        pending_out_count=values['actual_pending_out_count'],
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='friend_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='pending_in_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='pending_out_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,14 @@
-from django.db import models
+import json
+from collections import defaultdict
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections, models, router, transaction
+from django.db.models import Case, Count, Exists, F, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+from django.dispatch import Signal
 from django.contrib.auth.models import AbstractUser, UserManager, Group, Permission
 from django.contrib.auth.hashers import make_password
 
@@ -52,12 +62,20 @@ class User(AbstractUser):
     username = None # type : ignore
     email = models.EmailField(unique=True)
     is_active = models.BooleanField(default=True)
+    # bumped on password change or deactivation to revoke issued JWTs
+    token_version = models.PositiveIntegerField(default=0)
+    # maintained with F() updates by the friend request and friendship write
+    # paths; `manage.py reconcile_counters` repairs drift
+    friend_count = models.PositiveIntegerField(default=0)
+    pending_in_count = models.PositiveIntegerField(default=0)
+    pending_out_count = models.PositiveIntegerField(default=0)
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     USERNAME_FIELD = "email"
     REQUIRED_FIELDS = []
+    COUNTER_FIELDS = ('friend_count', 'pending_in_count', 'pending_out_count')
 
     objects = CustomUserManager()
 
@@ -78,6 +96,38 @@ class User(AbstractUser):
         related_name='custom_user_permissions'
     )
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        user = super().from_db(db, field_names, values)
+        user._loaded_is_active = user.__dict__.get('is_active')
+        return user
+
+    def _bump_token_version(self):
+        self.token_version += 1
+        self._token_version_changed = True
+
+    def set_password(self, raw_password):
+        super().set_password(raw_password)
+        if self.pk is not None:
+            self._bump_token_version()
+
+    def save(self, *args, **kwargs):
+        if getattr(self, '_from_token_claims', False):
+            raise ValueError('cannot save a user built from token claims; load it from the database first')
+        if kwargs.get('update_fields') is None and not self._state.adding:
+            # a full save of a stale instance must not write back the counters
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields if not f.primary_key and f.name not in self.COUNTER_FIELDS
+            ]
+        if getattr(self, '_loaded_is_active', None) and not self.is_active:
+            self._bump_token_version()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and getattr(self, '_token_version_changed', False):
+            kwargs['update_fields'] = {*update_fields, 'token_version'}
+        super().save(*args, **kwargs)
+        self._loaded_is_active = self.is_active
+        self._token_version_changed = False
+
 
 
 class UserActivityConstraints(BaseModel):
@@ -88,14 +138,557 @@ class UserActivityConstraints(BaseModel):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
 
 
+def _write_db(manager):
+    '''
+        Alias for a manager's raw write statements. manager.db is the read alias,
+        which the replica router may point at a read-only replica.
+    '''
+    return manager._db or router.db_for_write(manager.model, **manager._hints)
+
+
+def _fetch_row(using, sql, params):
+    '''
+        Run a single INSERT/UPDATE/DELETE ... RETURNING statement and return the
+        first returned row, or None.
+    '''
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchone()
+
+
+def _fetch_all(using, sql, params):
+    '''
+        Run a multi-row INSERT/UPDATE/DELETE ... RETURNING statement and return
+        every returned row.
+    '''
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def _fetch_first(using, sql, params):
+    row = _fetch_row(using, sql, params)
+    return row[0] if row else None
+
+
+def adjust_counters(using, changes):
+    '''
+        Apply {user_id: {counter: delta}} to the User counters in one UPDATE of
+        F() + CASE expressions, so concurrent adjustments add up instead of
+        overwriting each other. Clamped at zero, which only matters once a
+        counter has drifted.
+    '''
+    changes = {uid: deltas for uid, deltas in changes.items() if any(deltas.values())}
+    if not changes:
+        return
+    fields = sorted({field for deltas in changes.values() for field, delta in deltas.items() if delta})
+    User.objects.using(using).filter(id__in=changes).update(**{
+        field: Greatest(
+            F(field) + Case(
+                *[When(id=uid, then=Value(deltas[field])) for uid, deltas in changes.items() if deltas.get(field)],
+                default=Value(0),
+            ),
+            Value(0),
+        )
+        for field in fields
+    })
+
+
+def friendship_row_counter_changes(user_id, friend_id, delta):
+    '''
+        friend_count changes for one Friendship row: with FRIENDSHIP_SYMMETRIC
+        each side has its own row and counts only that one.
+    '''
+    if settings.FRIENDSHIP_SYMMETRIC:
+        return {user_id: {'friend_count': delta}}
+    return {user_id: {'friend_count': delta}, friend_id: {'friend_count': delta}}
+
+
+def counted_values(friendship_model=None, friend_request_model=None, symmetric=None):
+    '''
+        Annotations computing each User counter from the underlying rows, for
+        populating and reconciling the stored values.
+
+        The models default to Friendship and FriendRequest, and ``symmetric`` to
+        FRIENDSHIP_SYMMETRIC. symmetric=False counts right in either mode, as a
+        symmetric graph has no one-way rows, at the cost of an anti-join; the
+        migration adding the counters passes it with its historical models.
+    '''
+    friendship_model = friendship_model or Friendship
+    friend_request_model = friend_request_model or FriendRequest
+    if symmetric is None:
+        symmetric = settings.FRIENDSHIP_SYMMETRIC
+
+    def count_of(queryset, outer):
+        return Coalesce(Subquery(
+            queryset.filter(**{outer: OuterRef('pk')}).order_by().values(outer).annotate(n=Count('*')).values('n')
+        ), 0)
+
+    pending = friend_request_model.objects.filter(accepted=False)
+    friend_count = count_of(friendship_model.objects.all(), 'user')
+    if not symmetric:
+        # a pair stored in both directions, e.g. by backfill_friendship_edges, counts once
+        one_way = friendship_model.objects.filter(~Exists(
+            friendship_model.objects.filter(user=OuterRef('friend'), friend=OuterRef('user'))
+        ))
+        friend_count = friend_count + count_of(one_way, 'friend')
+    return {
+        'actual_friend_count': friend_count,
+        'actual_pending_in_count': count_of(pending, 'receiver'),
+        'actual_pending_out_count': count_of(pending, 'sender'),
+    }
+
+
+def recount_counters(users):
+    '''
+        Set the counters of the users in a queryset from the underlying rows in
+        one UPDATE, for writers that bypass the incremental adjustments (bulk
+        inserts of users, friendships and friend requests).
+    '''
+    values = counted_values()
+    return users.update(**{field: values[f'actual_{field}'] for field in User.COUNTER_FIELDS})
+
+
+# sent with the affected user ids, the action ("sent", "accepted", "rejected" or
+# "expired") and the (sender_id, receiver_id) pairs by the FriendRequestManager write
+# paths and bulk writes, whose raw or bulk statements bypass post_save/post_delete.
+# Archiving sends only the user ids: nothing changed that clients act on
+friend_requests_changed = Signal()
+
+
+class FriendRequestManager(models.Manager):
+
+    '''
+        Single-statement write paths for friend requests. Each method decides
+        with one round trip, so concurrent calls cannot interleave between a read
+        and a write, adjusts the User counters in the same transaction and sends
+        friend_requests_changed when it changed a row.
+    '''
+
+    def _tables(self):
+        quote = connections[_write_db(self)].ops.quote_name
+        return quote(self.model._meta.db_table), quote(User._meta.db_table)
+
+    def _now(self):
+        return connections[_write_db(self)].ops.adapt_datetimefield_value(timezone.now())
+
+    def send(self, sender_id, receiver_email):
+        '''
+            INSERT ... SELECT ... ON CONFLICT DO NOTHING. Returns the receiver id when
+            a new request was created, None when the receiver does not exist, the
+            request was already sent or the two are already friends (whose accepted
+            request may have been archived).
+        '''
+        table, user_table = self._tables()
+        using = _write_db(self)
+        friendship_table = connections[using].ops.quote_name(Friendship._meta.db_table)
+        now = self._now()
+        with transaction.atomic(using=using, savepoint=False):
+            receiver_id = _fetch_first(
+                using,
+                f'INSERT INTO {table} (sender_id, receiver_id, accepted, created_at, updated_at) '
+                f'SELECT %s, u.id, %s, %s, %s FROM {user_table} u WHERE u.email = %s '
+                f'AND NOT EXISTS (SELECT 1 FROM {friendship_table} f '
+                'WHERE (f.user_id = %s AND f.friend_id = u.id) OR (f.user_id = u.id AND f.friend_id = %s)) '
+                'ON CONFLICT (sender_id, receiver_id) DO NOTHING RETURNING receiver_id',
+                [sender_id, False, now, now, receiver_email, sender_id, sender_id],
+            )
+            if receiver_id is not None:
+                adjust_counters(using, {sender_id: {'pending_out_count': 1}, receiver_id: {'pending_in_count': 1}})
+        if receiver_id is not None:
+            friend_requests_changed.send(
+                sender=self.model, user_ids=[sender_id, receiver_id], action='sent',
+                pairs=[(sender_id, receiver_id)],
+            )
+        return receiver_id
+
+    def accept(self, receiver_id, sender_email):
+        '''
+            Conditional UPDATE marking the pending request from sender_email as
+            accepted. Returns the sender id, or None when there is no such request;
+            an already accepted request costs one more lookup and changes nothing.
+        '''
+        table, user_table = self._tables()
+        using = _write_db(self)
+        with transaction.atomic(using=using, savepoint=False):
+            sender_id = _fetch_first(
+                using,
+                f'UPDATE {table} SET accepted = %s, updated_at = %s '
+                f'WHERE receiver_id = %s AND sender_id = (SELECT id FROM {user_table} WHERE email = %s) '
+                'AND accepted = %s RETURNING sender_id',
+                [True, self._now(), receiver_id, sender_email, False],
+            )
+            if sender_id is None:
+                return self.filter(
+                    receiver_id=receiver_id, sender__email=sender_email, accepted=True
+                ).values_list('sender_id', flat=True).first()
+            adjust_counters(using, {sender_id: {'pending_out_count': -1}, receiver_id: {'pending_in_count': -1}})
+        friend_requests_changed.send(
+            sender=self.model, user_ids=[sender_id, receiver_id], action='accepted',
+            pairs=[(sender_id, receiver_id)],
+        )
+        return sender_id
+
+    def reject(self, receiver_id, sender_email):
+        '''
+            Conditional DELETE of the request from sender_email. Returns the sender
+            id, or None when there is no such request.
+        '''
+        table, user_table = self._tables()
+        using = _write_db(self)
+        with transaction.atomic(using=using, savepoint=False):
+            row = _fetch_row(
+                using,
+                f'DELETE FROM {table} '
+                f'WHERE receiver_id = %s AND sender_id = (SELECT id FROM {user_table} WHERE email = %s) '
+                'RETURNING sender_id, accepted',
+                [receiver_id, sender_email],
+            )
+            if row is None:
+                return None
+            sender_id, accepted = row
+            if not accepted:
+                adjust_counters(using, {sender_id: {'pending_out_count': -1}, receiver_id: {'pending_in_count': -1}})
+        friend_requests_changed.send(
+            sender=self.model, user_ids=[sender_id, receiver_id], action='rejected',
+            pairs=[(sender_id, receiver_id)],
+        )
+        return sender_id
+
+    def send_many(self, sender_id, receiver_ids):
+        '''
+            Bulk variant of send() for known receiver ids, in one INSERT ...
+            SELECT ... ON CONFLICT DO NOTHING. Returns the ids of the receivers
+            whose request was created; the counters and the signal cover only
+            those.
+        '''
+        receiver_ids = sorted(set(receiver_ids) - {sender_id})
+        if not receiver_ids:
+            return []
+        table, user_table = self._tables()
+        using = _write_db(self)
+        friendship_table = connections[using].ops.quote_name(Friendship._meta.db_table)
+        now = self._now()
+        with transaction.atomic(using=using, savepoint=False):
+            created = [row[0] for row in _fetch_all(
+                using,
+                f'INSERT INTO {table} (sender_id, receiver_id, accepted, created_at, updated_at) '
+                f'SELECT %s, u.id, %s, %s, %s FROM {user_table} u '
+                f'WHERE u.id IN ({", ".join(["%s"] * len(receiver_ids))}) '
+                f'AND NOT EXISTS (SELECT 1 FROM {friendship_table} f '
+                'WHERE (f.user_id = %s AND f.friend_id = u.id) OR (f.user_id = u.id AND f.friend_id = %s)) '
+                'ON CONFLICT (sender_id, receiver_id) DO NOTHING RETURNING receiver_id',
+                [sender_id, False, now, now, *receiver_ids, sender_id, sender_id],
+            )]
+            adjust_counters(using, {
+                sender_id: {'pending_out_count': len(created)},
+                **{receiver_id: {'pending_in_count': 1} for receiver_id in created},
+            })
+        if created:
+            friend_requests_changed.send(
+                sender=self.model, user_ids=[sender_id, *created], action='sent',
+                pairs=[(sender_id, receiver_id) for receiver_id in created],
+            )
+        return created
+
+    def accept_many(self, receiver_id, sender_ids):
+        '''
+            Bulk variant of accept() for known sender ids: one conditional UPDATE
+            ... RETURNING. Returns the ids of the senders whose pending request it
+            accepted; already accepted ones change nothing and are left out.
+        '''
+        sender_ids = sorted(set(sender_ids))
+        if not sender_ids:
+            return []
+        table, _ = self._tables()
+        using = _write_db(self)
+        with transaction.atomic(using=using, savepoint=False):
+            accepted = [row[0] for row in _fetch_all(
+                using,
+                f'UPDATE {table} SET accepted = %s, updated_at = %s '
+                f'WHERE receiver_id = %s AND sender_id IN ({", ".join(["%s"] * len(sender_ids))}) '
+                'AND accepted = %s RETURNING sender_id',
+                [True, self._now(), receiver_id, *sender_ids, False],
+            )]
+            adjust_counters(using, {
+                receiver_id: {'pending_in_count': -len(accepted)},
+                **{sender_id: {'pending_out_count': -1} for sender_id in accepted},
+            })
+        if accepted:
+            friend_requests_changed.send(
+                sender=self.model, user_ids=[receiver_id, *accepted], action='accepted',
+                pairs=[(sender_id, receiver_id) for sender_id in accepted],
+            )
+        return accepted
+
+    def reject_many(self, receiver_id, sender_ids):
+        '''
+            Bulk variant of reject() for known sender ids: one DELETE ...
+            RETURNING, without the per-row post_delete receivers of
+            QuerySet.delete(). Returns the ids of the senders whose request it
+            deleted.
+        '''
+        sender_ids = sorted(set(sender_ids))
+        if not sender_ids:
+            return []
+        table, _ = self._tables()
+        using = _write_db(self)
+        with transaction.atomic(using=using, savepoint=False):
+            rows = _fetch_all(
+                using,
+                f'DELETE FROM {table} '
+                f'WHERE receiver_id = %s AND sender_id IN ({", ".join(["%s"] * len(sender_ids))}) '
+                'RETURNING sender_id, accepted',
+                [receiver_id, *sender_ids],
+            )
+            pending = [sender_id for sender_id, accepted in rows if not accepted]
+            adjust_counters(using, {
+                receiver_id: {'pending_in_count': -len(pending)},
+                **{sender_id: {'pending_out_count': -1} for sender_id in pending},
+            })
+        rejected = [sender_id for sender_id, _ in rows]
+        if rejected:
+            friend_requests_changed.send(
+                sender=self.model, user_ids=[receiver_id, *rejected], action='rejected',
+                pairs=[(sender_id, receiver_id) for sender_id in rejected],
+            )
+        return rejected
+
+    async def asend(self, sender_id, receiver_email):
+        return await sync_to_async(self.send)(sender_id, receiver_email)
+
+    async def aaccept(self, receiver_id, sender_email):
+        return await sync_to_async(self.accept)(receiver_id, sender_email)
+
+    async def areject(self, receiver_id, sender_email):
+        return await sync_to_async(self.reject)(receiver_id, sender_email)
+
+    def _delete_ids(self, using, ids):
+        table, _ = self._tables()
+        with connections[using].cursor() as cursor:
+            cursor.execute(f'DELETE FROM {table} WHERE id IN ({", ".join(["%s"] * len(ids))})', ids)
+
+    def expire_pending(self, low, high, cutoff):
+        '''
+            Delete the requests with ids in [low, high) still pending since before
+            cutoff. The rows are locked while the counters are adjusted; returns
+            the (sender_id, receiver_id) pairs removed.
+        '''
+        using = _write_db(self)
+        with transaction.atomic(using=using):
+            rows = list(
+                self.using(using).select_for_update()
+                .filter(id__gte=low, id__lt=high, accepted=False, created_at__lt=cutoff)
+                .values_list('id', 'sender_id', 'receiver_id')
+            )
+            if not rows:
+                return []
+            self._delete_ids(using, [pk for pk, _, _ in rows])
+            changes = defaultdict(lambda: defaultdict(int))
+            for _, sender_id, receiver_id in rows:
+                changes[sender_id]['pending_out_count'] -= 1
+                changes[receiver_id]['pending_in_count'] -= 1
+            adjust_counters(using, changes)
+        pairs = [(sender_id, receiver_id) for _, sender_id, receiver_id in rows]
+        friend_requests_changed.send(
+            sender=self.model, user_ids=list({uid for pair in pairs for uid in pair}), action='expired',
+            pairs=pairs,
+        )
+        return pairs
+
+    def archive_accepted(self, low, high, cutoff):
+        '''
+            Move the requests with ids in [low, high) accepted before cutoff to
+            FriendRequestArchive, copying and deleting them in one transaction.
+            Returns the number of rows moved.
+        '''
+        using = _write_db(self)
+        with transaction.atomic(using=using):
+            rows = list(
+                self.using(using).select_for_update()
+                .filter(id__gte=low, id__lt=high, accepted=True, updated_at__lt=cutoff)
+                .values_list('id', 'sender_id', 'receiver_id', 'created_at', 'updated_at')
+            )
+            if not rows:
+                return 0
+            # ids are kept, so a batch retried after a failed delete is not copied twice
+            FriendRequestArchive.objects.using(using).bulk_create([
+                FriendRequestArchive(
+                    id=pk, sender_id=sender_id, receiver_id=receiver_id, created_at=created_at, accepted_at=accepted_at,
+                )
+                for pk, sender_id, receiver_id, created_at, accepted_at in rows
+            ], ignore_conflicts=True)
+            self._delete_ids(using, [row[0] for row in rows])
+        # the users' accepted requests leave list-requests/ and the export
+        friend_requests_changed.send(
+            sender=self.model, user_ids=list({uid for row in rows for uid in row[1:3]}),
+        )
+        return len(rows)
+
+    def pending_rows(self, receiver, after=None, before=None):
+        '''
+            (id, created_at, sender_email) rows of the receiver's unaccepted
+            requests, newest first, optionally restricted to rows older than
+            ``after`` or newer than ``before`` -- (created_at, id) keyset
+            positions. ``before`` pages are returned oldest first. Served by the
+            api_friendrequest_inbox index.
+        '''
+        rows = self.filter(receiver=receiver, accepted=False)
+        if after is not None:
+            created_at, pk = after
+            rows = rows.filter(models.Q(created_at__lt=created_at) | models.Q(created_at=created_at, id__lt=pk))
+        if before is not None:
+            created_at, pk = before
+            rows = rows.filter(models.Q(created_at__gt=created_at) | models.Q(created_at=created_at, id__gt=pk))
+        ordering = ('created_at', 'id') if before is not None else ('-created_at', '-id')
+        return rows.values_list('id', 'created_at', 'sender__email').order_by(*ordering)
+
+
 class FriendRequest(BaseModel):
 
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_requests')
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_requests')
     accepted = models.BooleanField(default=False)
 
+    objects = FriendRequestManager()
+
     class Meta:
         unique_together = ['sender', 'receiver']
+        indexes = [
+            # pending inbox: keyset scan newest first with sender_id read from the
+            # index. The accepted filter is the partial-index predicate rather than a
+            # key column, since "NOT accepted" is not an equality match on SQLite
+            # and would force a sort; backends without partial indexes get the
+            # full index.
+            models.Index(
+                fields=['receiver', '-created_at', '-id', 'sender'],
+                condition=models.Q(accepted=False),
+                name='api_friendrequest_inbox',
+            ),
+        ]
+
+
+class FriendRequestArchive(models.Model):
+
+    '''
+        Accepted friend requests moved out of FriendRequest by
+        `manage.py compact_friend_requests` once their Friendship exists, keeping
+        the live table and its indexes to pending requests and recent accepts.
+        ``id`` is the original FriendRequest id.
+    '''
+
+    id = models.BigIntegerField(primary_key=True)
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    created_at = models.DateTimeField()
+    accepted_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+
+# sent by FriendshipManager.befriend(), whose raw insert bypasses post_save
+friendship_created = Signal()
+
+
+class FriendshipManager(models.Manager):
+
+    def befriend(self, user_id, friend_id):
+        '''
+            Record a friendship with a single INSERT ... ON CONFLICT DO NOTHING.
+            With FRIENDSHIP_SYMMETRIC both directed edges are written in that
+            statement so reads only ever need the (user, friend) index; otherwise
+            the insert is skipped when the reverse edge already exists.
+            Returns False when the two were already friends.
+        '''
+        using = _write_db(self)
+        table = connections[using].ops.quote_name(self.model._meta.db_table)
+        if settings.FRIENDSHIP_SYMMETRIC:
+            sql = (
+                f'INSERT INTO {table} (user_id, friend_id) VALUES (%s, %s), (%s, %s) '
+                'ON CONFLICT (user_id, friend_id) DO NOTHING RETURNING id'
+            )
+            params = [user_id, friend_id, friend_id, user_id]
+        else:
+            sql = (
+                f'INSERT INTO {table} (user_id, friend_id) SELECT %s, %s '
+                f'WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE user_id = %s AND friend_id = %s) '
+                'ON CONFLICT (user_id, friend_id) DO NOTHING RETURNING id'
+            )
+            params = [user_id, friend_id, friend_id, user_id]
+
+        with transaction.atomic(using=using, savepoint=False):
+            if _fetch_first(using, sql, params) is None:
+                return False
+            adjust_counters(using, {user_id: {'friend_count': 1}, friend_id: {'friend_count': 1}})
+        friendship_created.send(sender=self.model, user_id=user_id, friend_id=friend_id)
+        return True
+
+    def befriend_many(self, user_id, friend_ids):
+        '''
+            Bulk variant of befriend(): one lookup for existing edges in either
+            direction and one bulk INSERT ... ON CONFLICT DO NOTHING. Returns the
+            ids that became friends of user_id.
+        '''
+        friend_ids = set(friend_ids) - {user_id}
+        existing = self.filter(
+            models.Q(user_id=user_id, friend_id__in=friend_ids) | models.Q(user_id__in=friend_ids, friend_id=user_id)
+        ).values_list('user_id', 'friend_id')
+        new_ids = friend_ids - {fid if uid == user_id else uid for uid, fid in existing}
+
+        edges = [self.model(user_id=user_id, friend_id=fid) for fid in sorted(new_ids)]
+        if settings.FRIENDSHIP_SYMMETRIC:
+            edges += [self.model(user_id=fid, friend_id=user_id) for fid in sorted(new_ids)]
+        using = _write_db(self)
+        with transaction.atomic(using=using, savepoint=False):
+            self.bulk_create(edges, ignore_conflicts=True)
+            adjust_counters(using, {user_id: {'friend_count': len(new_ids)}, **{fid: {'friend_count': 1} for fid in new_ids}})
+
+        for fid in sorted(new_ids):
+            friendship_created.send(sender=self.model, user_id=user_id, friend_id=fid)
+        return sorted(new_ids)
+
+    def are_friends(self, user, other):
+        if settings.FRIENDSHIP_SYMMETRIC:
+            return self.filter(user=user, friend=other).exists()
+        return self.filter(
+            models.Q(user=user, friend=other) | models.Q(user=other, friend=user)
+        ).exists()
+
+    def friend_ids(self, user_id):
+        outgoing = self.filter(user_id=user_id).values_list('friend_id', flat=True)
+        if settings.FRIENDSHIP_SYMMETRIC:
+            return set(outgoing)
+        return set(outgoing.union(self.filter(friend_id=user_id).values_list('user_id', flat=True)))
+
+    def friend_rows(self, user, after=None, before=None, limit=None):
+        '''
+            (friend_id, friend_email) rows for the user ordered by friend id,
+            optionally restricted to ids after/before a keyset position and to the
+            first ``limit`` rows. In symmetric mode this is one range scan on
+            (user, friend); otherwise a UNION over both directions, each branch
+            cut to its own first ``limit`` keys before the merge, so a page reads
+            at most 2 * limit rows whatever the number of friends.
+        '''
+        descending = before is not None
+
+        def branch(rows, key):
+            if after is not None:
+                rows = rows.filter(**{f'{key}__gt': after})
+            if before is not None:
+                rows = rows.filter(**{f'{key}__lt': before})
+            if limit is not None and not settings.FRIENDSHIP_SYMMETRIC:
+                # a LIMIT inside a compound SELECT is not portable, an IN subquery is
+                first = rows.order_by(f'-{key}' if descending else key).values(key)[:limit]
+                rows = rows.filter(**{f'{key}__in': first})
+            return rows
+
+        ordering = '-friend_id' if descending else 'friend_id'
+        outgoing = branch(self.filter(user=user), 'friend_id').values_list('friend_id', 'friend__email')
+        if settings.FRIENDSHIP_SYMMETRIC:
+            rows = outgoing.order_by(ordering)
+        else:
+            incoming = branch(self.filter(friend=user), 'user_id').values_list('user_id', 'user__email')
+            rows = outgoing.union(incoming).order_by(ordering)
+        return rows if limit is None else rows[:limit]
 
 
 class Friendship(models.Model):
@@ -103,5 +696,124 @@ class Friendship(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='friendships_as_user')
     friend = models.ForeignKey(User, on_delete=models.CASCADE, related_name='friendships_as_friend')
 
+    objects = FriendshipManager()
+
+    class Meta:
+        unique_together = ['user', 'friend']
+        indexes = [
+            # serves the reverse branch of friend_rows() ordered by user id
+            models.Index(fields=['friend', 'user'], name='api_friendship_friend_user'),
+        ]
+
+
+class FriendSuggestion(models.Model):
+    '''
+        Precomputed "people you may know" score: number of friends user and
+        candidate have in common. Maintained incrementally on new friendships
+        and rebuilt by the rebuild_friend_suggestions command.
+    '''
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='friend_suggestions')
+    candidate = models.ForeignKey(User, on_delete=models.CASCADE, related_name='suggested_to')
+    mutual_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ['user', 'candidate']
+        indexes = [
+            models.Index(fields=['user', '-mutual_count'], name='api_suggestion_user_rank'),
+        ]
+
+
+class JobManager(models.Manager):
+
+    def _table(self, using):
+        return connections[using].ops.quote_name(self.model._meta.db_table)
+
+    def enqueue(self, name, payload=None, key=None, delay=0, max_attempts=None):
+        '''
+            INSERT ... ON CONFLICT (idempotency_key) DO NOTHING. Returns the new
+            job's id, or None when a job with the same key already exists.
+        '''
+        using = _write_db(self)
+        ops = connections[using].ops
+        now = timezone.now()
+        return _fetch_first(
+            using,
+            f'INSERT INTO {self._table(using)} (name, payload, idempotency_key, status, attempts, max_attempts, '
+            'run_at, last_error, created_at, updated_at) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s) '
+            'ON CONFLICT (idempotency_key) DO NOTHING RETURNING id',
+            [
+                name, json.dumps(payload or {}), key, self.model.QUEUED, 0,
+                max_attempts or settings.JOBS['MAX_ATTEMPTS'],
+                ops.adapt_datetimefield_value(now + timedelta(seconds=delay)), '',
+                ops.adapt_datetimefield_value(now), ops.adapt_datetimefield_value(now),
+            ],
+        )
+
+    def claim(self, batch_size, lease):
+        '''
+            Mark up to batch_size due jobs as running for lease seconds in one
+            UPDATE and return them. Concurrent workers skip each other's rows with
+            FOR UPDATE SKIP LOCKED where the backend has it (PostgreSQL); on SQLite
+            the statement holds the database write lock, which serialises claims.
+            A running job whose lease expired (its worker died) is due again.
+        '''
+        using = _write_db(self)
+        connection = connections[using]
+        table = self._table(using)
+        now = timezone.now()
+        skip_locked = ' FOR UPDATE SKIP LOCKED' if connection.features.has_select_for_update_skip_locked else ''
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {table} SET status = %s, attempts = attempts + 1, run_at = %s, updated_at = %s '
+                f'WHERE id IN (SELECT id FROM {table} WHERE status IN (%s, %s) AND run_at <= %s '
+                f'ORDER BY run_at LIMIT %s{skip_locked}) RETURNING id',
+                [
+                    self.model.RUNNING,
+                    connection.ops.adapt_datetimefield_value(now + timedelta(seconds=lease)),
+                    connection.ops.adapt_datetimefield_value(now),
+                    self.model.QUEUED, self.model.RUNNING,
+                    connection.ops.adapt_datetimefield_value(now),
+                    batch_size,
+                ],
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            return []
+        return list(self.using(using).filter(id__in=ids).order_by('run_at', 'id'))
+
+
+class Job(BaseModel):
+
+    '''
+        A unit of background work, run by `manage.py run_jobs` through the handler
+        registered under ``name`` in api.jobs. ``run_at`` is when a queued job is
+        due and, while it is running, when its worker's lease expires.
+    '''
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    # at most one job per key, until the finished job is purged
+    idempotency_key = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    run_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+
+    objects = JobManager()
+
     class Meta:
-        unique_together = ['user', 'friend']
\ No newline at end of file
+        indexes = [
+            # the claim scan: due jobs in run_at order, without finished ones
+            models.Index(
+                fields=['run_at'],
+                condition=models.Q(status__in=['queued', 'running']),
+                name='api_job_due',
+            ),
+        ]
@@ -0,0 +1,177 @@
+from collections import OrderedDict
+from datetime import datetime
+
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator as DjangoPaginator
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination, PageNumberPagination
+from rest_framework.response import Response
+
+
+class KeysetPagination(CursorPagination):
+
+    '''
+        Cursor pagination over an integer keyset for queries DRF's
+        CursorPagination cannot filter itself (e.g. UNION querysets).
+
+        The view passes a ``fetch(after, before, limit)`` callable returning rows
+        whose first element is the key; only ``page_size + 1`` rows are ever read,
+        so deep pages cost the same as the first one. Cursors are the same opaque
+        base64 tokens CursorPagination emits. Subclasses with a composite key
+        override ``row_position``/``parse_position``.
+    '''
+
+    page_size = 10
+
+    def paginate_rows(self, fetch, request):
+        reverse, position = self._start(request)
+        if reverse:
+            rows = list(fetch(None, position, self.page_size + 1))
+        else:
+            rows = list(fetch(position, None, self.page_size + 1))
+        return self._page(rows, reverse, position)
+
+    async def apaginate_rows(self, fetch, request):
+        '''
+            paginate_rows() for async views; ``fetch`` returns a queryset that is
+            iterated with the async ORM.
+        '''
+        reverse, position = self._start(request)
+        if reverse:
+            rows = [row async for row in fetch(None, position, self.page_size + 1)]
+        else:
+            rows = [row async for row in fetch(position, None, self.page_size + 1)]
+        return self._page(rows, reverse, position)
+
+    def _start(self, request):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+
+        cursor = self.decode_cursor(request)
+        reverse = bool(cursor and cursor.reverse)
+        self.page_size = self.get_page_size(request)
+        position = None
+        if cursor is not None and cursor.position is not None:
+            try:
+                position = self.parse_position(cursor.position)
+            except ValueError:
+                raise NotFound(self.invalid_cursor_message)
+        return reverse, position
+
+    def _page(self, rows, reverse, position):
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+            self.has_next, self.has_previous = position is not None, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+
+        self.first_key = self.row_position(rows[0]) if rows else None
+        self.last_key = self.row_position(rows[-1]) if rows else None
+        return rows
+
+    def row_position(self, row):
+        return str(row[0])
+
+    def parse_position(self, position):
+        return int(position)
+
+    def get_next_link(self):
+        if not self.has_next or self.last_key is None:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=self.last_key))
+
+    def get_previous_link(self):
+        if not self.has_previous or self.first_key is None:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=self.first_key))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+
+class PendingRequestPagination(KeysetPagination):
+
+    '''
+        Newest-first keyset over (created_at, id) rows as returned by
+        FriendRequestManager.pending_rows(). The response also carries the
+        total number of pending requests.
+    '''
+
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    def row_position(self, row):
+        return f'{row[1].isoformat()}|{row[0]}'
+
+    def parse_position(self, position):
+        created_at, _, pk = position.rpartition('|')
+        return datetime.fromisoformat(created_at), int(pk)
+
+    def get_paginated_response(self, data, count):
+        return Response(OrderedDict([
+            ('count', count),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
+
+
+class CountedPaginator(DjangoPaginator):
+
+    '''
+        Django Paginator starting from a stored total. Pages are sliced with one
+        extra row instead of ending where the total says, and a page that
+        contradicts the total (short before it, or with rows past it) replaces
+        it with a COUNT(*), so a drifted total never hides or invents rows.
+    '''
+
+    def __init__(self, object_list, per_page, count):
+        super().__init__(object_list, per_page)
+        self.count = count
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        consistent = self.count > bottom + self.per_page if more else self.count == bottom + len(rows)
+        if not consistent:
+            self.count = self.object_list.count()
+        if not rows and number > 1:
+            raise EmptyPage('That page contains no results')
+        return self._get_page(rows, number, self)
+
+    def validate_number(self, number):
+        # pages past the stored total are tried, page() decides if they exist
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        return number
+
+
+class CountedPagination(PageNumberPagination):
+
+    '''
+        Page-number pagination whose total comes from the caller, e.g. a
+        denormalized counter, instead of a COUNT(*) over the queryset. See
+        CountedPaginator for what happens when the total has drifted.
+    '''
+
+    page_size = 10
+
+    def paginate_counted(self, queryset, count, request, view=None):
+        self.count = count
+        return self.paginate_queryset(queryset, request, view)
+
+    def django_paginator_class(self, object_list, per_page):
+        return CountedPaginator(object_list, per_page, self.count)
@@ -0,0 +1,156 @@
+import re
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+
+from api.models import User
+
+
+_WORD_RE = re.compile(r'[^\W_]+')
+
+
+def trigrams(text):
+    '''
+        Split text into the same trigram set pg_trgm builds: lowercased words,
+        padded with two leading spaces and one trailing space.
+    '''
+    grams = set()
+    for word in _WORD_RE.findall((text or '').lower()):
+        padded = f'  {word} '
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+
+class PostgresTrigramSearch:
+
+    '''
+        Ranked name search served by the pg_trgm GIN index on api_user.name.
+
+        The index only answers the % operator, which compares against the
+        pg_trgm.similarity_threshold setting rather than a query parameter, so
+        each search sets it to USER_SEARCH['SIMILARITY_THRESHOLD'] for its own
+        transaction.
+    '''
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+    def search(self, keyword, limit):
+        from django.contrib.postgres.search import TrigramSimilarity
+
+        queryset = (
+            User.objects.filter(name__trigram_similar=keyword, is_active=True)
+            .annotate(similarity=TrigramSimilarity('name', keyword))
+            .order_by('-similarity', 'id')
+            .values_list('email', flat=True)[:limit]
+        )
+        with transaction.atomic(using=queryset.db), connections[queryset.db].cursor() as cursor:
+            cursor.execute("SELECT set_config('pg_trgm.similarity_threshold', %s, true)", [str(self.threshold)])
+            return list(queryset)
+
+
+class InMemoryTrigramIndex:
+
+    '''
+        Inverted trigram index over the names of active users, used when the
+        database has no trigram support (SQLite test runs). Built lazily on first
+        search and kept current by the User post_save/post_delete signals.
+    '''
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._postings = defaultdict(set)
+        self._docs = {}
+        self._built = False
+
+    def _build(self):
+        for pk, name, email in User.objects.filter(is_active=True).values_list('id', 'name', 'email').iterator():
+            self._add(pk, name, email)
+        self._built = True
+
+    def _add(self, pk, name, email):
+        grams = trigrams(name)
+        self._docs[pk] = (grams, email)
+        for gram in grams:
+            self._postings[gram].add(pk)
+
+    def _remove(self, pk):
+        doc = self._docs.pop(pk, None)
+        if doc is None:
+            return
+        for gram in doc[0]:
+            postings = self._postings.get(gram)
+            if postings is not None:
+                postings.discard(pk)
+                if not postings:
+                    del self._postings[gram]
+
+    def update(self, user):
+        with self._lock:
+            if not self._built:
+                return
+            self._remove(user.pk)
+            if user.is_active:
+                self._add(user.pk, user.name, user.email)
+
+    def remove(self, pk):
+        with self._lock:
+            if self._built:
+                self._remove(pk)
+
+    def reset(self):
+        with self._lock:
+            self._postings.clear()
+            self._docs.clear()
+            self._built = False
+
+    def search(self, keyword, limit):
+        query = trigrams(keyword)
+        if not query:
+            return []
+
+        with self._lock:
+            if not self._built:
+                self._build()
+
+            hits = defaultdict(int)
+            for gram in query:
+                for pk in self._postings.get(gram, ()):
+                    hits[pk] += 1
+
+            ranked = []
+            for pk, shared in hits.items():
+                grams, email = self._docs[pk]
+                similarity = shared / (len(query) + len(grams) - shared)
+                if similarity >= self.threshold:
+                    ranked.append((-similarity, pk, email))
+
+        ranked.sort()
+        return [email for _, _, email in ranked[:limit]]
+
+
+memory_index = InMemoryTrigramIndex(settings.USER_SEARCH['SIMILARITY_THRESHOLD'])
+postgres_search = PostgresTrigramSearch(settings.USER_SEARCH['SIMILARITY_THRESHOLD'])
+
+
+def get_search_backend():
+
+    '''
+        Pick the search backend from USER_SEARCH['BACKEND']; "auto" uses pg_trgm
+        on Postgres and the in-process index everywhere else.
+    '''
+
+    backend = settings.USER_SEARCH['BACKEND']
+    if backend == 'auto':
+        backend = 'postgres' if connection.vendor == 'postgresql' else 'memory'
+    if backend == 'postgres':
+        return postgres_search
+    return memory_index
+
+
+def search_users(keyword):
+    return get_search_backend().search(keyword, settings.USER_SEARCH['MAX_RESULTS'])
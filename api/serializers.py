@@ -14,6 +14,16 @@ class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
 
     username_field = 'email'
 
+    @classmethod
+    def get_token(cls, user):
+        # claims read by utils.authentication.StatelessJWTAuthentication
+        token = super().get_token(user)
+        token['email'] = user.email
+        token['is_active'] = user.is_active
+        token['is_staff'] = user.is_staff
+        token['ver'] = user.token_version
+        return token
+
     def validate(self, attrs):
         
         email= attrs.get('email')
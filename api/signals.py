@@ -0,0 +1,164 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from api.models import (
+    User, FriendRequest, Friendship, UserActivityConstraints, adjust_counters, friend_requests_changed,
+    friendship_created, friendship_row_counter_changes,
+)
+from api import search
+from api.events import publish_friend_request_events
+from api.autocomplete import prefix_index
+from api.email_filter import email_filter, publish_emails
+from api.adjacency import adjacency_index
+from utils.permissions import override_cache_key
+from utils.authentication import token_state_cache_key
+from utils.response_cache import USERS_VERSION, bump_versions
+
+
+@receiver(post_save, sender=User)
+def index_user(sender, instance, **kwargs):
+    search.memory_index.update(instance)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def drop_token_state(sender, instance, **kwargs):
+    key = token_state_cache_key(instance.pk)
+    caches[settings.TOKEN_STATE_CACHE].delete(key)
+    # again on commit, so a request that cached the old row in between does
+    # not keep it for TOKEN_STATE_CACHE_TTL
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: caches[settings.TOKEN_STATE_CACHE].delete(key))
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def bump_users_version(sender, instance, update_fields=None, **kwargs):
+    # last_login/password/token_version saves do not change search results
+    if update_fields is None or {'email', 'name', 'is_active'} & set(update_fields):
+        bump_versions(USERS_VERSION)
+
+
+@receiver(post_delete, sender=User)
+def unindex_user(sender, instance, **kwargs):
+    search.memory_index.remove(instance.pk)
+
+
+@receiver(post_save, sender=User)
+def index_user_prefixes(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'email', 'name', 'is_active'} & set(update_fields):
+        prefix_index.update(instance)
+
+
+@receiver(post_delete, sender=User)
+def unindex_user_prefixes(sender, instance, **kwargs):
+    prefix_index.remove(instance.pk)
+
+
+@receiver(post_save, sender=User)
+def add_to_email_filter(sender, instance, created, update_fields=None, **kwargs):
+    if created or update_fields is None or 'email' in update_fields:
+        email = instance.email
+        email_filter.add(email)
+        # other processes' filters catch up once the row is visible to them
+        transaction.on_commit(lambda: publish_emails([email]))
+
+
+@receiver(friendship_created)
+def index_friendship(sender, user_id, friend_id, **kwargs):
+    adjacency_index.add_edge(user_id, friend_id)
+
+
+@receiver(post_save, sender=Friendship)
+def index_saved_friendship(sender, instance, created, **kwargs):
+    if created:
+        adjacency_index.add_edge(instance.user_id, instance.friend_id)
+
+
+@receiver(post_delete, sender=Friendship)
+def unindex_friendship(sender, instance, **kwargs):
+    adjacency_index.remove_edge(instance.user_id, instance.friend_id)
+
+
+@receiver(post_save, sender=UserActivityConstraints)
+@receiver(post_delete, sender=UserActivityConstraints)
+def drop_request_limit_override(sender, instance, **kwargs):
+    caches[settings.RATE_LIMIT_CACHE].delete(override_cache_key(instance.user_id))
+
+
+@receiver(friendship_created)
+def bump_friendship_versions(sender, user_id, friend_id, **kwargs):
+    bump_versions(user_id, friend_id)
+
+
+@receiver(post_save, sender=Friendship)
+@receiver(post_delete, sender=Friendship)
+def bump_saved_friendship_versions(sender, instance, **kwargs):
+    bump_versions(instance.user_id, instance.friend_id)
+
+
+@receiver(friend_requests_changed)
+def bump_friend_request_versions(sender, user_ids, **kwargs):
+    bump_versions(*user_ids)
+
+
+@receiver(friend_requests_changed)
+def notify_friend_request_change(sender, action=None, pairs=(), **kwargs):
+    # after commit, so a client refetching on the event sees the change
+    if action is not None:
+        transaction.on_commit(lambda: publish_friend_request_events(action, pairs))
+
+
+@receiver(post_save, sender=FriendRequest)
+@receiver(post_delete, sender=FriendRequest)
+def bump_saved_friend_request_versions(sender, instance, **kwargs):
+    bump_versions(instance.sender_id, instance.receiver_id)
+
+
+@receiver(post_save, sender=FriendRequest)
+def notify_saved_friend_request(sender, instance, created, **kwargs):
+    # requests created through the ORM; the manager's raw writes send friend_requests_changed
+    if created:
+        pairs = [(instance.sender_id, instance.receiver_id)]
+        transaction.on_commit(lambda: publish_friend_request_events('sent', pairs))
+
+
+@receiver(post_delete, sender=FriendRequest)
+def notify_deleted_friend_request(sender, instance, **kwargs):
+    if not instance.accepted:
+        pairs = [(instance.sender_id, instance.receiver_id)]
+        transaction.on_commit(lambda: publish_friend_request_events('rejected', pairs))
+
+
+# counters for rows written through the ORM (admin, fixtures, cascading deletes);
+# the manager write paths and bulk views adjust them themselves
+
+
+@receiver(post_save, sender=FriendRequest)
+def count_created_friend_request(sender, instance, created, using, **kwargs):
+    if created and not instance.accepted:
+        adjust_counters(using, {
+            instance.sender_id: {'pending_out_count': 1}, instance.receiver_id: {'pending_in_count': 1},
+        })
+
+
+@receiver(post_delete, sender=FriendRequest)
+def count_deleted_friend_request(sender, instance, using, **kwargs):
+    if not instance.accepted:
+        adjust_counters(using, {
+            instance.sender_id: {'pending_out_count': -1}, instance.receiver_id: {'pending_in_count': -1},
+        })
+
+
+@receiver(post_save, sender=Friendship)
+def count_created_friendship(sender, instance, created, using, **kwargs):
+    if created:
+        adjust_counters(using, friendship_row_counter_changes(instance.user_id, instance.friend_id, 1))
+
+
+@receiver(post_delete, sender=Friendship)
+def count_deleted_friendship(sender, instance, using, **kwargs):
+    adjust_counters(using, friendship_row_counter_changes(instance.user_id, instance.friend_id, -1))
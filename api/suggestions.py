@@ -0,0 +1,93 @@
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from api.models import FriendRequest, Friendship, FriendSuggestion
+
+
+def _friend_sets(user_ids):
+    sets = {uid: set() for uid in user_ids}
+    for uid, fid in Friendship.objects.filter(user_id__in=user_ids).values_list('user_id', 'friend_id'):
+        sets[uid].add(fid)
+    if not settings.FRIENDSHIP_SYMMETRIC:
+        for fid, uid in Friendship.objects.filter(friend_id__in=user_ids).values_list('friend_id', 'user_id'):
+            sets[fid].add(uid)
+    return sets
+
+
+def on_friendship_created(user_id, friend_id):
+    '''
+        Update only the neighbourhoods touched by a new user <-> friend edge:
+        every existing friend of one side gains the other side as a mutual-friend
+        suggestion (and vice versa), and the pair stops suggesting each other.
+
+        Runs as the "friendship_created" job, possibly after later edges were
+        added, so the affected pairs' counts are recomputed from the current
+        graph and upserted rather than incremented. Only the first
+        FRIEND_SUGGESTIONS['MAX_STORED'] candidates of each side are recomputed,
+        which bounds the friend sets loaded for a user with many friends; the
+        rest are left to rebuild_friend_suggestions.
+    '''
+    sets = _friend_sets([user_id, friend_id])
+    user_friends = sets[user_id] - {friend_id}
+    friend_friends = sets[friend_id] - {user_id}
+    max_stored = settings.FRIEND_SUGGESTIONS['MAX_STORED']
+
+    # friend_id now shares user_id with each of user_friends it is not friends with yet
+    pairs = [(friend_id, c) for c in sorted(user_friends - friend_friends - {friend_id})[:max_stored]]
+    pairs += [(user_id, c) for c in sorted(friend_friends - user_friends - {user_id})[:max_stored]]
+    candidate_sets = _friend_sets({c for _, c in pairs})
+
+    suggestions = []
+    for a, c in pairs:
+        mutual_count = len(sets[a] & candidate_sets[c])
+        suggestions += [
+            FriendSuggestion(user_id=a, candidate_id=c, mutual_count=mutual_count),
+            FriendSuggestion(user_id=c, candidate_id=a, mutual_count=mutual_count),
+        ]
+
+    with transaction.atomic(savepoint=False):
+        FriendSuggestion.objects.filter(
+            Q(user_id=user_id, candidate_id=friend_id) | Q(user_id=friend_id, candidate_id=user_id)
+        ).delete()
+        FriendSuggestion.objects.bulk_create(
+            suggestions, update_conflicts=True, unique_fields=['user', 'candidate'], update_fields=['mutual_count'],
+        )
+
+
+def compute_suggestions(user_id, friend_ids=None):
+    '''
+        Full friends-of-friends count for one user, keeping the top
+        FRIEND_SUGGESTIONS['MAX_STORED'] candidates. ``friend_ids`` lets the
+        rebuild command pass a cached adjacency lookup.
+    '''
+    friend_ids = friend_ids or Friendship.objects.friend_ids
+    friends = friend_ids(user_id)
+    counts = Counter()
+    for fid in friends:
+        counts.update(friend_ids(fid))
+    for excluded in friends | {user_id}:
+        counts.pop(excluded, None)
+    return counts.most_common(settings.FRIEND_SUGGESTIONS['MAX_STORED'])
+
+
+def store_suggestions(user_id, scored):
+    with transaction.atomic():
+        FriendSuggestion.objects.filter(user_id=user_id).delete()
+        FriendSuggestion.objects.bulk_create([
+            FriendSuggestion(user_id=user_id, candidate_id=cid, mutual_count=count)
+            for cid, count in scored
+        ])
+
+
+def suggestions_for(user, limit):
+    pending = FriendRequest.objects.filter(accepted=False)
+    return (
+        FriendSuggestion.objects.filter(user=user, mutual_count__gt=0)
+        .exclude(candidate_id__in=pending.filter(sender=user).values('receiver_id'))
+        .exclude(candidate_id__in=pending.filter(receiver=user).values('sender_id'))
+        .order_by('-mutual_count', 'candidate_id')
+        .values_list('candidate__email', 'mutual_count')[:limit]
+    )
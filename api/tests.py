@@ -1,3 +1,1381 @@
-from django.test import TestCase
+import importlib
+import json
+import os
+import shlex
+import sys
+import tempfile
+import threading
+from collections import Counter
+from datetime import timedelta
+from io import StringIO
+from unittest import skipUnless
 
-# Create your tests here.
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connections, transaction
+from django.utils import timezone
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import clear_url_caches, resolve
+from rest_framework.test import APIClient, APITestCase
+from rest_framework_simplejwt.exceptions import AuthenticationFailed
+
+from api.models import (
+    User, FriendRequest, FriendRequestArchive, Friendship, FriendSuggestion, Job, UserActivityConstraints,
+    friend_requests_changed,
+)
+import api.urls
+import social_media_main.urls
+from api import jobs
+from api.adjacency import adjacency_index
+from api.async_views import AsyncListAllFriends, AsyncSearchUserView
+from api.autocomplete import PrefixIndex, prefix_index
+from api.email_filter import EmailFilter, current_sequence, email_filter, publish_emails
+from api.export import export_graph
+from api.search import PostgresTrigramSearch, memory_index, postgres_search
+from api.serializers import CustomTokenObtainPairSerializer
+from utils.authentication import StatelessJWTAuthentication, token_state_cache_key
+from utils.db_router import ReplicaRouter, mark_sticky, routing_request
+from utils import metrics
+from utils.permissions import request_limit_override
+from utils.profiling import StackStore, collapse, stack_store
+from utils.pubsub import RESET, InProcessHub
+from utils.response_cache import get_versions
+from utils.testing import QueryBudgetMixin
+
+
+class FriendRequestWriteQueryCountTests(APITestCase):
+
+    '''
+        Pin the number of queries the friend-request write endpoints issue, so a
+        regression shows up here rather than in production latency.
+    '''
+
+    def setUp(self):
+        cache.clear()
+        self.me = User.objects.create_user('me@example.com', 'password', name='Me')
+        self.other = User.objects.create_user('other@example.com', 'password', name='Other')
+        self.client.force_authenticate(self.me)
+        # warm the cached per-user rate limit override and the email filter
+        request_limit_override(self.me.pk)
+        email_filter.reset()
+        email_filter.sync()
+
+    def test_send_request(self):
+        # INSERT ... ON CONFLICT + the counter UPDATE
+        with self.assertNumQueries(2):
+            response = self.client.post('/api/send-request/', {'to_email': self.other.email}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(FriendRequest.objects.filter(sender=self.me, receiver=self.other).exists())
+
+    def test_send_request_already_sent(self):
+        FriendRequest.objects.create(sender=self.me, receiver=self.other)
+        with self.assertNumQueries(2):
+            response = self.client.post('/api/send-request/', {'to_email': self.other.email}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_send_request_unknown_user(self):
+        with self.assertNumQueries(0):
+            response = self.client.post('/api/send-request/', {'to_email': 'nobody@example.com'}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_send_request_invalid_email(self):
+        for to_email in [123, ['other@example.com'], 'not an email']:
+            response = self.client.post('/api/send-request/', {'to_email': to_email}, format='json')
+            self.assertEqual(response.status_code, 400)
+
+    def test_reject_request(self):
+        FriendRequest.objects.create(sender=self.other, receiver=self.me)
+        # savepoint + DELETE ... RETURNING + the counter UPDATE + release
+        with self.assertNumQueries(4):
+            response = self.client.post('/api/manage-requests/', {'sender': self.other.email, 'accept': False}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(FriendRequest.objects.exists())
+
+    def test_reject_unknown_request(self):
+        with self.assertNumQueries(3):
+            response = self.client.post('/api/manage-requests/', {'sender': self.other.email, 'accept': False}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_accept_request(self):
+        FriendRequest.objects.create(sender=self.other, receiver=self.me)
+        # savepoint + UPDATE ... RETURNING + INSERT ... ON CONFLICT, each with its
+        # counter UPDATE, + the suggestion job's INSERT + release
+        with self.assertNumQueries(7):
+            response = self.client.post('/api/manage-requests/', {'sender': self.other.email, 'accept': True}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(FriendRequest.objects.get(sender=self.other).accepted)
+        self.assertTrue(Friendship.objects.are_friends(self.me, self.other))
+
+    def test_accept_twice_does_not_duplicate_friendship(self):
+        FriendRequest.objects.create(sender=self.other, receiver=self.me)
+        self.client.post('/api/manage-requests/', {'sender': self.other.email, 'accept': True}, format='json')
+        with self.assertNumQueries(5):
+            response = self.client.post('/api/manage-requests/', {'sender': self.other.email, 'accept': True}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Friendship.objects.count(), 1)
+
+
+# TestCase data is never committed, so a replica connection could not see it
+@override_settings(DATABASE_REPLICAS={'ALIASES': [], 'STICKY_SECONDS': 5, 'CACHE': 'default'})
+class QueryBudgetTests(QueryBudgetMixin, APITestCase):
+
+    '''
+        Every api endpoint stays within the query_budget its view declares.
+    '''
+
+    def setUp(self):
+        cache.clear()
+        email_filter.reset()
+        email_filter.sync()
+        self.me = User.objects.create_user('me@example.com', 'password', name='Me Example')
+        self.other = User.objects.create_user('other@example.com', 'password', name='Other Example')
+        self.friend = User.objects.create_user('friend@example.com', 'password', name='Friend Example')
+        Friendship.objects.befriend(self.me.id, self.friend.id)
+        Friendship.objects.befriend(self.other.id, self.friend.id)
+        FriendRequest.objects.create(sender=self.other, receiver=self.me)
+        # pick up the counters the writes above kept in the database
+        self.me.refresh_from_db()
+        self.client.force_authenticate(self.me)
+
+    def test_search_by_name(self):
+        response = self.assertWithinQueryBudget('get', '/api/search-user/?keyword=example')
+        self.assertEqual(response.status_code, 200)
+
+    def test_search_by_email(self):
+        response = self.assertWithinQueryBudget('get', '/api/search-user/?keyword=other@example.com')
+        self.assertEqual(response.data['results'], ['other@example.com'])
+
+    def test_list_pending(self):
+        response = self.assertWithinQueryBudget('get', '/api/list-requests/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_list_friends(self):
+        response = self.assertWithinQueryBudget('get', '/api/lists-friends/')
+        self.assertEqual(response.data['results']['lists'], ['friend@example.com'])
+
+    def test_list_friends_cursor(self):
+        response = self.assertWithinQueryBudget('get', '/api/lists-friends/?mode=cursor')
+        self.assertEqual(response.data['results']['lists'], ['friend@example.com'])
+
+    def test_suggestions(self):
+        response = self.assertWithinQueryBudget('get', '/api/suggestions/')
+        self.assertEqual(response.status_code, 200)
+
+    def test_mutual_friends(self):
+        adjacency_index.reset()
+        response = self.assertWithinQueryBudget('post', '/api/mutual-friends/', {'users': [self.other.email], 'sample': 1})
+        self.assertEqual(response.data['results'][self.other.email]['count'], 1)
+
+        newcomer = User.objects.create_user('newcomer@example.com', 'password', name='Newcomer')
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                Friendship.objects.befriend(self.me.id, newcomer.id)
+                Friendship.objects.befriend(self.other.id, newcomer.id)
+                raise IntegrityError('rolled back')
+        self.assertEqual(adjacency_index.mutual_friends(self.me.id, [self.other.id]), {self.other.id: [self.friend.id]})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Friendship.objects.befriend(self.me.id, newcomer.id)
+            Friendship.objects.befriend(self.other.id, newcomer.id)
+        self.assertEqual(
+            adjacency_index.mutual_friends(self.me.id, [self.other.id]), {self.other.id: [self.friend.id, newcomer.id]}
+        )
+
+    def test_send_request(self):
+        response = self.assertWithinQueryBudget('post', '/api/send-request/', {'to_email': self.friend.email})
+        self.assertEqual(response.status_code, 200)
+
+    def test_bulk_send_request(self):
+        response = self.assertWithinQueryBudget('post', '/api/send-request/bulk/', {'to_emails': [self.friend.email, self.other.email]})
+        self.assertEqual(response.status_code, 200)
+
+    def test_manage_request(self):
+        response = self.assertWithinQueryBudget('post', '/api/manage-requests/', {'sender': self.other.email, 'accept': True})
+        self.assertEqual(response.status_code, 200)
+
+    def test_bulk_manage_request(self):
+        senders = [User.objects.create_user(f'sender{i}@example.com', 'password', name='Sender') for i in range(20)]
+        FriendRequest.objects.bulk_create([FriendRequest(sender=sender, receiver=self.me) for sender in senders])
+        decisions = [{'sender': sender.email, 'accept': i % 4 == 0} for i, sender in enumerate(senders)]
+        response = self.assertWithinQueryBudget('post', '/api/manage-requests/bulk/', {'decisions': decisions})
+        self.assertEqual(list(response.data['results'].values()).count('rejected'), 15)
+
+    def test_export(self):
+        response = self.assertWithinQueryBudget('get', '/api/export/')
+        lines = [json.loads(line) for line in b''.join(response).splitlines()]
+        self.assertEqual(lines[0], {'type': 'user', 'id': self.me.id, 'email': 'me@example.com'})
+        self.assertEqual(
+            [(line['type'], line['email']) for line in lines[1:]],
+            [('friend', 'friend@example.com'), ('received_request', 'other@example.com')]
+        )
+
+    def test_autocomplete(self):
+        prefix_index.reset()
+        prefix_index.load()
+        response = self.assertWithinQueryBudget('get', '/api/autocomplete/?q=Ex')
+        self.assertEqual(len(response.data['results']), 3)
+
+        self.other.name = 'Ölga Smith'
+        self.other.save(update_fields=['name'])
+        response = self.client.get('/api/autocomplete/?q=olg')
+        self.assertEqual(response.data['results'], [{'id': self.other.id, 'name': 'Ölga Smith', 'email': 'other@example.com'}])
+        self.assertEqual(self.client.get('/api/autocomplete/?q=other e').data['results'], [])
+
+    def test_autocomplete_ranking(self):
+        prefix_index.reset()
+        prefix_index.load()
+        for i in range(5):
+            User.objects.create_user(f'user{i}@example.com', 'password', name=f'Abacus{i}')
+        short = User.objects.create_user('short@example.com', 'password', name='Abz')
+        User.objects.create_user('gone@example.com', 'password', name='Ab', is_active=False)
+        # the shortest match comes first although four longer terms sort before it
+        results = self.client.get('/api/autocomplete/?q=ab&limit=2').data['results']
+        self.assertEqual([result['id'] for result in results][:1], [short.id])
+
+        short.is_active = False
+        short.save(update_fields=['is_active'])
+        results = self.client.get('/api/autocomplete/?q=ab&limit=10').data['results']
+        self.assertEqual(len(results), 5)
+
+    def test_autocomplete_from_database(self):
+        # the query answering until the index is built matches accented names
+        self.other.name = 'Émile Zola'
+        self.other.save(update_fields=['name'])
+        index = PrefixIndex(3600, 1000, 32)
+        self.assertEqual(index._complete_from_database('Émi', 10), [(self.other.id, 'Émile Zola', 'other@example.com')])
+        self.assertEqual(index._complete_from_database('emile', 10), [])
+        index = PrefixIndex(3600, 1, 32)
+        index.load()
+        self.assertEqual(index.complete('Émi', 10, 50), ([(self.other.id, 'Émile Zola', 'other@example.com')], False))
+
+    def test_unknown_email(self):
+        # the default process-local caches answer a miss without a query too
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/search-user/?keyword=nobody@example.com')
+        self.assertEqual(response.data['results'], [])
+
+        User.objects.create_user('nobody@example.com', 'password', name='Nobody')
+        self.assertTrue(email_filter.might_exist('NOBODY@example.com'))
+        response = self.client.get('/api/search-user/?keyword=nobody@example.com')
+        self.assertEqual(response.data['results'], ['nobody@example.com'])
+
+        # bulk inserts bypass post_save and publish the new emails themselves
+        User.objects.bulk_create([User(email='bulk@example.com', name='Bulk')])
+        publish_emails(['bulk@example.com'])
+        with self.assertNumQueries(0):
+            self.assertTrue(email_filter.might_exist('bulk@example.com'))
+            self.assertFalse(email_filter.might_exist('nobody-else@example.com'))
+
+    def test_unknown_email_other_process(self):
+        # a filter built before another process added users catches up from the log
+        other = EmailFilter(None, 1000, 0.001, 3600, 10)
+        other.sync()
+        User.objects.bulk_create([User(email='bulk@example.com', name='Bulk')])
+        publish_emails(['bulk@example.com'])
+        with self.assertNumQueries(0):
+            self.assertTrue(other.might_exist('bulk@example.com'))
+            self.assertFalse(other.might_exist('nobody@example.com'))
+
+        # an entry it cannot read makes it answer "may exist"
+        publish_emails(['late@example.com'])
+        cache.delete(f'email_filter:added:{current_sequence()}')
+        self.assertTrue(other.might_exist('nobody@example.com'))
+
+    def test_friend_request_events(self):
+        last_id = self.client.get('/api/list-requests/events/').data['last_event_id']
+        pair = {'sender_id': self.other.id, 'receiver_id': self.me.id}
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/manage-requests/', {'sender': 'other@example.com', 'accept': False}, format='json')
+            self.client.force_authenticate(self.other)
+            self.client.post('/api/send-request/', {'to_email': 'me@example.com'})
+
+        self.client.force_authenticate(self.me)
+        response = self.assertWithinQueryBudget('get', f'/api/list-requests/events/?last_event_id={last_id}&timeout=0')
+        self.assertEqual(
+            [(event['type'], event['data']) for event in response.data['events']],
+            [('friend_request.rejected', pair), ('friend_request.sent', pair)]
+        )
+        self.assertEqual(response.data['last_event_id'], last_id + 2)
+
+    def test_register(self):
+        self.client.force_authenticate(None)
+        response = self.assertWithinQueryBudget('post', '/api/register/', {'name': 'New', 'email': 'new@example.com', 'password': 'password'})
+        self.assertEqual(response.status_code, 201)
+
+
+class KeysetPaginationTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.me = User.objects.create_user('me@example.com', 'password', name='Me')
+        self.client.force_authenticate(self.me)
+
+    def walk(self, path):
+        '''
+            Follow next links from path to the last page, then previous links back
+            to the first; returns the pages of each walk.
+        '''
+        forward, backward = [], []
+        response = self.client.get(path)
+        while True:
+            forward.append(response.data['results'])
+            if response.data['next'] is None:
+                break
+            response = self.client.get(response.data['next'])
+        while response.data['previous'] is not None:
+            response = self.client.get(response.data['previous'])
+            backward.append(response.data['results'])
+        return forward, backward
+
+    def test_friends_cursor(self):
+        friends = [User.objects.create_user(f'friend{i}@example.com', 'password', name=f'Friend {i}') for i in range(25)]
+        for i, friend in enumerate(friends):
+            # both directions, so non-symmetric mode walks both halves of the UNION
+            if i % 2:
+                Friendship.objects.befriend(self.me.id, friend.id)
+            else:
+                Friendship.objects.befriend(friend.id, self.me.id)
+
+        forward, backward = self.walk('/api/lists-friends/?mode=cursor')
+        emails = [friend.email for friend in friends]
+        self.assertEqual([page['lists'] for page in forward], [emails[:10], emails[10:20], emails[20:]])
+        self.assertEqual([page['lists'] for page in backward], [emails[10:20], emails[:10]])
+
+        # a friend removed from an earlier page does not shift the next one
+        response = self.client.get('/api/lists-friends/?mode=cursor')
+        Friendship.objects.filter(user__in=[self.me, friends[0]], friend__in=[self.me, friends[0]]).delete()
+        self.assertEqual(self.client.get(response.data['next']).data['results']['lists'], emails[10:20])
+
+    def test_friends_page_reads_one_page(self):
+        sql = str(Friendship.objects.friend_rows(self.me, after=5, limit=10).query)
+        # each branch of the UNION is cut to the page size, not only the merged rows
+        self.assertEqual(sql.count('LIMIT 10'), 1 if settings.FRIENDSHIP_SYMMETRIC else 3)
+
+    def test_pending_cursor(self):
+        senders = [User.objects.create_user(f'sender{i}@example.com', 'password', name=f'Sender {i}') for i in range(25)]
+        for sender in senders:
+            FriendRequest.objects.send(sender.id, self.me.email)
+        # ties on created_at are broken by id, newest first
+        FriendRequest.objects.filter(sender__in=senders[5:15]).update(created_at=timezone.now() - timedelta(days=1))
+        FriendRequest.objects.filter(sender__in=senders[:5]).update(created_at=timezone.now() - timedelta(days=2))
+        self.me.refresh_from_db()
+
+        forward, backward = self.walk('/api/list-requests/?page_size=10')
+        emails = [sender.email for sender in reversed(senders)]
+        self.assertEqual(forward, [emails[:10], emails[10:20], emails[20:]])
+        self.assertEqual(backward, [emails[10:20], emails[:10]])
+        self.assertEqual(self.client.get('/api/list-requests/').data['count'], 25)
+
+        # accepting a request on the first page does not shift the second one
+        response = self.client.get('/api/list-requests/?page_size=10')
+        FriendRequest.objects.accept(self.me.id, emails[0])
+        self.assertEqual(self.client.get(response.data['next']).data['results'], emails[10:20])
+
+
+class ResponseCacheTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.me = User.objects.create_user('me@example.com', 'password', name='Me')
+        self.other = User.objects.create_user('other@example.com', 'password', name='Other')
+        self.friend = User.objects.create_user('friend@example.com', 'password', name='Friend')
+        FriendRequest.objects.send(self.other.id, self.me.email)
+        FriendRequest.objects.send(self.friend.id, self.me.email)
+
+    def get(self, user, path):
+        self.client.force_authenticate(user)
+        response = self.client.get(path)
+        return response['X-Cache'], response.data['results']
+
+    def manage(self, sender, accept):
+        self.client.force_authenticate(self.me)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/manage-requests/', {'sender': sender.email, 'accept': accept}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_manage_invalidates(self):
+        pending = ['friend@example.com', 'other@example.com']
+        self.assertEqual(self.get(self.me, '/api/list-requests/'), ('MISS', pending))
+        self.assertEqual(self.get(self.me, '/api/list-requests/'), ('HIT', pending))
+        self.assertEqual(self.get(self.me, '/api/lists-friends/'), ('MISS', {'lists': []}))
+        self.assertEqual(self.get(self.other, '/api/lists-friends/'), ('MISS', {'lists': []}))
+        self.assertEqual(self.get(self.other, '/api/lists-friends/'), ('HIT', {'lists': []}))
+
+        # accepting drops the cached pages of both the receiver and the sender
+        self.manage(self.other, True)
+        self.assertEqual(self.get(self.me, '/api/list-requests/'), ('MISS', ['friend@example.com']))
+        self.assertEqual(self.get(self.me, '/api/lists-friends/'), ('MISS', {'lists': ['other@example.com']}))
+        self.assertEqual(self.get(self.other, '/api/lists-friends/'), ('MISS', {'lists': ['me@example.com']}))
+
+        self.assertEqual(self.get(self.me, '/api/list-requests/'), ('HIT', ['friend@example.com']))
+        self.manage(self.friend, False)
+        self.assertEqual(self.get(self.me, '/api/list-requests/'), ('MISS', []))
+        # a rejection only concerns its sender and receiver
+        self.assertEqual(self.get(self.other, '/api/lists-friends/'), ('HIT', {'lists': ['me@example.com']}))
+
+
+class AsyncViewTests(APITestCase):
+
+    '''
+        The api routes with ASYNC_VIEWS on, served through the test client's sync
+        handler as under WSGI.
+    '''
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # registered first, so the urls are rebuilt after the override is undone
+        cls.addClassCleanup(cls.reload_urls)
+        cls.enterClassContext(override_settings(ASYNC_VIEWS=True))
+        cls.reload_urls()
+
+    @staticmethod
+    def reload_urls():
+        importlib.reload(api.urls)
+        importlib.reload(social_media_main.urls)
+        clear_url_caches()
+
+    def setUp(self):
+        cache.clear()
+        email_filter.reset()
+        email_filter.sync()
+        self.me = User.objects.create_user('me@example.com', 'password', name='Me Example')
+        self.other = User.objects.create_user('other@example.com', 'password', name='Other Example')
+        self.friend = User.objects.create_user('friend@example.com', 'password', name='Friend Example')
+        Friendship.objects.befriend(self.me.id, self.friend.id)
+        self.client.force_authenticate(self.me)
+
+    def test_routes(self):
+        self.assertIs(resolve('/api/search-user/').func.view_class, AsyncSearchUserView)
+        self.assertIs(resolve('/api/lists-friends/').func.view_class, AsyncListAllFriends)
+
+    def test_events(self):
+        last_id = self.client.get('/api/list-requests/events/').data['last_event_id']
+        # requests written through the ORM publish too
+        with self.captureOnCommitCallbacks(execute=True):
+            FriendRequest.objects.create(sender=self.other, receiver=self.me).delete()
+        response = self.client.get(f'/api/list-requests/events/?last_event_id={last_id}&timeout=0')
+        pair = {'sender_id': self.other.id, 'receiver_id': self.me.id}
+        self.assertEqual(
+            [(event['type'], event['data']) for event in response.data['events']],
+            [('friend_request.sent', pair), ('friend_request.rejected', pair)]
+        )
+
+    def test_requests(self):
+        response = self.client.get('/api/search-user/?keyword=other example')
+        self.assertEqual(response.data['results'][0], 'other@example.com')
+        self.assertEqual(self.client.get('/api/search-user/?keyword=nobody@example.com').data['results'], [])
+
+        self.assertEqual(self.client.post('/api/send-request/', {'to_email': 7}, format='json').status_code, 400)
+        self.assertEqual(self.client.post('/api/send-request/', {'to_email': 'nobody@example.com'}).status_code, 400)
+        self.client.force_authenticate(self.other)
+        self.assertEqual(self.client.post('/api/send-request/', {'to_email': 'me@example.com'}).status_code, 200)
+        self.assertEqual(FriendRequest.objects.get().sender_id, self.other.id)
+
+        # the counters the request above kept in the database
+        self.me.refresh_from_db()
+        self.client.force_authenticate(self.me)
+        response = self.client.get('/api/list-requests/')
+        self.assertEqual((response.data['count'], response.data['results']), (1, ['other@example.com']))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/manage-requests/', {'sender': 'other@example.com', 'accept': True}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get('/api/list-requests/').data['results'], [])
+
+        expected = sorted(['friend@example.com', 'other@example.com'], key=lambda email: User.objects.get(email=email).id)
+        self.assertEqual(self.client.get('/api/lists-friends/').data['results']['lists'], expected)
+        response = self.client.get('/api/lists-friends/?mode=cursor')
+        self.assertEqual((response.data['results']['lists'], response.data['next']), (expected, None))
+
+
+class JobQueueTests(TestCase):
+
+    def setUp(self):
+        self.me = User.objects.create_user('me@example.com', 'password', name='Me')
+        self.other = User.objects.create_user('other@example.com', 'password', name='Other')
+        self.friend = User.objects.create_user('friend@example.com', 'password', name='Friend')
+        Friendship.objects.befriend(self.me.id, self.friend.id)
+
+    def test_suggestions_job(self):
+        FriendRequest.objects.create(sender=self.other, receiver=self.me)
+        api = APIClient()
+        api.force_authenticate(self.me)
+        api.post('/api/manage-requests/', {'sender': self.other.email, 'accept': True}, format='json')
+        self.assertFalse(FriendSuggestion.objects.exists())
+
+        self.assertEqual(jobs.work(burst=True), (1, 0))
+        self.assertEqual(
+            set(FriendSuggestion.objects.values_list('user_id', 'candidate_id', 'mutual_count')),
+            {(self.other.id, self.friend.id, 1), (self.friend.id, self.other.id, 1)}
+        )
+        # a worker whose lease was taken over rolls its work back
+        FriendSuggestion.objects.all().delete()
+        with self.assertLogs('api.jobs', 'WARNING'):
+            self.assertFalse(jobs.run_job(Job.objects.get()))
+        self.assertFalse(FriendSuggestion.objects.exists())
+        self.assertEqual(Job.objects.get().status, Job.DONE)
+
+    def test_suggestions_recounted(self):
+        newcomer = User.objects.create_user('newcomer@example.com', 'password', name='Newcomer')
+        for user_id, friend_id in [(self.other.id, self.me.id), (self.other.id, self.friend.id), (newcomer.id, self.me.id)]:
+            Friendship.objects.befriend(user_id, friend_id)
+            jobs.enqueue('friendship_created', {'user_id': user_id, 'friend_id': friend_id})
+        self.assertEqual(jobs.work(burst=True), (3, 0))
+        # the jobs run after all three edges exist and recount instead of adding
+        # up: newcomer shares me with both, once
+        self.assertEqual(
+            set(FriendSuggestion.objects.filter(user=newcomer).values_list('candidate_id', 'mutual_count')),
+            {(self.other.id, 1), (self.friend.id, 1)}
+        )
+        Friendship.objects.befriend(newcomer.id, self.friend.id)
+        jobs.enqueue('friendship_created', {'user_id': newcomer.id, 'friend_id': self.friend.id})
+        jobs.work(burst=True)
+        self.assertEqual(
+            set(FriendSuggestion.objects.filter(user=newcomer).values_list('candidate_id', 'mutual_count')),
+            {(self.other.id, 2)}
+        )
+
+    @override_settings(FRIEND_SUGGESTIONS={**settings.FRIEND_SUGGESTIONS, 'MAX_STORED': 1})
+    def test_suggestions_fan_out_bounded(self):
+        for i in range(3):
+            Friendship.objects.befriend(self.me.id, User.objects.create_user(f'user{i}@example.com', 'password').id)
+        Friendship.objects.befriend(self.other.id, self.me.id)
+        jobs.enqueue('friendship_created', {'user_id': self.other.id, 'friend_id': self.me.id})
+        jobs.work(burst=True)
+        # only the first of me's four other friends is recounted
+        self.assertEqual(
+            list(FriendSuggestion.objects.filter(user=self.other).values_list('candidate_id', flat=True)), [self.friend.id]
+        )
+
+    def test_expired_lease(self):
+        jobs.enqueue('friendship_created', {'user_id': self.me.id, 'friend_id': self.friend.id})
+        stalled, = Job.objects.claim(1, lease=0)
+        taken_over, = Job.objects.claim(1, lease=60)
+        with self.assertLogs('api.jobs', 'WARNING'):
+            self.assertFalse(jobs.run_job(stalled))
+        self.assertTrue(jobs.run_job(taken_over))
+        self.assertEqual(Job.objects.get().attempts, 2)
+
+    def test_idempotency_key(self):
+        self.assertIsNotNone(jobs.enqueue('friendship_created', {'user_id': self.me.id, 'friend_id': self.friend.id}, key='k'))
+        self.assertIsNone(jobs.enqueue('friendship_created', {'user_id': self.me.id, 'friend_id': self.friend.id}, key='k'))
+        self.assertEqual(Job.objects.count(), 1)
+
+    def test_retry(self):
+        job_id = jobs.enqueue('friendship_created', {'user_id': self.me.id})
+        with self.assertLogs('api.jobs', 'WARNING'):
+            self.assertEqual(jobs.work(burst=True), (0, 1))
+        job = Job.objects.get(pk=job_id)
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 1))
+        self.assertIn('TypeError', job.last_error)
+        self.assertGreater(job.run_at, timezone.now())
+
+        Job.objects.filter(pk=job_id).update(run_at=timezone.now(), attempts=job.max_attempts - 1)
+        with self.assertLogs('api.jobs', 'ERROR'):
+            jobs.work(burst=True)
+        self.assertEqual(Job.objects.get(pk=job_id).status, Job.FAILED)
+
+
+class FriendSuggestionTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        users = {
+            name: User.objects.create_user(f'{name}@example.com', 'password', name=name.title())
+            for name in ['me', 'f1', 'f2', 'f3', 'three', 'two', 'one', 'sent', 'received']
+        }
+        self.me = users['me']
+        edges = [
+            ('me', 'f1'), ('me', 'f2'), ('me', 'f3'), ('f1', 'f2'),
+            ('three', 'f1'), ('three', 'f2'), ('three', 'f3'),
+            ('two', 'f1'), ('two', 'f3'),
+            ('one', 'f2'),
+            ('sent', 'f1'), ('sent', 'f2'),
+            ('received', 'f3'),
+        ]
+        for a, b in edges:
+            Friendship.objects.befriend(users[a].id, users[b].id)
+        FriendRequest.objects.create(sender=self.me, receiver=users['sent'])
+        FriendRequest.objects.create(sender=users['received'], receiver=self.me)
+        self.client.force_authenticate(self.me)
+
+    def test_rebuild_and_list(self):
+        out = StringIO()
+        call_command('rebuild_friend_suggestions', '--shards', '3', stdout=out)
+        self.assertIn('rebuilt suggestions for 9 users over 3 shards', out.getvalue())
+        # friends and the user themselves are never stored; pending requests are
+        # left out when listing
+        self.assertEqual(
+            set(FriendSuggestion.objects.filter(user=self.me).values_list('candidate__email', 'mutual_count')),
+            {('three@example.com', 3), ('two@example.com', 2), ('sent@example.com', 2),
+             ('one@example.com', 1), ('received@example.com', 1)},
+        )
+
+        response = self.client.get('/api/suggestions/')
+        self.assertEqual(response.data['results'], [
+            {'email': 'three@example.com', 'mutual_friends': 3},
+            {'email': 'two@example.com', 'mutual_friends': 2},
+            {'email': 'one@example.com', 'mutual_friends': 1},
+        ])
+        response = self.client.get('/api/suggestions/?limit=2')
+        self.assertEqual([result['email'] for result in response.data['results']], ['three@example.com', 'two@example.com'])
+        self.assertEqual(self.client.get('/api/suggestions/?limit=x').status_code, 400)
+
+        # once the request is answered the candidate is suggested again
+        FriendRequest.objects.filter(sender=self.me).delete()
+        response = self.client.get('/api/suggestions/')
+        self.assertIn({'email': 'sent@example.com', 'mutual_friends': 2}, response.data['results'])
+
+
+class CounterTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.me = User.objects.create_user('me@example.com', 'password', name='Me')
+        self.other = User.objects.create_user('other@example.com', 'password', name='Other')
+        self.friend = User.objects.create_user('friend@example.com', 'password', name='Friend')
+        self.api = APIClient()
+
+    def counters(self, user):
+        user.refresh_from_db(fields=User.COUNTER_FIELDS)
+        return tuple(getattr(user, field) for field in User.COUNTER_FIELDS)
+
+    def test_counters(self):
+        self.api.force_authenticate(self.other)
+        self.api.post('/api/send-request/bulk/', {'to_emails': [self.me.email, self.friend.email]}, format='json')
+        self.assertEqual(self.counters(self.other), (0, 0, 2))
+        self.assertEqual(self.counters(self.me), (0, 1, 0))
+
+        self.api.force_authenticate(self.me)
+        self.api.post('/api/manage-requests/', {'sender': self.other.email, 'accept': True}, format='json')
+        self.api.post('/api/manage-requests/', {'sender': self.other.email, 'accept': True}, format='json')
+        self.assertEqual(self.counters(self.me), (1, 0, 0))
+        self.assertEqual(self.counters(self.other), (1, 0, 1))
+
+        self.api.force_authenticate(self.friend)
+        self.api.post('/api/manage-requests/bulk/', {'decisions': [{'sender': self.other.email, 'accept': False}]}, format='json')
+        self.assertEqual(self.counters(self.other), (1, 0, 0))
+        self.assertEqual(self.counters(self.friend), (0, 0, 0))
+
+        Friendship.objects.filter(user=self.me).delete()
+        self.assertEqual(self.counters(self.me), (0, 0, 0))
+
+    def test_reconcile(self):
+        FriendRequest.objects.create(sender=self.other, receiver=self.me)
+        Friendship.objects.befriend(self.me.id, self.friend.id)
+        User.objects.update(friend_count=5, pending_in_count=0, pending_out_count=0)
+
+        out = StringIO()
+        call_command('reconcile_counters', '--batch-size', '2', stdout=out)
+        self.assertIn('repaired 3', out.getvalue())
+        self.assertEqual(self.counters(self.me), (1, 1, 0))
+        self.assertEqual(self.counters(self.other), (0, 0, 1))
+        self.assertEqual(self.counters(self.friend), (1, 0, 0))
+
+    def test_counters_migration(self):
+        migration = importlib.import_module('api.migrations.0014_user_counters')
+        FriendRequest.objects.create(sender=self.other, receiver=self.me)
+        # me <-> friend stored in both directions, me -> other one way
+        Friendship.objects.bulk_create([
+            Friendship(user=self.me, friend=self.friend), Friendship(user=self.friend, friend=self.me),
+            Friendship(user=self.me, friend=self.other),
+        ])
+        for symmetric in (False, True):
+            User.objects.update(friend_count=0, pending_in_count=0, pending_out_count=0)
+            with override_settings(FRIENDSHIP_SYMMETRIC=symmetric):
+                migration.populate_counters(django_apps, None)
+            self.assertEqual(
+                [self.counters(user) for user in (self.me, self.other, self.friend)],
+                [(2, 1, 0), (1, 0, 1), (1, 0, 0)],
+            )
+
+    def test_drifted_friend_count_lists_every_friend(self):
+        Friendship.objects.bulk_create([
+            Friendship(user=self.me, friend=self.other), Friendship(user=self.friend, friend=self.me),
+        ])
+        self.api.force_authenticate(User.objects.get(pk=self.me.pk))
+        response = self.api.get('/api/lists-friends/')
+        self.assertEqual(response.data['count'], 2)
+        self.assertCountEqual(response.data['results']['lists'], [self.other.email, self.friend.email])
+
+        User.objects.filter(pk=self.me.pk).update(friend_count=30)
+        self.api.force_authenticate(User.objects.get(pk=self.me.pk))
+        response = self.api.get('/api/lists-friends/')
+        self.assertEqual(response.data['count'], 2)
+        self.assertIsNone(response.data['next'])
+
+    def test_backfill_keeps_friend_count(self):
+        Friendship.objects.befriend(self.me.id, self.friend.id)
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'checkpoint')
+            call_command('backfill_friendship_edges', '--checkpoint', checkpoint, stdout=StringIO())
+            self.assertEqual(Friendship.objects.count(), 2)
+            self.assertEqual(self.counters(self.me), (1, 0, 0))
+            self.assertEqual(self.counters(self.friend), (1, 0, 0))
+
+            # a one-way row written after the first run, e.g. before the flip
+            Friendship.objects.befriend(self.other.id, self.me.id)
+            with self.settings(FRIENDSHIP_SYMMETRIC=True):
+                call_command('backfill_friendship_edges', '--checkpoint', checkpoint, stdout=StringIO())
+                self.assertEqual(Friendship.objects.friend_ids(self.me.id), {self.friend.id, self.other.id})
+                self.assertEqual(self.counters(self.me), (2, 0, 0))
+                self.assertEqual(self.counters(self.other), (1, 0, 0))
+
+
+class ImportTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        email_filter.reset()
+        email_filter.sync()
+        self.directory = self.enterContext(tempfile.TemporaryDirectory())
+        self.existing = User.objects.create_user('existing@example.com', 'password', name='Existing')
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_import(self):
+        users = self.write('users.csv', (
+            'email,name,password,password_hash\n'
+            'ann@example.com,Ann,secret1,\n'
+            'bob@example.com,Bob,,' + make_password('secret2') + '\n'
+            'existing@example.com,Clash,secret3,\n'
+            'ann@example.com,Ann Again,secret4,\n'
+            ',Nameless,secret5,\n'
+        ))
+        friendships = self.write('friendships.ndjson', '\n'.join(json.dumps(pair) for pair in [
+            {'user_email': 'ann@example.com', 'friend_email': 'bob@example.com'},
+            {'user_email': 'bob@example.com', 'friend_email': 'ann@example.com'},
+            {'user_email': 'ann@EXAMPLE.com', 'friend_email': 'existing@Example.COM'},
+            {'user_email': 'ann@example.com', 'friend_email': 'ann@example.com'},
+            {'user_email': 'ann@example.com', 'friend_email': 'nobody@example.com'},
+            {'user_email': 'ann@example.com'},
+        ]))
+        checkpoint = os.path.join(self.directory, 'checkpoint.json')
+        args = ['--users', users, '--friendships', friendships, '--batch-size', '2', '--workers', '1',
+                '--checkpoint', checkpoint]
+
+        version = get_versions([self.existing.id])
+        out = StringIO()
+        call_command('import_social_graph', *args, stdout=out)
+        self.assertIn('users: 5 records read, 2 rows inserted, 1 records skipped', out.getvalue())
+        rows = 4 if settings.FRIENDSHIP_SYMMETRIC else 2
+        self.assertIn(f'friendships: 6 records read, {rows} rows inserted, 3 records skipped', out.getvalue())
+        # cached friend lists of the users gaining friends are dropped
+        self.assertNotEqual(get_versions([self.existing.id]), version)
+        ann, bob = User.objects.get(email='ann@example.com'), User.objects.get(email='bob@example.com')
+        self.assertEqual((ann.name, User.objects.get(pk=self.existing.pk).name), ('Ann', 'Existing'))
+        self.assertTrue(ann.check_password('secret1'))
+        self.assertTrue(bob.check_password('secret2'))
+        self.assertTrue(Friendship.objects.are_friends(ann, bob))
+        self.assertTrue(Friendship.objects.are_friends(ann, self.existing))
+        self.assertEqual(
+            [User.objects.get(pk=user.pk).friend_count for user in (ann, bob, self.existing)], [2, 1, 1]
+        )
+        # bulk-created users are visible to the email filter of this process
+        self.assertTrue(email_filter.might_exist('bob@example.com'))
+        with open(checkpoint) as f:
+            self.assertEqual(json.load(f), {'users': 5, 'friendships': 6})
+
+        # a rerun resumes after the checkpoint and writes nothing
+        out = StringIO()
+        call_command('import_social_graph', *args, stdout=out)
+        self.assertIn('users: resuming after 5 records', out.getvalue())
+        self.assertIn('0 rows inserted', out.getvalue())
+        self.assertEqual(User.objects.count(), 3)
+
+
+    def test_export_command(self):
+        ann = User.objects.create_user('ann@example.com', 'password', name='Ann')
+        bob = User.objects.create_user('bob@example.com', 'password', name='Bob')
+        Friendship.objects.befriend(self.existing.id, ann.id)
+        Friendship.objects.befriend(bob.id, self.existing.id)
+        # the pair stored in both directions, as backfill_friendship_edges leaves it
+        Friendship.objects.get_or_create(user=ann, friend=self.existing)
+        output = os.path.join(self.directory, 'export.ndjson')
+        out = StringIO()
+        call_command('export_social_graph', 'existing@example.com', '--output', output, stdout=out)
+        self.assertIn(f'to {output}', out.getvalue())
+        with open(output) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(records[0], {'type': 'user', 'id': self.existing.id, 'email': 'existing@example.com'})
+        self.assertEqual(
+            sorted(record['email'] for record in records if record['type'] == 'friend'),
+            ['ann@example.com', 'bob@example.com'],
+        )
+        with self.assertRaises(CommandError):
+            call_command('export_social_graph', 'nobody@example.com', stdout=StringIO())
+
+class BulkRequestTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.me = User.objects.create_user('me@example.com', 'password', name='Me')
+        self.other = User.objects.create_user('other@example.com', 'password', name='Other')
+        self.friend = User.objects.create_user('friend@example.com', 'password', name='Friend')
+        self.new = User.objects.create_user('new@example.com', 'password', name='New')
+        self.events = []
+        friend_requests_changed.connect(self.record, dispatch_uid='bulk-request-tests')
+        self.addCleanup(friend_requests_changed.disconnect, dispatch_uid='bulk-request-tests')
+
+    def record(self, action=None, pairs=(), **kwargs):
+        if action:
+            self.events.append((action, sorted(pairs)))
+
+    def counters(self, user):
+        user.refresh_from_db(fields=User.COUNTER_FIELDS)
+        return tuple(getattr(user, field) for field in User.COUNTER_FIELDS)
+
+    def test_bulk_send_request(self):
+        Friendship.objects.befriend(self.me.id, self.friend.id)
+        FriendRequest.objects.create(sender=self.me, receiver=self.other)
+        self.client.force_authenticate(self.me)
+        response = self.client.post('/api/send-request/bulk/', {'to_emails': [
+            'new@example.com', 'new@example.com', 'other@example.com', 'friend@example.com',
+            'me@example.com', 'nobody@example.com', 'not an email', 123,
+        ]}, format='json')
+        self.assertEqual(response.data['results'], {
+            'new@example.com': 'sent', 'other@example.com': 'already_sent', 'friend@example.com': 'already_sent',
+            'me@example.com': 'self', 'nobody@example.com': 'not_found', 'not an email': 'invalid', '123': 'invalid',
+        })
+        self.assertEqual(self.events, [('sent', [(self.me.id, self.new.id)])])
+        self.assertEqual(self.counters(self.me), (1, 0, 2))
+        self.assertEqual(self.counters(self.new), (0, 1, 0))
+
+    def test_bulk_manage_request(self):
+        FriendRequest.objects.create(sender=self.other, receiver=self.me)
+        FriendRequest.objects.create(sender=self.friend, receiver=self.me, accepted=True)
+        FriendRequest.objects.create(sender=self.new, receiver=self.me)
+        self.events.clear()
+        self.client.force_authenticate(self.me)
+        response = self.client.post('/api/manage-requests/bulk/', {'decisions': [
+            {'sender': 'other@example.com', 'accept': True},
+            {'sender': 'friend@example.com', 'accept': True},
+            {'sender': 'new@example.com', 'accept': False},
+            {'sender': 'nobody@example.com', 'accept': False},
+            {'sender': 7},
+        ]}, format='json')
+        self.assertEqual(response.data['results'], {
+            'other@example.com': 'accepted', 'friend@example.com': 'accepted', 'new@example.com': 'rejected',
+            'nobody@example.com': 'not_found', "{'sender': 7}": 'invalid',
+        })
+        # the already accepted request is befriended but not accepted again
+        self.assertEqual(self.events, [
+            ('accepted', [(self.other.id, self.me.id)]), ('rejected', [(self.new.id, self.me.id)]),
+        ])
+        self.assertEqual(Friendship.objects.friend_ids(self.me.id), {self.other.id, self.friend.id})
+        self.assertEqual(self.counters(self.me), (2, 0, 0))
+        self.assertEqual(self.counters(self.other), (1, 0, 0))
+        self.assertEqual(self.counters(self.new), (0, 0, 0))
+
+
+class StatelessAuthenticationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.me = User.objects.create_user('me@example.com', 'password', name='Me', is_staff=True)
+        self.auth = StatelessJWTAuthentication()
+
+    def authenticate(self, token):
+        request = RequestFactory().get('/api/lists-friends/', HTTP_AUTHORIZATION=f'Bearer {token}')
+        return self.auth.authenticate(request)[0]
+
+    def test_user_from_claims(self):
+        token = CustomTokenObtainPairSerializer.get_token(self.me).access_token
+        with self.assertNumQueries(1):
+            user = self.authenticate(token)
+        with self.assertNumQueries(0):
+            user = self.authenticate(token)
+        self.assertEqual((user.pk, user.email, user.is_staff), (self.me.pk, 'me@example.com', True))
+        # other fields load on access instead of reading model defaults
+        with self.assertNumQueries(1):
+            self.assertEqual(user.name, 'Me')
+        with self.assertRaises(ValueError):
+            user.save()
+
+    def test_revocation(self):
+        token = CustomTokenObtainPairSerializer.get_token(self.me).access_token
+        self.authenticate(token)
+
+        self.me.is_staff = False
+        self.me.save()
+        self.assertFalse(self.authenticate(token).is_staff)
+
+        self.me.set_password('changed')
+        self.me.save()
+        with self.assertRaisesMessage(AuthenticationFailed, 'revoked'):
+            self.authenticate(token)
+
+        token = CustomTokenObtainPairSerializer.get_token(self.me).access_token
+        self.me.is_active = False
+        self.me.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token)
+
+    def test_state_dropped_on_commit(self):
+        token = CustomTokenObtainPairSerializer.get_token(self.me).access_token
+        with self.captureOnCommitCallbacks(execute=True):
+            self.me.set_password('changed')
+            self.me.save()
+            # a request served before the commit caches the old row again
+            cache.set(token_state_cache_key(self.me.pk), (self.me.token_version - 1, True, True))
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(token)
+
+
+class RateLimitTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.me = User.objects.create_user('me@example.com', 'password', name='Me')
+        self.client.force_authenticate(self.me)
+
+    def send(self):
+        return self.client.post('/api/send-request/', {'to_email': 'nobody@example.com'}, format='json')
+
+    def test_send_request_limit(self):
+        self.assertEqual([self.send().status_code for _ in range(3)], [400] * 3)
+        response = self.send()
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response['Retry-After']), 0)
+
+    def test_request_limit_override(self):
+        constraints = UserActivityConstraints.objects.create(user=self.me, request_limit=5)
+        self.assertEqual([self.send().status_code for _ in range(6)], [400] * 5 + [429])
+
+        cache.clear()
+        constraints.request_limit = 0
+        constraints.save()
+        self.assertEqual(self.send().status_code, 429)
+        # the override is of send_request only
+        self.assertEqual(self.client.get('/api/export/').status_code, 200)
+
+    def test_override_survives_migration(self):
+        migration = importlib.import_module('api.migrations.0010_reset_useractivityconstraints')
+        other = User.objects.create_user('other@example.com', 'password', name='Other')
+        UserActivityConstraints.objects.create(user=self.me, request_limit=10)
+        # a countdown the old view left partly spent
+        UserActivityConstraints.objects.create(user=other, request_limit=1)
+
+        migration.reset_countdowns(django_apps, None)
+        self.assertEqual(
+            dict(UserActivityConstraints.objects.values_list('user_id', 'request_limit')),
+            {self.me.id: 10, other.id: 3},
+        )
+        self.assertEqual([self.send().status_code for _ in range(11)], [400] * 10 + [429])
+
+    def test_bulk_send_request_charges_per_email(self):
+        emails = [f'nobody{i}@example.com' for i in range(300)]
+        response = self.client.post('/api/send-request/bulk/', {'to_emails': emails}, format='json')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/api/send-request/bulk/', {'to_emails': emails}, format='json')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        response = self.client.post('/api/send-request/bulk/', {'to_emails': emails[:100]}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        memory_index.reset()
+        self.exact = User.objects.create_user('exact@example.com', 'password', name='John Smith')
+        self.longer = User.objects.create_user('longer@example.com', 'password', name='Johnathan Smith')
+        self.spelled = User.objects.create_user('spelled@example.com', 'password', name='Jon Smyth')
+        User.objects.create_user('zed@example.com', 'password', name='Zed')
+        User.objects.create_user('gone@example.com', 'password', name='John Smith', is_active=False)
+
+    def test_memory_ranking(self):
+        # ranked by trigram similarity: 1.0, 10/17 and 5/16; "Zed" is under the threshold
+        expected = ['exact@example.com', 'longer@example.com', 'spelled@example.com']
+        self.assertEqual(memory_index.search('john smith', 10), expected)
+        self.assertEqual(memory_index.search('john smith', 2), expected[:2])
+
+        self.exact.is_active = False
+        self.exact.save(update_fields=['is_active'])
+        self.assertEqual(memory_index.search('john smith', 10), expected[1:])
+
+    @skipUnless(connections['default'].vendor == 'postgresql', 'pg_trgm needs postgres')
+    def test_postgres_ranking(self):
+        expected = ['exact@example.com', 'longer@example.com', 'spelled@example.com']
+        self.assertEqual(postgres_search.search('john smith', 10), expected)
+        # the configured threshold applies whatever pg_trgm.similarity_threshold says
+        self.assertEqual(PostgresTrigramSearch(0.5).search('john smith', 10), expected[:2])
+        self.assertEqual(PostgresTrigramSearch(0.9).search('john smith', 10), expected[:1])
+
+
+class RetentionTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.me = User.objects.create_user('me@example.com', 'password', name='Me')
+        self.other = User.objects.create_user('other@example.com', 'password', name='Other')
+        self.friend = User.objects.create_user('friend@example.com', 'password', name='Friend')
+
+    def test_compact(self):
+        old = timezone.now() - timedelta(days=100)
+        stale = FriendRequest.objects.create(sender=self.other, receiver=self.me)
+        fresh = FriendRequest.objects.create(sender=self.friend, receiver=self.other)
+        accepted = FriendRequest.objects.create(sender=self.friend, receiver=self.me, accepted=True)
+        Friendship.objects.befriend(self.me.id, self.friend.id)
+        FriendRequest.objects.filter(pk__in=[stale.pk, accepted.pk]).update(created_at=old, updated_at=old)
+
+        out = StringIO()
+        call_command('compact_friend_requests', '--batch-size', '1', '--max-rate', '0', stdout=out)
+        self.assertIn('expired 1 and archived 1', out.getvalue())
+        self.assertEqual(list(FriendRequest.objects.values_list('id', flat=True)), [fresh.pk])
+        archived = FriendRequestArchive.objects.get()
+        self.assertEqual((archived.id, archived.sender_id, archived.accepted_at), (accepted.pk, self.friend.id, old))
+        self.assertEqual(User.objects.get(pk=self.me.pk).pending_in_count, 0)
+        self.assertEqual(User.objects.get(pk=self.other.pk).pending_out_count, 0)
+
+        # the export still lists the archived request, as accepted
+        records = [json.loads(line) for line in b''.join(export_graph(self.me)).splitlines()]
+        self.assertIn(
+            {'type': 'received_request', 'id': self.friend.id, 'email': 'friend@example.com',
+             'accepted': True, 'created_at': old.isoformat()},
+            records
+        )
+
+        # the archived request does not reopen between friends
+        self.assertIsNone(FriendRequest.objects.send(self.friend.id, self.me.email))
+        self.assertIsNotNone(FriendRequest.objects.send(self.other.id, self.me.email))
+
+
+class ProfilingTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        stack_store.reset()
+        self.staff = User.objects.create_user('staff@example.com', 'password', name='Staff', is_staff=True)
+        self.me = User.objects.create_user('me@example.com', 'password', name='Me')
+
+    def get(self, user, path, **headers):
+        token = CustomTokenObtainPairSerializer.get_token(user).access_token
+        return self.client.get(path, HTTP_AUTHORIZATION=f'Bearer {token}', **headers)
+
+    def test_profile_header(self):
+        self.assertNotIn('X-Profile-Samples', self.get(self.me, '/api/lists-friends/', HTTP_X_PROFILE='1'))
+        self.assertNotIn('X-Profile-Samples', self.get(self.staff, '/api/lists-friends/'))
+        self.assertIn('X-Profile-Samples', self.get(self.staff, '/api/lists-friends/', HTTP_X_PROFILE='1'))
+
+        # the header costs unprivileged callers no query
+        with CaptureQueriesContext(connections['default']) as plain:
+            self.get(self.me, '/api/lists-friends/')
+        with CaptureQueriesContext(connections['default']) as profiled:
+            self.get(self.me, '/api/lists-friends/', HTTP_X_PROFILE='1')
+        self.assertEqual(len(profiled), len(plain))
+
+        # a staff claim in a token issued before a demotion is not enough
+        token = CustomTokenObtainPairSerializer.get_token(self.staff).access_token
+        self.staff.is_staff = False
+        self.staff.save(update_fields=['is_staff'])
+        response = self.client.get('/api/lists-friends/', HTTP_AUTHORIZATION=f'Bearer {token}', HTTP_X_PROFILE='1')
+        self.assertNotIn('X-Profile-Samples', response)
+
+    def test_collapsed_stacks(self):
+        stack = collapse(sys._getframe(), 0, 128)
+        self.assertTrue(stack.endswith('ProfilingTests.test_collapsed_stacks (api/tests.py:%d)' % (
+            ProfilingTests.test_collapsed_stacks.__code__.co_firstlineno
+        )))
+
+        stack_store.add('lists-friends', Counter({'a (x.py:1);b (x.py:2)': 3}))
+        self.assertEqual(self.get(self.me, '/api/profiles/').status_code, 403)
+        response = self.get(self.staff, '/api/profiles/?url_name=lists-friends')
+        self.assertEqual(response.content.decode(), 'a (x.py:1);b (x.py:2) 3\n')
+        response = self.get(self.staff, '/api/profiles/')
+        self.assertEqual(response.content.decode(), 'lists-friends;a (x.py:1);b (x.py:2) 3\n')
+
+    def test_report(self):
+        # the default locmem cache never holds the workers' samples
+        with self.assertRaises(CommandError):
+            call_command('profile_report', stdout=StringIO())
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(CACHES={
+            **settings.CACHES,
+            'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': directory},
+        }):
+            worker = StackStore(settings.PROFILING)
+            worker.add('lists-friends', Counter({'a (x.py:1)': 2}))
+            worker.flush()
+            for _ in range(3):
+                out = StringIO()
+                call_command('profile_report', stdout=out)
+                self.assertEqual(out.getvalue(), 'lists-friends;a (x.py:1) 2\n')
+            # reporting takes no slot of its own
+            self.assertEqual(cache.get('profiling:slots'), 1)
+
+
+class MetricsTests(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        metrics.clear()
+        self.me = User.objects.create_user('me@example.com', 'password', name='Me')
+
+    def test_metrics_endpoint(self):
+        self.client.get('/api/lists-friends/')
+        self.client.force_authenticate(self.me)
+        self.client.get('/api/lists-friends/')
+        self.client.get('/api/lists-friends/')
+
+        # closed unless a token or networks are configured, loopback included
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+        with override_settings(METRICS={**settings.METRICS, 'TOKEN': 'secret'}):
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 404)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        lines = response.content.decode().splitlines()
+        self.assertIn('# TYPE api_request_duration_seconds histogram', lines)
+        self.assertIn('api_request_duration_seconds_count{url_name="lists-friends",method="GET",status="200"} 2', lines)
+        self.assertIn('api_request_duration_seconds_bucket{url_name="lists-friends",method="GET",status="401",le="+Inf"} 1', lines)
+        self.assertIn('api_response_cache_requests_total{scope="lists-friends",outcome="hit"} 1', lines)
+        self.assertIn('api_auth_failures_total{reason="not_authenticated"} 1', lines)
+        self.assertIn('api_request_db_queries_count{url_name="lists-friends"} 3', lines)
+
+        with override_settings(METRICS={**settings.METRICS, 'ALLOWED_NETWORKS': ['10.0.0.0/8']}):
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.1.2.3').status_code, 200)
+            self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 404)
+
+    def test_worker_files(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(METRICS={**settings.METRICS, 'DIR': directory}):
+            first = metrics.MmapStore(os.path.join(directory, 'metrics-1.db'))
+            second = metrics.MmapStore(os.path.join(directory, 'metrics-2.db'))
+            for i in range(2000):
+                first.inc(('c_total', (('n', str(i)),)), 1)
+            first.inc(('c_total', (('n', '0'),)), 2)
+            second.inc(('c_total', (('n', '0'),)), 0.5)
+
+            values = metrics.collect()
+            self.assertEqual(values[('c_total', (('n', '0'),))], 3.5)
+            self.assertEqual(len(values), 2000)
+            # a restarted worker with the same pid continues its series
+            reopened = metrics.MmapStore(os.path.join(directory, 'metrics-1.db'))
+            reopened.inc(('c_total', (('n', '1999'),)), 1)
+            self.assertEqual(metrics.collect()[('c_total', (('n', '1999'),))], 2)
+
+
+def join_threads(name):
+    for thread in threading.enumerate():
+        if thread.name == name:
+            thread.join(10)
+
+
+class BackgroundBuildTests(TransactionTestCase):
+
+    '''
+        In-process indexes built from committed rows in a thread of their own.
+    '''
+
+    def setUp(self):
+        cache.clear()
+        User.objects.create_user('me@example.com', 'password', name='Me Example')
+
+    def test_email_filter(self):
+        emails = EmailFilter(None, 1000, 0.001, 3600, 10)
+        # every email may exist until the first build is done
+        self.assertTrue(emails.might_exist('nobody@example.com'))
+        join_threads('email-filter-rebuild')
+        with self.assertNumQueries(0):
+            self.assertFalse(emails.might_exist('nobody@example.com'))
+            self.assertTrue(emails.might_exist('ME@example.com'))
+
+    def test_prefix_index(self):
+        me = User.objects.get()
+        index = PrefixIndex(3600, 1000, 32)
+        # answered by the database until the first build is in
+        self.assertEqual([pk for pk, _, _ in index.complete('me', 10, 50)[0]], [me.pk])
+        join_threads('prefix-index-rebuild')
+        with self.assertNumQueries(0):
+            self.assertEqual(index.complete('exa', 10, 50)[0], [(me.pk, 'Me Example', 'me@example.com')])
+
+
+class BenchmarkCommandTests(TransactionTestCase):
+
+    '''
+        The benchmark workers run in threads of their own, so they need
+        committed rows.
+    '''
+
+    def setUp(self):
+        cache.clear()
+
+    def test_generate_and_run(self):
+        out = StringIO()
+        call_command('generate_social_graph', '--users', '20', '--avg-degree', '3', '--pending-max', '3', stdout=out)
+        self.assertIn('generated 20 users', out.getvalue())
+        self.assertEqual(User.objects.filter(email__startswith='bench').count(), 20)
+        self.assertTrue(Friendship.objects.exists())
+        user = User.objects.filter(friend_count__gt=0).first()
+        self.assertEqual(user.friend_count, len(Friendship.objects.friend_ids(user.id)))
+
+        email_filter.reset()
+        email_filter.sync()
+        prefix_index.reset()
+        prefix_index.load()
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'results.json')
+            call_command(
+                'run_benchmarks', '--requests', '6', '--warmup', '1', '--sample-users', '2',
+                '--output', output, stdout=StringIO(),
+            )
+            with open(output) as handle:
+                report = json.load(handle)
+        self.assertEqual(report['mode'], 'in-process')
+        self.assertEqual(set(report['results']), {
+            'search-user', 'lists-friends', 'list-requests', 'send-request', 'manage-requests', 'login',
+        })
+        for endpoint in ('search-user', 'lists-friends', 'list-requests', 'login'):
+            self.assertEqual(report['results'][endpoint]['statuses'], {'200': 6}, endpoint)
+        # the raised request_limit keeps the send-request scenario out of the throttle
+        send = report['results']['send-request']
+        self.assertEqual(send['requests'], 6)
+        self.assertNotIn('429', send['statuses'])
+        self.assertEqual(send['non_2xx'], 6 - sum(n for status, n in send['statuses'].items() if status[0] == '2'))
+
+
+class BenchmarkServerStacksTests(SimpleTestCase):
+
+    def test_dry_run(self):
+        out = StringIO()
+        call_command(
+            'benchmark_server_stacks', '--dry-run', '--workers', '2', '--threads', '4', '--cpus', '1,0',
+            '--port', '9100', '--endpoints', 'login', 'search-user', '--output-dir', '/tmp/stacks', stdout=out,
+        )
+        output = out.getvalue()
+        self.assertIn(
+            'ASYNC_VIEWS=false ' + shlex.join([
+                sys.executable, '-m', 'gunicorn', 'social_media_main.wsgi:application', '--bind', '127.0.0.1:9100',
+                '--workers', '2', '--threads', '4', '--worker-class', 'gthread',
+            ]),
+            output,
+        )
+        self.assertIn('ASYNC_VIEWS=true ' + shlex.join([
+            sys.executable, '-m', 'uvicorn', 'social_media_main.asgi:application', '--host', '127.0.0.1',
+            '--port', '9100', '--workers', '2', '--no-access-log',
+        ]), output)
+        self.assertEqual(output.count('cpus:      0,1'), 2)
+        self.assertIn(
+            'run_benchmarks --base-url http://127.0.0.1:9100 --requests 500 --concurrency 50 '
+            '--output /tmp/stacks/asgi.json --endpoints login search-user',
+            output,
+        )
+
+    def test_arguments(self):
+        for args in (['--cpus', 'a,b'], ['--workers', '0'], ['--stacks', 'fcgi']):
+            with self.assertRaises(CommandError):
+                call_command('benchmark_server_stacks', '--dry-run', *args, stdout=StringIO())
+
+class InProcessHubTests(SimpleTestCase):
+
+    def setUp(self):
+        self.hub = InProcessHub({**settings.EVENTS, 'HISTORY': 2, 'CHANNELS': 2})
+
+    def test_resume(self):
+        start = self.hub.last_id('a')
+        for n in range(3):
+            self.hub.publish('a', 'tick', {'n': n})
+        self.assertEqual([event.data for event in self.hub.since('a', start + 1)], [{'n': 1}, {'n': 2}])
+        self.assertEqual(self.hub.since('a', start + 3), [])
+        # the first event was evicted from the history
+        self.assertEqual([(event.id, event.type) for event in self.hub.since('a', start)], [(start + 3, RESET)])
+
+    def test_evicted_channel(self):
+        start = self.hub.last_id('a')
+        self.hub.publish('a', 'tick', {})
+        self.hub.publish('b', 'tick', {})
+        self.hub.publish('c', 'tick', {})
+        self.assertEqual(self.hub.since('a', start + 1)[0].type, RESET)
+
+    def test_wait(self):
+        start = self.hub.last_id('a')
+        self.assertEqual(self.hub.wait('a', start, 0.01), [])
+        threading.Timer(0.05, self.hub.publish, ('a', 'tick', {})).start()
+        self.assertEqual([event.type for event in self.hub.wait('a', start, 5)], ['tick'])
+
+
+@override_settings(DATABASE_REPLICAS={'ALIASES': ['replica0'], 'STICKY_SECONDS': 5, 'CACHE': 'default'})
+class ReplicaRouterTests(SimpleTestCase):
+
+    '''
+        Routing decisions of ReplicaRouter; run the whole suite with
+        REPLICA_DATABASE_URLS set to exercise a real second database.
+    '''
+
+    def setUp(self):
+        cache.clear()
+        self.router = ReplicaRouter()
+        self.request = RequestFactory().get('/api/lists-friends/')
+        self.request.user = User(id=1, email='me@example.com')
+
+    def test_outside_a_request_reads_primary(self):
+        self.assertIsNone(self.router.db_for_read(User))
+
+    def test_replica_view_reads_replica(self):
+        with routing_request(self.request, use_replica=True):
+            self.assertEqual(self.router.db_for_read(User), 'replica0')
+
+    def test_other_views_read_primary(self):
+        with routing_request(self.request, use_replica=False):
+            self.assertIsNone(self.router.db_for_read(User))
+
+    def test_reads_before_authentication_stay_on_primary(self):
+        del self.request.user
+        with routing_request(self.request, use_replica=True):
+            self.assertIsNone(self.router.db_for_read(User))
+
+    def test_reads_after_a_write_stay_on_primary(self):
+        with routing_request(self.request, use_replica=True) as state:
+            self.assertEqual(self.router.db_for_write(User), 'default')
+            self.assertTrue(state['wrote'])
+            self.assertIsNone(self.router.db_for_read(User))
+
+    def test_sticky_user_reads_primary(self):
+        mark_sticky(1)
+        with routing_request(self.request, use_replica=True):
+            self.assertIsNone(self.router.db_for_read(User))
+
+    def test_no_migrations_on_replicas(self):
+        self.assertFalse(self.router.allow_migrate('replica0', 'api'))
+        self.assertTrue(self.router.allow_migrate('default', 'api'))
+
+
+@skipUnless(settings.DATABASE_REPLICAS['ALIASES'], 'set REPLICA_DATABASE_URLS to run against a replica alias')
+class ReplicaRoutingTests(TransactionTestCase):
+
+    '''
+        End to end through the middleware with a real second alias (a test mirror of
+        default), e.g. REPLICA_DATABASE_URLS=sqlite:////tmp/replica.db.
+    '''
+
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        self.replica = settings.DATABASE_REPLICAS['ALIASES'][0]
+        self.me = User.objects.create_user('me@example.com', 'password', name='Me')
+        self.friend = User.objects.create_user('friend@example.com', 'password', name='Friend')
+        Friendship.objects.befriend(self.me.id, self.friend.id)
+        self.client = APIClient()
+        self.client.force_authenticate(self.me)
+
+    @override_settings(RESPONSE_CACHE={'ENABLED': False, 'CACHE': 'responses', 'TTL': {}, 'STATS': False})
+    def test_read_only_view_reads_replica_until_the_user_writes(self):
+        with CaptureQueriesContext(connections[self.replica]) as replica_queries:
+            response = self.client.get('/api/lists-friends/')
+        self.assertEqual(response.data['results']['lists'], ['friend@example.com'])
+        self.assertGreater(len(replica_queries), 0)
+
+        self.client.post('/api/send-request/', {'to_email': 'friend@example.com'}, format='json')
+        with CaptureQueriesContext(connections[self.replica]) as replica_queries:
+            self.client.get('/api/lists-friends/')
+        self.assertEqual(len(replica_queries), 0)
@@ -1,11 +1,27 @@
+from django.conf import settings
 from django.urls import path
-from api.views import RegisterUser, SearchUserView, FriendRequestView, ListPendingRequestView, ManageFriendRequestView, ListAllFriends
+from api.views import RegisterUser, SearchUserView, FriendRequestView, ListPendingRequestView, ManageFriendRequestView, ListAllFriends, FriendSuggestionView, MutualFriendsView, \
+    BulkFriendRequestView, BulkManageFriendRequestView, ExportGraphView, AutocompleteView, FriendRequestEventsView, ProfileView
+
+if settings.ASYNC_VIEWS:
+    from api.async_views import AsyncSearchUserView as SearchUserView, AsyncFriendRequestView as FriendRequestView, \
+        AsyncListPendingRequestView as ListPendingRequestView, AsyncManageFriendRequestView as ManageFriendRequestView, \
+        AsyncListAllFriends as ListAllFriends, AsyncExportGraphView as ExportGraphView, \
+        AsyncFriendRequestEventsView as FriendRequestEventsView
 
 urlpatterns = [
     path('register/', RegisterUser.as_view(), name='create_user_api'),
     path('search-user/', SearchUserView.as_view(), name='search_user'),
+    path('autocomplete/', AutocompleteView.as_view(), name='autocomplete'),
     path('send-request/', FriendRequestView.as_view(), name='send_request'),
+    path('send-request/bulk/', BulkFriendRequestView.as_view(), name='bulk_send_request'),
     path('list-requests/', ListPendingRequestView.as_view(), name='list_friend_request'),
+    path('list-requests/events/', FriendRequestEventsView.as_view(), name='friend-request-events'),
     path('manage-requests/', ManageFriendRequestView.as_view(), name='manage-requests'),
-    path('lists-friends/', ListAllFriends.as_view(), name='lists-friends')
+    path('manage-requests/bulk/', BulkManageFriendRequestView.as_view(), name='bulk-manage-requests'),
+    path('lists-friends/', ListAllFriends.as_view(), name='lists-friends'),
+    path('suggestions/', FriendSuggestionView.as_view(), name='friend-suggestions'),
+    path('mutual-friends/', MutualFriendsView.as_view(), name='mutual-friends'),
+    path('export/', ExportGraphView.as_view(), name='export-graph'),
+    path('profiles/', ProfileView.as_view(), name='profiles'),
 ]
\ No newline at end of file
@@ -1,13 +1,27 @@
 from django.shortcuts import render
-from api.models import User, FriendRequest, UserActivityConstraints, Friendship
+from django.http import HttpResponse, StreamingHttpResponse
+from api.models import User, FriendRequest, Friendship
 from rest_framework.views import APIView
 from rest_framework.response import Response
 import rest_framework.status as status
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
-from django.db.models import Q
+from django.conf import settings
+from django.db import IntegrityError, transaction
 from utils.permissions import HasRequestLimit
+from api.search import search_users
+from api.pagination import CountedPagination, KeysetPagination, PendingRequestPagination
+from api.suggestions import suggestions_for
+from api.jobs import enqueue, enqueue_many
+from api.adjacency import adjacency_index
+from api.autocomplete import prefix_index
+from api.email_filter import email_filter
+from api.export import export_graph
+from api.events import event_data, user_channel
+from utils.profiling import format_collapsed, stack_store
+from utils.pubsub import get_hub
+from utils.response_cache import cache_response, user_graph_version, users_version
 from rest_framework.pagination import PageNumberPagination
 
 
@@ -20,34 +34,46 @@ class SearchUserView(APIView):
     """
 
     permission_classes = [IsAuthenticated]
+    use_replica = True
+    query_budget = 3
 
+    @cache_response('search-user', users_version)
     def get(self, request):
 
         """
         Get method to search for users.
 
         If the keyword matches an exact email, return the user associated with that email.
-        If the keyword contains any part of the name, return a list of all users with matching names.
+        Otherwise return users whose name is trigram-similar to the keyword, best match
+        first, capped at USER_SEARCH['MAX_RESULTS'] and paginated. Responses are cached per
+        user until a user is added, renamed or deactivated (RESPONSE_CACHE).
 
         Parameters:
             request (HttpRequest): The HTTP request object.
 
         Returns:
-            Response: A JSON response containing the search results.
+            Response: A paginated JSON response containing the search results.
         """
 
-        keyword = request.data.get('keyword')
+        keyword = request.query_params.get('keyword') or request.data.get('keyword')
+        if not keyword:
+            return Response(data={'message': 'keyword is required'}, status=status.HTTP_400_BAD_REQUEST)
+
         try:
             # Attempt to validate the keyword as an email
             validate_email(keyword)
-            users = User.objects.filter(email=keyword).values_list('email', flat=True)
-        except Exception:
+            # the email filter answers unknown emails without a query
+            users = []
+            if email_filter.might_exist(keyword):
+                users = list(User.objects.filter(email=keyword, is_active=True).values_list('email', flat=True))
+        except ValidationError:
             # If keyword is not a valid email, search by name
-            query = Q()
-            for char in keyword:
-                query &= Q(name__icontains=char)
-            users = User.objects.filter(query).values_list('email', flat=True)
-        return Response(data={'results' : users}, status=status.HTTP_200_OK) 
+            users = search_users(keyword)
+
+        paginator = PageNumberPagination()
+        paginator.page_size = settings.USER_SEARCH['PAGE_SIZE']
+        result_page = paginator.paginate_queryset(users, request)
+        return paginator.get_paginated_response(result_page)
 
 
 class ListPendingRequestView(APIView):
@@ -59,25 +85,58 @@ class ListPendingRequestView(APIView):
     """
 
     permission_classes = [IsAuthenticated]
+    use_replica = True
+    query_budget = 3
 
+    @cache_response('list-requests', user_graph_version)
     def get(self, request):
 
         """
         Get method to retrieve pending friend requests.
 
-        Retrieves a list of pending friend requests received by the authenticated user.
+        Retrieves the pending friend requests received by the authenticated user,
+        newest first, one keyset page at a time (``page_size`` up to 100). Pages are
+        read from the partial api_friendrequest_inbox index on
+        (receiver, -created_at, -id, sender) WHERE NOT accepted and linked by opaque
+        next/previous cursors; ``count`` is the total number of pending requests,
+        read from the user's pending_in_count counter. Pages are cached until the
+        user's requests or friendships change (RESPONSE_CACHE).
 
         Parameters:
             request (HttpRequest): The HTTP request object.
 
         Returns:
-            Response: A JSON response containing the list of pending friend requests.
+            Response: A JSON response containing a page of sender emails.
         """
 
-        lists = FriendRequest.objects.filter(receiver=request.user, accepted=False).values_list('sender__email', flat=True)
-        return Response(data={'results' : lists}, status=status.HTTP_200_OK) 
+        paginator = PendingRequestPagination()
+
+        def fetch(after, before, limit):
+            return FriendRequest.objects.pending_rows(request.user, after=after, before=before)[:limit]
+
+        rows = paginator.paginate_rows(fetch, request)
+        return paginator.get_paginated_response([email for _, _, email in rows], request.user.pending_in_count)
     
 
+def manage_friend_request(receiver_id, sender_email, accept):
+
+    '''
+        Accept (and befriend) or reject the request from sender_email in one
+        transaction. Returns the sender id, or None when there is no such request.
+    '''
+
+    # one conditional UPDATE/DELETE ... RETURNING decides both "does the request
+    # exist" and the outcome, so there is no read-then-write race
+    with transaction.atomic():
+        if not accept:
+            return FriendRequest.objects.reject(receiver_id, sender_email)
+        sender_id = FriendRequest.objects.accept(receiver_id, sender_email)
+        if sender_id is not None and Friendship.objects.befriend(receiver_id, sender_id):
+            # suggestion upkeep runs in the job worker, committed with the friendship
+            enqueue('friendship_created', {'user_id': receiver_id, 'friend_id': sender_id})
+        return sender_id
+
+
 class ManageFriendRequestView(APIView):
 
     """
@@ -87,6 +146,10 @@ class ManageFriendRequestView(APIView):
     """
 
     permission_classes = [IsAuthenticated]
+    # accept: UPDATE + INSERT, each with its counter UPDATE, + the suggestion job's
+    # INSERT, plus a savepoint pair when nested in a transaction and, like every
+    # authenticated view's budget, the JWT user lookup
+    query_budget = 8
 
     def post(self, request):
 
@@ -104,23 +167,11 @@ class ManageFriendRequestView(APIView):
 
         accept = request.data.get('accept')
         sender_email = request.data.get('sender')
-        ref = FriendRequest.objects.filter(sender__email=sender_email, receiver=request.user)
-        if ref.exists():
-            ref = ref.first()
-            if not accept:
-                ref.delete()
-                return Response(data={'accept-status' : accept}, status=status.HTTP_200_OK) 
-            ref.accepted = accept
-            ref.save()
-
-            Friendship.objects.get_or_create(
-                user = request.user,
-                friend = ref.sender
-            )
 
-            return Response(data={'accept-status' : accept}, status=status.HTTP_200_OK) 
-        else:
+        sender_id = manage_friend_request(request.user.id, sender_email, accept)
+        if sender_id is None:
             return Response(data={'message': 'Invalid email address'}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(data={'accept-status' : accept}, status=status.HTTP_200_OK) 
 
 
 
@@ -134,12 +185,22 @@ class ListAllFriends(APIView):
     """
 
     permission_classes = [IsAuthenticated]
+    use_replica = True
+    query_budget = 3
 
+    @cache_response('lists-friends', user_graph_version)
     def get(self, request):
 
         """
         GET method to retrieve a paginated list of all friends of the authenticated user.
 
+        Pass ``mode=cursor`` for keyset pagination: each page is read with a single
+        UNION query ordered by friend id and the response carries opaque next/previous
+        cursors, so page N costs the same as page 1. Without it, page-number
+        pagination over the same query is used, with the total taken from the user's
+        friend_count counter rather than a COUNT query. Pages are cached until the user's
+        requests or friendships change (RESPONSE_CACHE).
+
         Parameters:
             request (HttpRequest): The HTTP request object.
 
@@ -147,20 +208,168 @@ class ListAllFriends(APIView):
             Response: A paginated JSON response containing a list of all friends.
         """
 
-        paginator = PageNumberPagination()
-        paginator.page_size = 10 # Number of friends per page
+        if request.query_params.get('mode') == 'cursor':
+            paginator = KeysetPagination()
 
-        your_friends = Friendship.objects.filter(user=request.user)
-        you_as_friend = Friendship.objects.filter(friend=request.user)
+            def fetch(after, before, limit):
+                return Friendship.objects.friend_rows(request.user, after=after, before=before, limit=limit)
 
-        friend_emails = list(your_friends.values_list('friend__email', flat=True)) + \
-                        list(you_as_friend.values_list('user__email', flat=True))
+            rows = paginator.paginate_rows(fetch, request)
+            return paginator.get_paginated_response({'lists': [email for _, email in rows]})
+
+        paginator = CountedPagination()
 
         # Paginate the friend list
-        result_page = paginator.paginate_queryset(friend_emails, request)
+        result_page = paginator.paginate_counted(
+            Friendship.objects.friend_rows(request.user), request.user.friend_count, request
+        )
         
         # Return paginated response
-        return paginator.get_paginated_response({'lists': result_page})
+        return paginator.get_paginated_response({'lists': [email for _, email in result_page]})
+
+
+
+class FriendSuggestionView(APIView):
+
+    """
+    API endpoint listing "people you may know" for the authenticated user.
+
+    Users must be authenticated to access this endpoint.
+    """
+
+    permission_classes = [IsAuthenticated]
+    query_budget = 2
+
+    def get(self, request):
+
+        """
+        GET method to retrieve friend suggestions ranked by mutual-friend count.
+
+        Scores are precomputed per user, so this is a single indexed read. Users with
+        a pending friend request in either direction are left out.
+
+        Parameters:
+            request (HttpRequest): The HTTP request object, optionally with a 'limit' query param.
+
+        Returns:
+            Response: A JSON response containing the suggested users and their mutual-friend counts.
+        """
+
+        max_limit = settings.FRIEND_SUGGESTIONS['MAX_PAGE_SIZE']
+        try:
+            limit = min(int(request.query_params.get('limit', max_limit)), max_limit)
+        except ValueError:
+            return Response(data={'message': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+
+        results = [
+            {'email': email, 'mutual_friends': count}
+            for email, count in suggestions_for(request.user, max(limit, 0))
+        ]
+        return Response(data={'results': results}, status=status.HTTP_200_OK)
+
+
+
+class MutualFriendsView(APIView):
+
+    """
+    API endpoint returning mutual-friend counts between the authenticated user and a batch of users.
+
+    Users must be authenticated to access this endpoint.
+    """
+
+    permission_classes = [IsAuthenticated]
+    query_budget = 4
+
+    def post(self, request):
+
+        """
+        POST method to count mutual friends for up to MUTUAL_FRIENDS['MAX_BATCH'] users at once.
+
+        Counts come from the in-memory adjacency index; the only database work is one
+        IN query resolving the given emails and, when 'sample' is set, one more for the
+        sampled mutual friends' emails.
+
+        Parameters:
+            request (HttpRequest): The HTTP request object containing 'users' (list of emails)
+                and optionally 'sample' (number of mutual friends to return per user).
+
+        Returns:
+            Response: A JSON response mapping each known email to its mutual-friend count.
+        """
+
+        emails = request.data.get('users')
+        if not isinstance(emails, list) or len(emails) > settings.MUTUAL_FRIENDS['MAX_BATCH']:
+            return Response(
+                data={'message': f"users must be a list of at most {settings.MUTUAL_FRIENDS['MAX_BATCH']} emails"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            sample = min(int(request.data.get('sample', 0)), settings.MUTUAL_FRIENDS['MAX_SAMPLE'])
+        except (TypeError, ValueError):
+            return Response(data={'message': 'sample must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+
+        ids = dict(User.objects.filter(email__in=emails).values_list('id', 'email'))
+        mutuals = adjacency_index.mutual_friends(request.user.id, ids)
+
+        sampled = {}
+        if sample > 0:
+            wanted = {fid for shared in mutuals.values() for fid in shared[:sample]}
+            sampled = dict(User.objects.filter(id__in=wanted).values_list('id', 'email'))
+
+        results = {}
+        for user_id, shared in mutuals.items():
+            results[ids[user_id]] = {'count': len(shared)}
+            if sample > 0:
+                results[ids[user_id]]['mutual'] = [sampled[fid] for fid in shared[:sample] if fid in sampled]
+        return Response(data={'results': results}, status=status.HTTP_200_OK)
+
+
+
+class AutocompleteView(APIView):
+
+    """
+    API endpoint completing a name or email prefix to matching users.
+
+    Users must be authenticated to access this endpoint.
+    """
+
+    permission_classes = [IsAuthenticated]
+    query_budget = 2
+
+    def get(self, request):
+
+        """
+        Get method returning the top matches for a prefix.
+
+        Matches come from the in-process prefix index (AUTOCOMPLETE), so a lookup does no
+        database work beyond authentication. The index scan is bounded by
+        AUTOCOMPLETE['BUDGET_MS']; 'truncated' is true when it was cut short.
+
+        Parameters:
+            request (HttpRequest): The HTTP request object containing 'q' (the prefix) and
+                optionally 'limit' (at most AUTOCOMPLETE['MAX_LIMIT']).
+
+        Returns:
+            Response: A JSON response with the matching users' id, name and email.
+        """
+
+        config = settings.AUTOCOMPLETE
+        prefix = request.query_params.get('q', '').strip()
+        if len(prefix) < config['MIN_PREFIX']:
+            return Response(
+                data={'message': f"q must be at least {config['MIN_PREFIX']} characters"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            limit = min(int(request.query_params.get('limit', config['DEFAULT_LIMIT'])), config['MAX_LIMIT'])
+        except ValueError:
+            return Response(data={'message': 'limit must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1:
+            return Response(data={'message': 'limit must be positive'}, status=status.HTTP_400_BAD_REQUEST)
+
+        matches, truncated = prefix_index.complete(prefix, limit, config['BUDGET_MS'])
+        results = [{'id': pk, 'name': name, 'email': email} for pk, name, email in matches]
+        return Response(data={'results': results, 'truncated': truncated}, status=status.HTTP_200_OK)
 
 
 
@@ -169,10 +378,12 @@ class FriendRequestView(APIView):
     """
     API endpoint for sending friend requests.
 
-    Users must be authenticated and have request limits to access this endpoint.
+    Users must be authenticated and within the 'send_request' rate limit to access this endpoint.
     """
 
     permission_classes = [IsAuthenticated, HasRequestLimit]
+    query_budget = 4
+    rate_limit_scope = 'send_request'
 
     def post(self, request):
 
@@ -187,27 +398,322 @@ class FriendRequestView(APIView):
         """
 
         to = request.data.get('to_email')
+        # validate_email raises TypeError, not ValidationError, on non-strings
+        if not isinstance(to, str):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
         try:
             validate_email(to)
-            user = User.objects.get(email=to)
-            FriendRequest.objects.get_or_create(
-                sender = request.user,
-                receiver = user
+        except ValidationError:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        if not email_filter.might_exist(to):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        # a single INSERT ... SELECT ... ON CONFLICT; only when it inserts nothing do
+        # we look up whether the receiver exists or the request was already sent
+        if FriendRequest.objects.send(request.user.id, to) is None:
+            if not User.objects.filter(email=to).exists():
+                return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(data={'request sent successfully' : to}, status=status.HTTP_200_OK) 
+
+
+
+class BulkFriendRequestView(APIView):
+
+    """
+    API endpoint for sending friend requests to many users at once (e.g. contact import).
+
+    Users must be authenticated and within the 'bulk_send_request' rate limit, which is
+    charged one request per email in the batch.
+    """
+
+    permission_classes = [IsAuthenticated, HasRequestLimit]
+    query_budget = 7
+    rate_limit_scope = 'bulk_send_request'
+
+    def get_rate_limit_cost(self, request):
+        emails = request.data.get('to_emails')
+        return max(len(emails), 1) if isinstance(emails, list) else 1
+
+    def post(self, request):
+
+        """
+        POST method to send friend requests to every email in 'to_emails'.
+
+        All receivers are resolved with one IN query, requests already sent and existing
+        friendships with another, and the requests are written with a single INSERT ...
+        RETURNING that skips ones sent or befriended concurrently.
+
+        Parameters:
+            request (HttpRequest): The HTTP request object containing the 'to_emails' list.
+
+        Returns:
+            Response: A JSON response with a per-email status: sent, already_sent,
+                not_found, invalid or self.
+        """
+
+        emails = request.data.get('to_emails')
+        if not isinstance(emails, list) or len(emails) > settings.BULK_MAX_ITEMS:
+            return Response(
+                data={'message': f'to_emails must be a list of at most {settings.BULK_MAX_ITEMS} emails'},
+                status=status.HTTP_400_BAD_REQUEST
             )
-            user_constraints = UserActivityConstraints.objects.filter(user=request.user)
-            if user_constraints.exists():
-                user_constraints = user_constraints.first()
-                user_constraints.request_limit = user_constraints.request_limit - 1
-                user_constraints.save()
+
+        results = {}
+        valid = []
+        for email in emails:
+            try:
+                if not isinstance(email, str):
+                    raise ValidationError('not a string')
+                validate_email(email)
+                valid.append(email)
+            except ValidationError:
+                results[str(email)] = 'invalid'
+
+        receivers = dict(User.objects.filter(email__in=valid).values_list('email', 'id'))
+        # existing friends count as already sent: their accepted requests may have
+        # been archived by `manage.py compact_friend_requests`
+        receiver_ids = receivers.values()
+        already_sent = set(
+            FriendRequest.objects.filter(sender=request.user, receiver_id__in=receiver_ids)
+            .values_list('receiver_id', flat=True)
+            .union(
+                Friendship.objects.filter(user=request.user, friend_id__in=receiver_ids).values_list('friend_id'),
+                Friendship.objects.filter(friend=request.user, user_id__in=receiver_ids).values_list('user_id'),
+            )
+        )
+
+        new_receivers = {}
+        for email in dict.fromkeys(valid):
+            receiver_id = receivers.get(email)
+            if receiver_id is None:
+                results[email] = 'not_found'
+            elif receiver_id == request.user.id:
+                results[email] = 'self'
+            elif receiver_id in already_sent:
+                results[email] = 'already_sent'
             else:
-                UserActivityConstraints.objects.create(
-                    user=request.user,
-                    request_limit=2
-                )
+                already_sent.add(receiver_id)
+                new_receivers[email] = receiver_id
+
+        created = set(FriendRequest.objects.send_many(request.user.id, new_receivers.values()))
+        for email, receiver_id in new_receivers.items():
+            results[email] = 'sent' if receiver_id in created else 'already_sent'
+        return Response(data={'results': results}, status=status.HTTP_200_OK)
+
+
+
+class BulkManageFriendRequestView(APIView):
+
+    """
+    API endpoint to accept or reject many received friend requests at once.
+
+    Users must be authenticated to access this endpoint.
+    """
+
+    permission_classes = [IsAuthenticated]
+    query_budget = 12
+
+    def post(self, request):
+
+        """
+        POST method applying a list of {'sender': email, 'accept': bool} decisions.
+
+        The senders with a request to the user are resolved with one query; accepted
+        requests are marked with one UPDATE ... RETURNING, rejected ones removed with
+        one DELETE ... RETURNING, the counters and events derived from the returned
+        rows, and the friendships and their suggestion-upkeep jobs inserted in bulk,
+        all in a single transaction.
+
+        Parameters:
+            request (HttpRequest): The HTTP request object containing the 'decisions' list.
+
+        Returns:
+            Response: A JSON response with a per-sender status: accepted, rejected,
+                not_found or invalid.
+        """
+
+        decisions = request.data.get('decisions')
+        if not isinstance(decisions, list) or len(decisions) > settings.BULK_MAX_ITEMS:
+            return Response(
+                data={'message': f'decisions must be a list of at most {settings.BULK_MAX_ITEMS} items'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        results = {}
+        wanted = {}
+        for decision in decisions:
+            if not isinstance(decision, dict) or not isinstance(decision.get('sender'), str):
+                results[str(decision)] = 'invalid'
+                continue
+            wanted[decision['sender']] = bool(decision.get('accept'))
+
+        senders = dict(
+            FriendRequest.objects.filter(receiver=request.user, sender__email__in=wanted)
+            .values_list('sender__email', 'sender_id')
+        )
+        accept_ids = [senders[email] for email, accept in wanted.items() if accept and email in senders]
+        reject_ids = [senders[email] for email, accept in wanted.items() if not accept and email in senders]
+
+        with transaction.atomic():
+            # accepting an already accepted request (re)creates the friendship only
+            FriendRequest.objects.accept_many(request.user.id, accept_ids)
+            if accept_ids:
+                enqueue_many('friendship_created', [
+                    {'user_id': request.user.id, 'friend_id': friend_id}
+                    for friend_id in Friendship.objects.befriend_many(request.user.id, accept_ids)
+                ])
+            rejected = set(FriendRequest.objects.reject_many(request.user.id, reject_ids))
+
+        for email, accept in wanted.items():
+            if email not in senders:
+                results[email] = 'not_found'
+            elif accept:
+                results[email] = 'accepted'
+            else:
+                # removed concurrently, between the lookup and the DELETE
+                results[email] = 'rejected' if senders[email] in rejected else 'not_found'
+        return Response(data={'results': results}, status=status.HTTP_200_OK)
+
+
+
+class ExportGraphView(APIView):
+
+    """
+    API endpoint streaming the authenticated user's friends, sent requests and received
+    requests as NDJSON.
+
+    Users must be authenticated and within the 'export_graph' rate limit.
+    """
+
+    permission_classes = [IsAuthenticated, HasRequestLimit]
+    # only the queries before streaming starts; the export itself runs while the
+    # response is sent
+    query_budget = 2
+    rate_limit_scope = 'export_graph'
+
+    def get(self, request):
+
+        """
+        GET method to download the export.
+
+        One JSON object per line: a "user" header, then "friend", "sent_request" and
+        "received_request" records. Rows are read with server-side cursors and written
+        chunk by chunk, so memory use does not grow with the graph.
+
+        Parameters:
+            request (HttpRequest): The HTTP request object.
+
+        Returns:
+            StreamingHttpResponse: The application/x-ndjson export.
+        """
+
+        return export_response(export_graph(request.user), request.user)
 
-            return Response(data={'request sent successfully' : to}, status=status.HTTP_200_OK) 
-        except Exception :
-            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+def export_response(content, user):
+    response = StreamingHttpResponse(content, content_type='application/x-ndjson')
+    response['Content-Disposition'] = f'attachment; filename="social-graph-{user.pk}.ndjson"'
+    return response
+
+
+
+class FriendRequestEventsView(APIView):
+
+    """
+    API endpoint long-polling for changes to the authenticated user's friend requests.
+
+    Users must be authenticated to access this endpoint.
+    """
+
+    permission_classes = [IsAuthenticated]
+    query_budget = 1
+
+    def get(self, request):
+
+        """
+        GET method waiting for friend requests to or from the user being sent, accepted
+        or rejected.
+
+        Without 'last_event_id' it returns the current id at once. With one it returns the
+        events after it as soon as there are any, or an empty list after 'timeout' seconds
+        (at most EVENTS['LONG_POLL_TIMEOUT']). A "reset" event means events were missed
+        and the client should refetch list-requests/. Waiting does not touch the database.
+
+        Parameters:
+            request (HttpRequest): The HTTP request object, optionally with 'last_event_id'
+                (or a Last-Event-ID header) and 'timeout'.
+
+        Returns:
+            Response: A JSON response with the events and the id to poll from next.
+        """
+
+        try:
+            last_id, timeout = event_request_params(request)
+        except ValueError:
+            return Response(data={'message': 'last_event_id and timeout must be numbers'}, status=status.HTTP_400_BAD_REQUEST)
+
+        channel = user_channel(request.user.id)
+        if last_id is None:
+            return Response(data={'events': [], 'last_event_id': get_hub().last_id(channel)}, status=status.HTTP_200_OK)
+        events = get_hub().wait(channel, last_id, timeout)
+        return events_response(events, last_id)
+
+
+def event_request_params(request):
+    # EventSource sends Last-Event-ID when it reconnects
+    last_id = request.headers.get('Last-Event-ID') or request.query_params.get('last_event_id')
+    timeout = float(request.query_params.get('timeout', settings.EVENTS['LONG_POLL_TIMEOUT']))
+    return (
+        None if last_id is None else int(last_id),
+        max(min(timeout, settings.EVENTS['LONG_POLL_TIMEOUT']), 0),
+    )
+
+
+def events_response(events, last_id):
+    return Response(
+        data={'events': [event_data(event) for event in events], 'last_event_id': events[-1].id if events else last_id},
+        status=status.HTTP_200_OK
+    )
+
+
+
+class ProfileView(APIView):
+
+    """
+    API endpoint serving the stack samples collected by utils.middleware.ProfilingMiddleware.
+
+    Only staff users can access this endpoint.
+    """
+
+    permission_classes = [IsAdminUser]
+    query_budget = 1
+
+    def get(self, request):
+
+        """
+        GET method returning the sampled stacks of every worker in collapsed format, one
+        "frame;frame;... samples" line per stack, ready for flamegraph.pl or speedscope.
+
+        Parameters:
+            request (HttpRequest): The HTTP request object, optionally with 'url_name' to
+                return the stacks of one endpoint only.
+
+        Returns:
+            HttpResponse: The text/plain collapsed stacks.
+        """
+
+        stacks = stack_store.collect()
+        return HttpResponse(format_collapsed(stacks, request.query_params.get('url_name')), content_type='text/plain')
+
+    def delete(self, request):
+
+        """
+        DELETE method discarding the samples collected so far.
+        """
+
+        stack_store.reset()
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
 
 
@@ -216,6 +722,7 @@ class RegisterUser(APIView):
         This API View is used to reguster new user
     '''
     permission_classes = [AllowAny]
+    query_budget = 2
 
     def post(self, request):
 
@@ -234,18 +741,20 @@ class RegisterUser(APIView):
             return Response(data={'message': 'Please enter all required fields'}, status=status.HTTP_400_BAD_REQUEST)
 
 
-        existing_users = User.objects.filter(email__iexact=email)
-        if existing_users.exists():
+        # skip the lookup when the email filter rules the email out
+        if email_filter.might_exist(email) and User.objects.filter(email__iexact=email).exists():
             return Response(data={'message' : 'user already exists'}, status=status.HTTP_400_BAD_REQUEST) 
         
-        
-        user = User.objects.create(
-            name = name, 
-            email = email,
-            password = password,
-            is_active = True
-        )
-        user.set_password(password)
-        user.save()
+        # create_user hashes before saving, so this is a single INSERT
+        try:
+            User.objects.create_user(
+                email = email,
+                password = password,
+                name = name,
+                is_active = True
+            )
+        except IntegrityError:
+            # lost a race with a concurrent registration of the same email
+            return Response(data={'message' : 'user already exists'}, status=status.HTTP_400_BAD_REQUEST) 
         return Response(data={'message' : 'user created'}, status=status.HTTP_201_CREATED)
 
@@ -57,14 +57,22 @@ INSTALLED_APPS = [
     'rest_framework',
 ]
 
+if 'postgresql' in env('ENGINE'):
+    # registers the trigram_similar lookup used by the user search
+    INSTALLED_APPS.append('django.contrib.postgres')
+
 MIDDLEWARE = [
+    'utils.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'utils.middleware.ReplicaRoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'utils.middleware.QueryInstrumentationMiddleware',
+    'utils.middleware.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'social_media_main.urls'
@@ -91,6 +99,14 @@ WSGI_APPLICATION = 'social_media_main.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# Persistent connections: seconds a connection is reused across requests (0 closes it
+# after each request, None never). Keep 0 under ASGI, where every sync_to_async thread
+# holds its own connection.
+CONN_SETTINGS = {
+    'CONN_MAX_AGE': env.int('CONN_MAX_AGE', default=60),
+    'CONN_HEALTH_CHECKS': env.bool('CONN_HEALTH_CHECKS', default=True),
+}
+
 DATABASES = {
     'default': {
         'ENGINE': env('ENGINE'),
@@ -98,10 +114,33 @@ DATABASES = {
         'NAME': env('NAME'),
         'PASSWORD': env('PASSWORD'),
         'HOST': env('HOST'),
-        'PORT': env('PORT')
+        'PORT': env('PORT'),
+        **CONN_SETTINGS,
     }
 }
 
+# Read replicas as database URLs, e.g.
+# REPLICA_DATABASE_URLS=postgres://app@replica1/app,postgres://app@replica2/app
+# Tests mirror them onto the default test database.
+for index, url in enumerate(env.list('REPLICA_DATABASE_URLS', default=[])):
+    DATABASES[f'replica{index}'] = {**env.db_url_config(url), **CONN_SETTINGS, 'TEST': {'MIRROR': 'default'}}
+
+DATABASE_ROUTERS = ['utils.db_router.ReplicaRouter']
+
+DATABASE_REPLICAS = {
+    # read-only views (use_replica = True) read from these aliases
+    "ALIASES": [alias for alias in DATABASES if alias != 'default'],
+    # after a write the user's reads stay on the primary this long
+    "STICKY_SECONDS": env.int('REPLICA_STICKY_SECONDS', default=5),
+    "CACHE": 'default',
+}
+
+
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+    'responses': env.cache('RESPONSE_CACHE_URL', default='locmemcache://responses'),
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -147,8 +186,12 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
+        # set to utils.authentication.StatelessJWTAuthentication to skip the
+        # per-request User lookup; both also authenticate async views
+        env('AUTHENTICATION_CLASS', default='utils.authentication.JWTAuthentication'),
+    ),
+    # counts rate-limit and authentication rejections for /metrics
+    'EXCEPTION_HANDLER': 'utils.metrics.exception_handler',
 }
 
 AUTH_USER_MODEL = "api.User"
@@ -162,4 +205,227 @@ SIMPLE_JWT = {
     "UPDATE_LAST_LOGIN": False,
     "AUTH_HEADER_TYPES": ("Bearer",),
    
-}
\ No newline at end of file
+}
+
+# Route search, list friends/pending, send/manage requests and the export to the coroutine views in
+# api.async_views. Only worth it under ASGI (asgi.py + uvicorn); under WSGI every
+# async view is run through async_to_sync.
+ASYNC_VIEWS = env.bool('ASYNC_VIEWS', default=False)
+
+# token_version/is_active/is_staff cache used by StatelessJWTAuthentication
+TOKEN_STATE_CACHE = 'default'
+TOKEN_STATE_CACHE_TTL = 300
+
+
+USER_SEARCH = {
+    # "auto" uses the pg_trgm index on Postgres and an in-process index elsewhere
+    "BACKEND": env('USER_SEARCH_BACKEND', default='auto'),
+    "SIMILARITY_THRESHOLD": 0.3,
+    "MAX_RESULTS": 100,
+    "PAGE_SIZE": 10,
+}
+
+
+AUTOCOMPLETE = {
+    # seconds before a worker reloads its in-memory prefix index
+    "INDEX_TTL": env.int('AUTOCOMPLETE_INDEX_TTL', default=300),
+    # above this many terms the index is not built and lookups query the database
+    "MAX_ENTRIES": env.int('AUTOCOMPLETE_MAX_ENTRIES', default=2_000_000),
+    "MAX_TERM_LENGTH": 32,
+    "MIN_PREFIX": 1,
+    "DEFAULT_LIMIT": 10,
+    "MAX_LIMIT": 25,
+    "BUDGET_MS": 20,
+}
+
+
+EMAIL_FILTER = {
+    # Bloom filter answering lookups of unknown emails without a query
+    "ENABLED": env.bool('EMAIL_FILTER_ENABLED', default=True),
+    # file shared by all workers on a host (see `manage.py rebuild_email_filter`);
+    # unset, each process builds its own copy
+    "PATH": env.str('EMAIL_FILTER_PATH', default='') or None,
+    "CAPACITY": env.int('EMAIL_FILTER_CAPACITY', default=1_000_000),
+    "ERROR_RATE": 0.001,
+    # seconds before a per-process filter is rebuilt, and log entries expire
+    "TTL": env.int('EMAIL_FILTER_TTL', default=3600),
+    # log of emails added since the filters were built; with several processes
+    # it needs a cache they all share (CACHE_URL), or misses go unnoticed
+    "CACHE": 'default',
+    # log entries (of up to 1000 emails) kept before filters rebuild instead
+    "LOG_SIZE": 10_000,
+}
+
+
+EVENTS = {
+    # utils.pubsub.InProcessHub serves a single process; with several workers use
+    # utils.pubsub.CacheHub, which shares events through EVENTS['CACHE']
+    "BACKEND": env('EVENTS_BACKEND', default='utils.pubsub.InProcessHub'),
+    # events kept per channel for clients resuming with Last-Event-ID
+    "HISTORY": 100,
+    # InProcessHub: user channels kept in memory
+    "CHANNELS": 100_000,
+    # CacheHub: cache alias, event lifetime and how often waiters re-check it
+    "CACHE": 'default',
+    "EVENT_TTL": 3600,
+    "POLL_INTERVAL": 1.0,
+    # seconds a long-poll request waits; each one holds a thread under WSGI
+    "LONG_POLL_TIMEOUT": env.int('EVENTS_LONG_POLL_TIMEOUT', default=25),
+    # server-sent events (ASYNC_VIEWS): keepalive interval, stream lifetime and
+    # the reconnect delay sent to the client
+    "HEARTBEAT": 15,
+    "STREAM_SECONDS": 300,
+    "RETRY_MS": 3000,
+}
+
+
+JOBS = {
+    # run handlers in-process after commit instead of queueing (no worker needed)
+    "RUN_INLINE": env.bool('JOBS_RUN_INLINE', default=False),
+    "MAX_ATTEMPTS": 5,
+    # retry backoff in seconds: RETRY_DELAY * 2 ** (attempt - 1), capped
+    "RETRY_DELAY": 10,
+    "MAX_RETRY_DELAY": 3600,
+    # jobs claimed per round trip, and seconds a worker may hold them before
+    # another worker takes them over
+    "BATCH_SIZE": 10,
+    "LEASE": 300,
+    "POLL_INTERVAL": 1.0,
+    # finished jobs (and their idempotency keys) are deleted after this many seconds
+    "KEEP_FINISHED": 7 * 86400,
+}
+
+
+# `manage.py compact_friend_requests`
+FRIEND_REQUEST_RETENTION = {
+    # pending requests older than this many days are deleted; 0 keeps them
+    "PENDING_TTL_DAYS": env.int('FRIEND_REQUEST_PENDING_TTL_DAYS', default=90),
+    # accepted requests move to FriendRequestArchive this many days after acceptance
+    "ARCHIVE_AFTER_DAYS": env.int('FRIEND_REQUEST_ARCHIVE_AFTER_DAYS', default=7),
+    # ids per locked chunk, and a cap on rows changed per second across chunks
+    "BATCH_SIZE": 1000,
+    "MAX_ROWS_PER_SECOND": 5000,
+}
+
+
+# Store every friendship as two directed edges (user -> friend and friend -> user).
+# Run `manage.py backfill_friendship_edges` before switching this on for existing data.
+FRIENDSHIP_SYMMETRIC = env.bool('FRIENDSHIP_SYMMETRIC', default=False)
+
+
+FRIEND_SUGGESTIONS = {
+    # candidates kept per user by rebuild_friend_suggestions
+    "MAX_STORED": 100,
+    "MAX_PAGE_SIZE": 20,
+}
+
+
+MUTUAL_FRIENDS = {
+    # seconds before a worker reloads its in-memory adjacency index
+    "INDEX_TTL": env.int('MUTUAL_FRIENDS_INDEX_TTL', default=300),
+    "MAX_BATCH": 300,
+    "MAX_SAMPLE": 5,
+}
+
+
+# Cache alias used by utils.ratelimit; use a shared backend (db, file, memcached)
+# when running several workers
+RATE_LIMIT_CACHE = 'default'
+
+RATE_LIMITS = {
+    # POLICY is "token_bucket", "sliding_window" or a dotted path to a RateLimitPolicy.
+    # With USER_OVERRIDE a user's UserActivityConstraints.request_limit overrides
+    # the count in RATE.
+    "send_request": {
+        "POLICY": env('SEND_REQUEST_RATE_POLICY', default='token_bucket'),
+        "RATE": env('SEND_REQUEST_RATE', default='3/m'),
+        "USER_OVERRIDE": True,
+    },
+    # charged per email in the batch; keep the count at least BULK_MAX_ITEMS so a
+    # full batch can pass
+    "bulk_send_request": {
+        "POLICY": env('BULK_SEND_REQUEST_RATE_POLICY', default='token_bucket'),
+        "RATE": env('BULK_SEND_REQUEST_RATE', default='500/h'),
+    },
+    "export_graph": {
+        "POLICY": env('EXPORT_GRAPH_RATE_POLICY', default='token_bucket'),
+        "RATE": env('EXPORT_GRAPH_RATE', default='5/h'),
+    },
+}
+
+# maximum items accepted by the bulk send/manage endpoints
+BULK_MAX_ITEMS = 500
+
+
+GRAPH_EXPORT = {
+    # rows fetched per server-side cursor round trip and written per chunk
+    "CHUNK_SIZE": env.int('GRAPH_EXPORT_CHUNK_SIZE', default=2000),
+}
+
+
+# Per-user cache of read endpoint responses (utils.response_cache). Entries are keyed by
+# user, URL and a per-user graph version bumped whenever a FriendRequest or Friendship
+# of the user changes; search results by a version bumped on user changes.
+RESPONSE_CACHE = {
+    "ENABLED": env.bool('RESPONSE_CACHE_ENABLED', default=True),
+    "CACHE": 'responses',
+    # seconds per scope; 0 disables caching for it
+    "TTL": {
+        "lists-friends": env.int('FRIENDS_CACHE_TTL', default=300),
+        "list-requests": env.int('PENDING_REQUESTS_CACHE_TTL', default=60),
+        "search-user": env.int('SEARCH_CACHE_TTL', default=60),
+    },
+    # hit/miss counters, see `manage.py response_cache_stats`
+    "STATS": env.bool('RESPONSE_CACHE_STATS', default=True),
+}
+
+
+QUERY_INSTRUMENTATION = {
+    # X-DB-* response headers on every request; otherwise log a sample
+    "HEADERS": DEBUG,
+    "SAMPLE_RATE": env.float('QUERY_LOG_SAMPLE_RATE', default=0.01),
+}
+
+PROFILING = {
+    "ENABLED": env.bool('PROFILING_ENABLED', default=True),
+    # fraction of api requests profiled; staff can profile any request by sending HEADER
+    "SAMPLE_RATE": env.float('PROFILING_SAMPLE_RATE', default=0.0),
+    "HEADER": 'X-Profile',
+    # seconds between stack samples of a profiled request
+    "INTERVAL": 0.005,
+    "MAX_DEPTH": 128,
+    "MAX_CONCURRENT": 4,
+    # distinct stacks kept per url name; further ones are counted as "[other]"
+    "MAX_STACKS": 2000,
+    # each worker writes its stacks to this cache every FLUSH_INTERVAL seconds
+    # for `manage.py profile_report`; they expire TTL seconds after the last write
+    "CACHE": 'default',
+    "FLUSH_INTERVAL": 10,
+    "TTL": 24 * 3600,
+}
+
+METRICS = {
+    # directory for the per-process files of multi-worker servers (gunicorn,
+    # uvicorn --workers), merged when /metrics is scraped; empty keeps the metrics
+    # in process memory. Clear it before the workers start: `manage.py metrics_report --clear`
+    "DIR": env('METRICS_DIR', default=''),
+    # bearer token Prometheus sends to scrape /metrics (authorization.credentials)
+    "TOKEN": env('METRICS_TOKEN', default=''),
+    # optionally also restrict scrapers to these networks. Behind nginx or any
+    # other local proxy every request comes from 127.0.0.1, so list a loopback
+    # network only when the app is not proxied; with neither set /metrics is closed
+    "ALLOWED_NETWORKS": env.list('METRICS_ALLOWED_NETWORKS', default=[]),
+    "LATENCY_BUCKETS": (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    "QUERY_BUCKETS": (0, 1, 2, 3, 5, 8, 13, 21, 34),
+}
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {"class": "logging.StreamHandler"},
+    },
+    "loggers": {
+        "api.queries": {"handlers": ["console"], "level": env('QUERY_LOG_LEVEL', default='INFO')},
+    },
+}
@@ -21,10 +21,12 @@ from rest_framework_simplejwt.views import (
     TokenRefreshView,
 )
 from api.serializers import CustomTokenObtainPairView
+from utils.metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include("api.urls")),
     path('api/login/', CustomTokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('metrics', metrics_view, name='metrics'),
 ]
@@ -0,0 +1,144 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt import authentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+
+
+TOKEN_CLAIMS = ('email', 'is_active', 'is_staff', 'ver')
+
+
+def token_state_cache_key(user_id):
+    return f'auth:token_state:v2:{user_id}'
+
+
+def get_token_state(user_id):
+
+    '''
+        (token_version, is_active, is_staff) for a user, cached so authenticating a request
+        costs at most one narrow query per TOKEN_STATE_CACHE_TTL. Returns None when
+        the user no longer exists.
+    '''
+
+    cache = caches[settings.TOKEN_STATE_CACHE]
+    state = cache.get(token_state_cache_key(user_id))
+    if state is None:
+        state = get_user_model().objects.filter(pk=user_id).values_list('token_version', 'is_active', 'is_staff').first()
+        if state is None:
+            return None
+        cache.set(token_state_cache_key(user_id), tuple(state), timeout=settings.TOKEN_STATE_CACHE_TTL)
+    return tuple(state)
+
+
+async def aget_token_state(user_id):
+    cache = caches[settings.TOKEN_STATE_CACHE]
+    state = await cache.aget(token_state_cache_key(user_id))
+    if state is None:
+        state = await get_user_model().objects.filter(pk=user_id).values_list('token_version', 'is_active', 'is_staff').afirst()
+        if state is None:
+            return None
+        await cache.aset(token_state_cache_key(user_id), tuple(state), timeout=settings.TOKEN_STATE_CACHE_TTL)
+    return tuple(state)
+
+
+def _user_id(validated_token):
+    try:
+        return validated_token[api_settings.USER_ID_CLAIM]
+    except KeyError:
+        raise InvalidToken(_("Token contained no recognizable user identification"))
+
+
+class JWTAuthentication(authentication.JWTAuthentication):
+
+    '''
+        simplejwt's JWTAuthentication with an aauthenticate() coroutine for
+        AsyncAPIView, loading the user through the async ORM.
+    '''
+
+    async def aauthenticate(self, request):
+        header = self.get_header(request)
+        if header is None:
+            return None
+
+        raw_token = self.get_raw_token(header)
+        if raw_token is None:
+            return None
+
+        validated_token = self.get_validated_token(raw_token)
+        return await self.aget_user(validated_token), validated_token
+
+    async def aget_user(self, validated_token):
+        user_id = _user_id(validated_token)
+        try:
+            user = await self.user_model.objects.aget(**{api_settings.USER_ID_FIELD: user_id})
+        except self.user_model.DoesNotExist:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+        if not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+
+        return user
+
+
+class StatelessJWTAuthentication(JWTAuthentication):
+
+    '''
+        Opt-in alternative to JWTAuthentication that builds request.user from the
+        signed token claims instead of loading the User row.
+
+        The result is a User instance carrying only id, email and the cached
+        is_active, is_staff and token_version, so it still works as a value in ORM
+        filters; other fields are deferred and load on access, and save() refuses
+        to write it. Revocation is a comparison of the token's "ver" claim with
+        the user's cached token_version, which is bumped on password change or
+        deactivation; staff status comes from the cached row, not the token, so
+        a demotion takes effect once the cache entry is dropped on save. Tokens
+        issued without these claims fall back to the regular database lookup.
+    '''
+
+    def get_user(self, validated_token):
+        if any(claim not in validated_token for claim in TOKEN_CLAIMS):
+            return super().get_user(validated_token)
+        user_id = _user_id(validated_token)
+        return self._user_from_claims(validated_token, user_id, get_token_state(user_id))
+
+    async def aget_user(self, validated_token):
+        if any(claim not in validated_token for claim in TOKEN_CLAIMS):
+            return await super().aget_user(validated_token)
+        user_id = _user_id(validated_token)
+        return self._user_from_claims(validated_token, user_id, await aget_token_state(user_id))
+
+    def _user_from_claims(self, validated_token, user_id, state):
+        if state is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+
+        version, is_active, is_staff = state
+        if not is_active or not validated_token['is_active']:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        if validated_token['ver'] != version:
+            raise AuthenticationFailed(_("Token has been revoked"), code="token_revoked")
+
+        user = self.user_model(
+            id=user_id,
+            email=validated_token['email'],
+            is_active=True,
+            is_staff=is_staff,
+            token_version=version,
+        )
+        user._state.adding = False
+        user._from_token_claims = True
+        # leave every other field deferred, like a queryset's only(): the
+        # denormalized counters, the name or the password load with a narrow
+        # query when a view needs them instead of reading model defaults
+        loaded = {'id', 'email', 'is_active', 'is_staff', 'token_version'}
+        for field in self.user_model._meta.concrete_fields:
+            if field.attname not in loaded:
+                del user.__dict__[field.attname]
+        return user
@@ -0,0 +1,100 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.functional import LazyObject
+
+
+_request_state = ContextVar('replica_request_state', default=None)
+
+
+def sticky_cache_key(user_id):
+    return f'db:sticky:{user_id}'
+
+
+def mark_sticky(user_id):
+    '''
+        Keep the user's reads on the primary for DATABASE_REPLICAS['STICKY_SECONDS'],
+        so they see their own writes despite replication lag.
+    '''
+    config = settings.DATABASE_REPLICAS
+    if config['STICKY_SECONDS'] > 0:
+        caches[config['CACHE']].set(sticky_cache_key(user_id), True, timeout=config['STICKY_SECONDS'])
+
+
+async def amark_sticky(user_id):
+    config = settings.DATABASE_REPLICAS
+    if config['STICKY_SECONDS'] > 0:
+        await caches[config['CACHE']].aset(sticky_cache_key(user_id), True, timeout=config['STICKY_SECONDS'])
+
+
+@contextmanager
+def routing_request(request, use_replica):
+    '''
+        Routing state for one request, visible to the router through a context
+        variable (and so in sync_to_async threads as well).
+    '''
+    state = {'request': request, 'use_replica': use_replica, 'sticky': None, 'wrote': False}
+    token = _request_state.set(state)
+    try:
+        yield state
+    finally:
+        _request_state.reset(token)
+
+
+def routing_state():
+    return _request_state.get()
+
+
+def request_user_id(request):
+    # DRF authenticates inside the view and then replaces request.user; until then
+    # it is Django's lazy session user, which is not evaluated here
+    user = request.__dict__.get('user')
+    if user is None or isinstance(user, LazyObject) or not user.is_authenticated:
+        return None
+    return user.pk
+
+
+class ReplicaRouter:
+
+    '''
+        Send reads of views flagged ``use_replica = True`` to a random alias from
+        DATABASE_REPLICAS['ALIASES']; everything else, and every write, goes to
+        "default".
+
+        A replica read is only used once the request's user is known (the
+        authentication lookup itself stays on the primary), the user has not
+        written within STICKY_SECONDS, and the request has not written anything
+        yet.
+    '''
+
+    def db_for_read(self, model, **hints):
+        state = _request_state.get()
+        aliases = settings.DATABASE_REPLICAS['ALIASES']
+        if state is None or not state['use_replica'] or state['wrote'] or not aliases:
+            return None
+
+        if state['sticky'] is None:
+            user_id = request_user_id(state['request'])
+            if user_id is None:
+                return None
+            cache = caches[settings.DATABASE_REPLICAS['CACHE']]
+            state['sticky'] = bool(cache.get(sticky_cache_key(user_id)))
+        if state['sticky']:
+            return None
+        return random.choice(aliases)
+
+    def db_for_write(self, model, **hints):
+        state = _request_state.get()
+        if state is not None:
+            state['wrote'] = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS['ALIASES']
@@ -0,0 +1,101 @@
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+
+from asgiref.sync import sync_to_async
+from django.db import connections
+
+
+_WHITESPACE_RE = re.compile(r'\s+')
+_VALUES_RE = re.compile(r'\((?:%s, )*%s\)(?:, \((?:%s, )*%s\))+')
+_IN_LIST_RE = re.compile(r'IN \((?:%s, )+%s\)')
+
+
+def fingerprint(sql):
+    '''
+        Statement shape with parameters left as placeholders and variable-length
+        VALUES / IN lists collapsed, used to spot repeated (N+1 / duplicate) queries.
+    '''
+    sql = _WHITESPACE_RE.sub(' ', sql).strip()
+    sql = _VALUES_RE.sub('(...), ...', sql)
+    return _IN_LIST_RE.sub('IN (...)', sql)
+
+
+class QueryRecorder:
+
+    '''
+        connection.execute_wrapper() callback recording the count, duration and
+        shape of every statement run while it is installed.
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.slowest_sql = None
+        self.slowest_time = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.count += 1
+            self.total_time += duration
+            self.fingerprints[fingerprint(sql)] += 1
+            if duration >= self.slowest_time:
+                self.slowest_time = duration
+                self.slowest_sql = sql
+
+    @property
+    def duplicates(self):
+        return {sql: count for sql, count in self.fingerprints.items() if count > 1}
+
+    def summary(self):
+        return {
+            'queries': self.count,
+            'db_time_ms': round(self.total_time * 1000, 3),
+            'duplicates': self.duplicates,
+            'slowest_ms': round(self.slowest_time * 1000, 3),
+            'slowest_sql': self.slowest_sql,
+        }
+
+
+@contextmanager
+def record_queries():
+    '''
+        Record every query run on any configured database inside the block.
+    '''
+    recorder = QueryRecorder()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(recorder))
+        yield recorder
+
+
+def _install(recorder):
+    for connection in connections.all():
+        connection.execute_wrappers.append(recorder)
+
+
+def _uninstall(recorder):
+    for connection in connections.all():
+        if recorder in connection.execute_wrappers:
+            connection.execute_wrappers.remove(recorder)
+
+
+@asynccontextmanager
+async def arecord_queries():
+    '''
+        record_queries() for async code. Async ORM calls run their queries on the
+        sync_to_async thread, whose connections are not the event loop's, so the
+        recorder is installed there.
+    '''
+    recorder = QueryRecorder()
+    await sync_to_async(_install)(recorder)
+    try:
+        yield recorder
+    finally:
+        await sync_to_async(_uninstall)(recorder)
@@ -0,0 +1,372 @@
+import glob
+import hmac
+import ipaddress
+import json
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.http import Http404, HttpResponse
+from rest_framework.exceptions import AuthenticationFailed, NotAuthenticated, Throttled
+from rest_framework.views import exception_handler as drf_exception_handler
+
+
+_USED = struct.Struct('<Q')
+_KEY_LENGTH = struct.Struct('<I')
+_VALUE = struct.Struct('<d')
+
+
+def _encode_key(key):
+    name, labels = key
+    return json.dumps([name, labels]).encode()
+
+
+def _decode_key(data):
+    name, labels = json.loads(data)
+    return name, tuple(tuple(pair) for pair in labels)
+
+
+class MemoryStore:
+
+    '''
+        Metric values of a single process, for runs without METRICS['DIR'].
+    '''
+
+    def __init__(self):
+        self._values = {}
+
+    def inc(self, key, amount):
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def items(self):
+        return list(self._values.items())
+
+
+class MmapStore:
+
+    '''
+        Metric values of one process in a memory-mapped file, so a scrape served
+        by any worker can add up every worker's values.
+
+        The file holds the number of bytes used, then one entry per series: the
+        key's JSON length and bytes, padded to 8 bytes, and a float64 value. An
+        increment is an in-place write of the value; a new series is written
+        before the used count that makes it visible to readers. Only the owning
+        process writes the file, callers serialize its threads.
+    '''
+
+    INITIAL_SIZE = 1 << 16
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._size = os.fstat(self._fd).st_size
+        if self._size < self.INITIAL_SIZE:
+            os.ftruncate(self._fd, self.INITIAL_SIZE)
+            self._size = self.INITIAL_SIZE
+        self._mmap = mmap.mmap(self._fd, self._size)
+        self._used = _USED.unpack_from(self._mmap, 0)[0] or _USED.size
+        # a worker reusing a dead worker's pid continues its series
+        self._offsets = {key: offset for key, _, offset in _entries(self._mmap, self._used)}
+
+    def inc(self, key, amount):
+        offset = self._offsets.get(key)
+        if offset is None:
+            offset = self._append(key)
+        _VALUE.pack_into(self._mmap, offset, _VALUE.unpack_from(self._mmap, offset)[0] + amount)
+
+    def _append(self, key):
+        encoded = _encode_key(key)
+        padded = _KEY_LENGTH.size + len(encoded)
+        padded += -padded % 8
+        end = self._used + padded + _VALUE.size
+        if end > self._size:
+            self._grow(end)
+        _KEY_LENGTH.pack_into(self._mmap, self._used, len(encoded))
+        self._mmap[self._used + _KEY_LENGTH.size:self._used + _KEY_LENGTH.size + len(encoded)] = encoded
+        offset = self._used + padded
+        _VALUE.pack_into(self._mmap, offset, 0.0)
+        self._used = end
+        _USED.pack_into(self._mmap, 0, end)
+        self._offsets[key] = offset
+        return offset
+
+    def _grow(self, needed):
+        size = self._size
+        while size < needed:
+            size *= 2
+        self._mmap.close()
+        os.ftruncate(self._fd, size)
+        self._mmap = mmap.mmap(self._fd, size)
+        self._size = size
+
+    def items(self):
+        return [(key, value) for key, value, _ in _entries(self._mmap, self._used)]
+
+
+def _entries(buffer, used):
+    position = _USED.size
+    while position < used:
+        length = _KEY_LENGTH.unpack_from(buffer, position)[0]
+        key = _decode_key(bytes(buffer[position + _KEY_LENGTH.size:position + _KEY_LENGTH.size + length]))
+        padded = _KEY_LENGTH.size + length
+        padded += -padded % 8
+        offset = position + padded
+        yield key, _VALUE.unpack_from(buffer, offset)[0], offset
+        position = offset + _VALUE.size
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < _USED.size:
+        return []
+    return [(key, value) for key, value, _ in _entries(data, _USED.unpack_from(data, 0)[0])]
+
+
+_lock = threading.Lock()
+_store = None
+_store_pid = None
+
+
+def _get_store():
+    # per process: a worker forked after the parent recorded gets its own file
+    global _store, _store_pid
+    if _store_pid != os.getpid():
+        directory = settings.METRICS['DIR']
+        _store = MmapStore(os.path.join(directory, f'metrics-{os.getpid()}.db')) if directory else MemoryStore()
+        _store_pid = os.getpid()
+    return _store
+
+
+def collect():
+    '''
+        {(name, labels): value} summed over every process writing to
+        METRICS['DIR'], including ones that have exited since, or of this process
+        only without one.
+    '''
+    directory = settings.METRICS['DIR']
+    if not directory:
+        with _lock:
+            return dict(_get_store().items())
+    values = {}
+    for path in glob.glob(os.path.join(directory, 'metrics-*.db')):
+        for key, value in read_file(path):
+            values[key] = values.get(key, 0.0) + value
+    return values
+
+
+def clear():
+    '''
+        Remove every process file from METRICS['DIR']; run it before workers
+        start (e.g. from gunicorn's on_starting hook), not while they write.
+    '''
+    global _store_pid
+    directory = settings.METRICS['DIR']
+    with _lock:
+        _store_pid = None
+        if directory:
+            for path in glob.glob(os.path.join(directory, 'metrics-*.db')):
+                os.remove(path)
+
+
+_families = []
+
+
+class Counter:
+
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        _families.append(self)
+
+    def inc(self, *labelvalues, amount=1):
+        key = (self.name, tuple(zip(self.labelnames, labelvalues)))
+        with _lock:
+            _get_store().inc(key, amount)
+
+    def render(self, values):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for (name, labels), value in sorted(values.items()):
+            if name == self.name:
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, documentation, labelnames, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(float(bucket) for bucket in buckets)
+        self._bounds = tuple(_format_value(bucket) for bucket in self.buckets) + ('+Inf',)
+        _families.append(self)
+
+    def _keys(self, value, labelvalues):
+        labels = tuple(zip(self.labelnames, labelvalues))
+        # buckets are stored non-cumulative, one increment per observation
+        bound = self._bounds[bisect_left(self.buckets, value)]
+        return (
+            (f'{self.name}_bucket', labels + (('le', bound),)),
+            (f'{self.name}_sum', labels),
+            (f'{self.name}_count', labels),
+        )
+
+    def observe(self, value, *labelvalues):
+        bucket, total, count = self._keys(value, labelvalues)
+        with _lock:
+            store = _get_store()
+            store.inc(bucket, 1)
+            store.inc(total, value)
+            store.inc(count, 1)
+
+    def render(self, values):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        series = {}
+        for (name, labels), value in values.items():
+            if name == f'{self.name}_bucket':
+                series.setdefault(labels[:-1], {})[labels[-1][1]] = value
+        for labels, buckets in sorted(series.items()):
+            cumulative = 0.0
+            for bound in self._bounds:
+                cumulative += buckets.get(bound, 0.0)
+                lines.append(f'{self.name}_bucket{_format_labels(labels + (("le", bound),))} {_format_value(cumulative)}')
+            lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(values.get((f"{self.name}_sum", labels), 0.0))}')
+            lines.append(f'{self.name}_count{_format_labels(labels)} {_format_value(cumulative)}')
+        return lines
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def render():
+    '''
+        Every metric in the Prometheus text exposition format.
+    '''
+    values = collect()
+    lines = []
+    for family in _families:
+        lines.extend(family.render(values))
+    return '\n'.join(lines) + '\n'
+
+
+_config = settings.METRICS
+
+REQUEST_LATENCY = Histogram(
+    'api_request_duration_seconds', 'Time spent handling api requests.',
+    ('url_name', 'method', 'status'), _config['LATENCY_BUCKETS'],
+)
+REQUEST_QUERIES = Histogram(
+    'api_request_db_queries', 'Database queries run by api requests.',
+    ('url_name',), _config['QUERY_BUCKETS'],
+)
+RESPONSE_CACHE = Counter(
+    'api_response_cache_requests_total', 'Response cache lookups by scope and outcome (hit or miss).',
+    ('scope', 'outcome'),
+)
+RATE_LIMITED = Counter(
+    'api_rate_limit_rejections_total', 'Requests rejected by a rate limit, by rate_limit_scope.',
+    ('scope',),
+)
+AUTH_FAILURES = Counter(
+    'api_auth_failures_total', 'Requests rejected for missing or invalid credentials, by reason.',
+    ('reason',),
+)
+
+
+# queries of the current request: a one-item list set by MetricsMiddleware and
+# copied into the sync_to_async threads running async views' ORM calls
+_request_queries = ContextVar('request_queries', default=None)
+
+
+def count_query(execute, sql, params, many, context):
+    queries = _request_queries.get()
+    if queries is not None:
+        queries[0] += 1
+    return execute(sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_query_counter(sender, connection, **kwargs):
+    # first, so connection.execute_wrapper() blocks entered before the
+    # connection opened still pop their own wrapper
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, count_query)
+
+
+def start_request():
+    return _request_queries.set([0])
+
+
+def finish_request(token, request, response, duration):
+    '''
+        Record a request's latency and query count under its url name. Only api
+        routes are recorded, which keeps the label values bounded.
+    '''
+    queries = _request_queries.get()
+    _request_queries.reset(token)
+    match = getattr(request, 'resolver_match', None)
+    if match is None or not match.route.startswith('api/'):
+        return
+    url_name = match.url_name or match.route
+    REQUEST_LATENCY.observe(duration, url_name, request.method, str(response.status_code))
+    REQUEST_QUERIES.observe(queries[0], url_name)
+
+
+def exception_handler(exc, context):
+    '''
+        DRF's exception handler, counting rate-limit and authentication rejections.
+    '''
+    if isinstance(exc, Throttled):
+        RATE_LIMITED.inc(getattr(context.get('view'), 'rate_limit_scope', None) or 'throttle')
+    elif isinstance(exc, (AuthenticationFailed, NotAuthenticated)):
+        detail = exc.detail.get('code', '') if isinstance(exc.detail, dict) else exc.detail
+        AUTH_FAILURES.inc(getattr(detail, 'code', None) or exc.default_code)
+    return drf_exception_handler(exc, context)
+
+
+def _allowed(request):
+    config = settings.METRICS
+    if not config['TOKEN'] and not config['ALLOWED_NETWORKS']:
+        return False
+    if config['TOKEN']:
+        # behind a reverse proxy every client shares the proxy's address, so the
+        # token is what identifies the scraper
+        expected = f'Bearer {config["TOKEN"]}'.encode()
+        if not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', '').encode(), expected):
+            return False
+    if config['ALLOWED_NETWORKS']:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR') or '0.0.0.0')
+        return any(address in ipaddress.ip_network(network) for network in config['ALLOWED_NETWORKS'])
+    return True
+
+
+def metrics_view(request):
+    '''
+        Prometheus scrape endpoint. Clients must send METRICS['TOKEN'] as a bearer
+        token and, when METRICS['ALLOWED_NETWORKS'] is set, connect from one of
+        those networks; without a token the networks alone decide, and with
+        neither configured the endpoint is closed. Everyone else gets a 404.
+    '''
+    if not _allowed(request):
+        raise Http404
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
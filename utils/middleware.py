@@ -0,0 +1,265 @@
+import json
+import logging
+import random
+import sys
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from rest_framework.exceptions import APIException
+from rest_framework.settings import api_settings
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+
+from utils.db_router import amark_sticky, mark_sticky, request_user_id, routing_request, routing_state
+from utils import metrics
+from utils.instrumentation import arecord_queries, record_queries
+from utils.profiling import sampler, stack_store
+
+
+logger = logging.getLogger('api.queries')
+
+
+def view_class(request):
+    match = getattr(request, 'resolver_match', None)
+    return getattr(getattr(match, 'func', None), 'view_class', None)
+
+
+class QueryInstrumentationMiddleware:
+
+    '''
+        Record query count, DB time, duplicate statements and the slowest statement
+        for requests to the api routes.
+
+        With QUERY_INSTRUMENTATION['HEADERS'] (on in DEBUG) every request is recorded
+        and the figures are returned as X-DB-* response headers; otherwise a
+        SAMPLE_RATE fraction of requests is logged as one JSON line on the
+        "api.queries" logger. A view's ``query_budget`` is reported alongside and
+        any request exceeding it is logged as a warning.
+
+        Sync and async capable, so it does not force async views under ASGI back
+        through a thread.
+    '''
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        config = settings.QUERY_INSTRUMENTATION
+        self.headers = config['HEADERS']
+        self.sample_rate = config['SAMPLE_RATE']
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self._sampled():
+            return self.get_response(request)
+
+        with record_queries() as recorder:
+            response = self.get_response(request)
+        return self._report(request, response, recorder)
+
+    async def __acall__(self, request):
+        if not self._sampled():
+            return await self.get_response(request)
+
+        async with arecord_queries() as recorder:
+            response = await self.get_response(request)
+        return self._report(request, response, recorder)
+
+    def _sampled(self):
+        return self.headers or random.random() < self.sample_rate
+
+    def _report(self, request, response, recorder):
+        match = getattr(request, 'resolver_match', None)
+        if match is None or not match.route.startswith('api/'):
+            return response
+
+        summary = recorder.summary()
+        budget = getattr(view_class(request), 'query_budget', None)
+        over_budget = budget is not None and summary['queries'] > budget
+
+        if self.headers:
+            response['X-DB-Query-Count'] = str(summary['queries'])
+            response['X-DB-Time-Ms'] = str(summary['db_time_ms'])
+            response['X-DB-Duplicate-Queries'] = str(sum(summary['duplicates'].values()))
+            response['X-DB-Slowest-Ms'] = str(summary['slowest_ms'])
+            if budget is not None:
+                response['X-DB-Query-Budget'] = str(budget)
+
+        record = {
+            'url_name': match.url_name,
+            'method': request.method,
+            'status': response.status_code,
+            'budget': budget,
+            **summary,
+        }
+        if over_budget:
+            logger.warning(json.dumps(record))
+        elif not self.headers:
+            logger.info(json.dumps(record))
+        return response
+
+
+class MetricsMiddleware:
+
+    '''
+        Record the latency and query count of every api request in
+        utils.metrics, labelled with its url name, method and status. Recording
+        is a few in-place increments of this worker's metrics file; queries are
+        counted by a wrapper installed on each connection when it opens.
+    '''
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = metrics.start_request()
+        started = time.perf_counter()
+        response = self.get_response(request)
+        metrics.finish_request(token, request, response, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        token = metrics.start_request()
+        started = time.perf_counter()
+        response = await self.get_response(request)
+        metrics.finish_request(token, request, response, time.perf_counter() - started)
+        return response
+
+
+class ReplicaRoutingMiddleware:
+
+    '''
+        Give utils.db_router.ReplicaRouter the state of the current request: whether
+        the resolved view is flagged ``use_replica`` and whether the request wrote.
+        A request that wrote pins its user to the primary for STICKY_SECONDS.
+    '''
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        with routing_request(request, use_replica=False) as state:
+            response = self.get_response(request)
+        if state['wrote'] and (user_id := request_user_id(request)) is not None:
+            mark_sticky(user_id)
+        return response
+
+    async def __acall__(self, request):
+        with routing_request(request, use_replica=False) as state:
+            response = await self.get_response(request)
+        if state['wrote'] and (user_id := request_user_id(request)) is not None:
+            await amark_sticky(user_id)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view = getattr(view_func, 'view_class', None)
+        routing_state()['use_replica'] = getattr(view, 'use_replica', False)
+
+
+def _stack_depth(frame):
+    depth = 0
+    while frame is not None:
+        depth += 1
+        frame = frame.f_back
+    return depth
+
+
+class ProfilingMiddleware:
+
+    '''
+        Sample the Python stack of a PROFILING['SAMPLE_RATE'] fraction of api
+        requests, and of any request sending the PROFILING['HEADER'] header with
+        a staff user's token, into utils.profiling.stack_store as collapsed
+        stacks per url name. The header is honoured when the token's signed
+        is_staff claim says so, which needs no query; the samples are kept only
+        if the user the view authenticated is staff as well. Read them with `manage.py profile_report` or the
+        admin-only profiles/ endpoint; profiled responses carry the number of
+        samples taken in X-Profile-Samples.
+
+        A request that is not profiled costs one random() call and a header
+        lookup; a profiled one costs a frame walk per sample every INTERVAL
+        seconds, for at most MAX_CONCURRENT requests at a time. Async requests
+        share the event loop's thread, so their stacks cannot be told apart and
+        they are passed through unprofiled.
+    '''
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        config = settings.PROFILING
+        if not config['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = config['SAMPLE_RATE']
+        self.header = 'HTTP_' + config['HEADER'].upper().replace('-', '_')
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.get_response(request)
+        sampled = bool(self.sample_rate) and random.random() < self.sample_rate
+        if not sampled and not self._staff_claim(request):
+            return self.get_response(request)
+
+        # leave out the server's frames and this one
+        samples = sampler.start(skip=_stack_depth(sys._getframe()))
+        if samples is None:
+            return self.get_response(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            sampler.stop()
+
+        if not sampled:
+            # DRF sets the authenticated user on the request; a stale claim is not enough
+            user = getattr(request, 'user', None)
+            if user is None or not user.is_staff:
+                return response
+
+        match = getattr(request, 'resolver_match', None)
+        if match is not None and match.route.startswith('api/'):
+            if samples:
+                stack_store.add(match.url_name or match.route, samples)
+            response['X-Profile-Samples'] = str(sum(samples.values()))
+        return response
+
+    def _staff_claim(self, request):
+        if self.header not in request.META:
+            return False
+        # JWT clients are only authenticated inside the view; the claim is
+        # checked here from the signed token alone
+        authentication = api_settings.DEFAULT_AUTHENTICATION_CLASSES[0]()
+        header = authentication.get_header(request)
+        try:
+            raw_token = None if header is None else authentication.get_raw_token(header)
+            if raw_token is None:
+                return False
+            token = authentication.get_validated_token(raw_token)
+        except (APIException, InvalidToken, TokenError):
+            return False
+        return token.get('is_staff') is True
@@ -1,34 +1,65 @@
+from asgiref.sync import sync_to_async
 from rest_framework import permissions
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import Throttled
+from django.core.cache import caches
+from django.conf import settings
 from api.models import UserActivityConstraints
-from django.utils import timezone
+from utils.ratelimit import get_rate_limiter
 
 
+_NO_OVERRIDE = -1
+
+
+def override_cache_key(user_id):
+    return f'ratelimit:override:{user_id}'
+
+
+def request_limit_override(user_id):
+
+    '''
+        Per-user request_limit from UserActivityConstraints, cached so the hot path
+        makes no database query. The cache entry is dropped whenever the row changes.
+    '''
+
+    cache = caches[settings.RATE_LIMIT_CACHE]
+    limit = cache.get(override_cache_key(user_id))
+    if limit is None:
+        limit = UserActivityConstraints.objects.filter(user_id=user_id).values_list('request_limit', flat=True).first()
+        limit = _NO_OVERRIDE if limit is None else limit
+        cache.set(override_cache_key(user_id), limit, timeout=None)
+    return None if limit == _NO_OVERRIDE else limit
+
 
 class HasRequestLimit(permissions.BasePermission):
 
     '''
-        check user not exceded friends request limit
+        check user not exceded the rate limit configured in RATE_LIMITS for the view's
+        rate_limit_scope, or the user's request_limit in scopes with USER_OVERRIDE;
+        raises Throttled (429 with Retry-After) when exceeded.
+        A request costs the view's rate_limit_cost, or get_rate_limit_cost(request)
+        when the view defines it
     '''
 
+    message = 'Friend Request Limit exceded'
+
     def has_permission(self, request, view):
 
-        constraints = UserActivityConstraints.objects.filter(user=request.user)
-        if constraints.exists():
-            constraints = constraints.first()
-            updated_at = constraints.updated_at
-            current_time = timezone.now()
-
-            # Calculate the time difference in minutes
-            time_diff_seconds = (current_time - updated_at).total_seconds()
-            time_diff_minutes = time_diff_seconds / 60
-
-            limit = constraints.request_limit
-            if time_diff_minutes <=1:
-                if limit > 0:
-                    return True
-                else:
-                    raise PermissionDenied("Friend Request Limit exceded")
-            constraints.request_limit = 3
-            constraints.save()
+        scope = getattr(view, 'rate_limit_scope', None)
+        if scope is None:
+            return True
+
+        limiter = get_rate_limiter(scope)
+        override = settings.RATE_LIMITS[scope].get('USER_OVERRIDE', False)
+        allowed, wait = limiter.consume(
+            f'{scope}:{request.user.pk}',
+            limit=request_limit_override(request.user.pk) if override else None,
+            cost=view.get_rate_limit_cost(request) if hasattr(view, 'get_rate_limit_cost')
+            else getattr(view, 'rate_limit_cost', 1),
+        )
+        if not allowed:
+            raise Throttled(wait=wait, detail=self.message)
         return True
+
+    async def ahas_permission(self, request, view):
+        # the limiter's cache lock and the override lookup run in the sync thread
+        return await sync_to_async(self.has_permission)(request, view)
@@ -0,0 +1,219 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+
+def frame_label(code):
+    '''
+        "qualified.name (path:first line)" for a code object, with the path
+        relative to the sys.path entry it was imported from.
+    '''
+    path = code.co_filename
+    for root in _path_roots():
+        if path.startswith(root):
+            path = path[len(root):]
+            break
+    name = getattr(code, 'co_qualname', code.co_name)
+    # ";" separates frames and the last space the count in collapsed stacks
+    return f'{name} ({path}:{code.co_firstlineno})'.replace(';', ':')
+
+
+_roots = None
+
+
+def _path_roots():
+    global _roots
+    if _roots is None:
+        # longest first, so a virtualenv's site-packages wins over its prefix
+        _roots = sorted({os.path.join(os.path.abspath(p), '') for p in sys.path if p}, key=len, reverse=True)
+    return _roots
+
+
+def collapse(frame, skip, max_depth):
+    '''
+        The stack under frame as one collapsed line, root first, leaving out the
+        ``skip`` outermost frames (the server and the profiling middleware itself).
+    '''
+    codes = []
+    while frame is not None:
+        codes.append(frame.f_code)
+        frame = frame.f_back
+    codes = codes[len(codes) - skip - 1::-1] if skip < len(codes) else []
+    # cut the leaf end of deep stacks, so every stack keeps its root
+    return ';'.join(frame_label(code) for code in codes[:max_depth])
+
+
+class StackSampler:
+
+    '''
+        Statistical profiler for request threads: a single daemon thread reads
+        sys._current_frames() every ``interval`` seconds and counts the collapsed
+        stack of each registered thread.
+
+        The thread is started by the first profiled request and sleeps on a
+        condition while nothing is registered, so a process that never profiles
+        never runs it. At most ``max_concurrent`` threads are sampled at a time.
+    '''
+
+    def __init__(self, interval, max_depth, max_concurrent):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.max_concurrent = max_concurrent
+        self._condition = threading.Condition()
+        self._targets = {}
+        self._thread = None
+
+    def start(self, skip):
+        '''
+            Begin sampling the calling thread; returns its sample Counter, or None
+            when max_concurrent threads are already being sampled.
+        '''
+        thread_id = threading.get_ident()
+        with self._condition:
+            if thread_id in self._targets or len(self._targets) >= self.max_concurrent:
+                return None
+            samples = Counter()
+            self._targets[thread_id] = (skip, samples)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+            return samples
+
+    def stop(self):
+        with self._condition:
+            self._targets.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._targets:
+                    self._condition.wait()
+                targets = dict(self._targets)
+            frames = sys._current_frames()
+            for thread_id, (skip, samples) in targets.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    samples[collapse(frame, skip, self.max_depth)] += 1
+            del frames
+            time.sleep(self.interval)
+
+
+class StackStore:
+
+    '''
+        Collapsed stack counts per url name for this process, at most
+        ``max_stacks`` distinct stacks each; samples of further stacks are
+        counted under a single "[other]" stack.
+
+        Every FLUSH_INTERVAL seconds the counts are written to the PROFILING
+        cache under a slot of their own, so `collect()` can merge the stacks of
+        every worker sharing that cache. Slots of stopped workers expire after
+        TTL seconds.
+    '''
+
+    OTHER = '[other]'
+
+    def __init__(self, config):
+        self.max_stacks = config['MAX_STACKS']
+        self.cache_alias = config['CACHE']
+        self.flush_interval = config['FLUSH_INTERVAL']
+        self.ttl = config['TTL']
+        self._lock = threading.Lock()
+        self._stacks = {}
+        self._slot = None
+        self._flushed_at = 0.0
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @property
+    def shared(self):
+        '''
+            Whether the PROFILING cache is shared between processes. A
+            process-local (locmem) one only ever holds this process's stacks.
+        '''
+        return not isinstance(self.cache, (LocMemCache, DummyCache))
+
+    def add(self, url_name, samples):
+        with self._lock:
+            stacks = self._stacks.setdefault(url_name, Counter())
+            for stack, count in samples.items():
+                if stack in stacks or len(stacks) < self.max_stacks:
+                    stacks[stack] += count
+                else:
+                    stacks[self.OTHER] += count
+        if time.monotonic() - self._flushed_at > self.flush_interval:
+            self.flush()
+
+    def snapshot(self):
+        with self._lock:
+            return {url_name: dict(stacks) for url_name, stacks in self._stacks.items()}
+
+    def flush(self):
+        self._flushed_at = time.monotonic()
+        if self._slot is None:
+            self.cache.add('profiling:slots', 0, timeout=None)
+            try:
+                self._slot = self.cache.incr('profiling:slots')
+            except ValueError:
+                # evicted between add() and incr()
+                self.cache.add('profiling:slots', 0, timeout=None)
+                self._slot = self.cache.incr('profiling:slots')
+        self.cache.set(f'profiling:stacks:{self._slot}', self.snapshot(), timeout=self.ttl)
+
+    def collect(self):
+        '''
+            {url_name: {stack: samples}} merged over every worker's last flush,
+            this process included.
+        '''
+        with self._lock:
+            sampled = bool(self._stacks)
+        # a process without samples (e.g. profile_report) takes no slot of its own
+        if sampled:
+            self.flush()
+        slots = self.cache.get('profiling:slots') or 0
+        merged = {}
+        found = self.cache.get_many([f'profiling:stacks:{slot}' for slot in range(1, slots + 1)])
+        for snapshot in found.values():
+            for url_name, stacks in snapshot.items():
+                merged.setdefault(url_name, Counter()).update(stacks)
+        return merged
+
+    def reset(self):
+        '''
+            Drop the stacks of this process and every flushed slot. Workers that
+            have not flushed since keep their in-memory counts until they do.
+        '''
+        with self._lock:
+            self._stacks = {}
+        slots = self.cache.get('profiling:slots') or 0
+        self.cache.delete_many([f'profiling:stacks:{slot}' for slot in range(1, slots + 1)])
+
+
+def format_collapsed(stacks, url_name=None):
+    '''
+        Lines of "frame;frame;... samples", the input of flamegraph.pl,
+        speedscope and inferno. Without url_name every endpoint is included with
+        its url name as the root frame.
+    '''
+    lines = []
+    for name, counts in sorted(stacks.items()):
+        if url_name is not None and name != url_name:
+            continue
+        for stack, count in sorted(counts.items()):
+            lines.append(f'{stack} {count}' if url_name is not None else f'{name};{stack} {count}')
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+_config = settings.PROFILING
+sampler = StackSampler(_config['INTERVAL'], _config['MAX_DEPTH'], _config['MAX_CONCURRENT'])
+stack_store = StackStore(_config)
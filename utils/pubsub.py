@@ -0,0 +1,253 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import NamedTuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+class Event(NamedTuple):
+    id: int
+    type: str
+    data: dict
+
+
+# returned by since() when events after the client's id are no longer available
+# (evicted, or from before a restart); the client should refetch its state
+RESET = 'reset'
+
+
+def _initial_id():
+    # ids of a new channel start at the current time in microseconds, so they keep
+    # increasing across restarts and cache evictions
+    return time.time_ns() // 1000
+
+
+class Hub:
+
+    '''
+        Base class for pub/sub hubs: numbered events per channel, a short history
+        for resuming from a last-seen id, and waiting for new events.
+
+        Subclasses implement ``_append`` and ``since``. Waiters in this process are
+        woken by ``publish`` directly; hubs shared between processes also re-check
+        every POLL_INTERVAL seconds to see events published elsewhere.
+    '''
+
+    poll_interval = None
+
+    def __init__(self, config):
+        self.history = config['HISTORY']
+        self._waiters_lock = threading.Lock()
+        self._waiters = {}
+
+    def _append(self, channel, event_type, data):
+        raise NotImplementedError
+
+    def since(self, channel, last_id):
+        '''
+            Events of channel after last_id, oldest first; a single RESET event
+            carrying the current id when some of them are no longer available.
+        '''
+        raise NotImplementedError
+
+    def last_id(self, channel):
+        raise NotImplementedError
+
+    async def asince(self, channel, last_id):
+        return await sync_to_async(self.since)(channel, last_id)
+
+    async def alast_id(self, channel):
+        return await sync_to_async(self.last_id)(channel)
+
+    def publish(self, channel, event_type, data):
+        event = self._append(channel, event_type, data)
+        with self._waiters_lock:
+            callbacks = list(self._waiters.get(channel, ()))
+        for callback in callbacks:
+            callback()
+        return event
+
+    def _watch(self, channel, callback):
+        with self._waiters_lock:
+            self._waiters.setdefault(channel, set()).add(callback)
+
+    def _unwatch(self, channel, callback):
+        with self._waiters_lock:
+            callbacks = self._waiters.get(channel)
+            if callbacks is not None:
+                callbacks.discard(callback)
+                if not callbacks:
+                    del self._waiters[channel]
+
+    def wait(self, channel, last_id, timeout):
+        '''
+            since(), blocking up to timeout seconds until there is something to
+            return. Holds a thread for the duration (long-poll under WSGI).
+        '''
+        deadline = time.monotonic() + timeout
+        woken = threading.Event()
+        self._watch(channel, woken.set)
+        try:
+            while True:
+                events = self.since(channel, last_id)
+                remaining = deadline - time.monotonic()
+                if events or remaining <= 0:
+                    return events
+                woken.wait(min(remaining, self.poll_interval or remaining))
+                woken.clear()
+        finally:
+            self._unwatch(channel, woken.set)
+
+    async def await_since(self, channel, last_id, timeout):
+        '''
+            Coroutine version of wait(); an idle waiter is one pending future.
+        '''
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        woken = asyncio.Event()
+
+        def wake():
+            loop.call_soon_threadsafe(woken.set)
+
+        self._watch(channel, wake)
+        try:
+            while True:
+                events = await self.asince(channel, last_id)
+                remaining = deadline - loop.time()
+                if events or remaining <= 0:
+                    return events
+                try:
+                    await asyncio.wait_for(woken.wait(), min(remaining, self.poll_interval or remaining))
+                except asyncio.TimeoutError:
+                    pass
+                woken.clear()
+        finally:
+            self._unwatch(channel, wake)
+
+
+class InProcessHub(Hub):
+
+    '''
+        Hub for a single process: a bounded deque of recent events per channel,
+        with at most CHANNELS channels kept (least recently published dropped
+        first; their clients get a RESET on resume).
+    '''
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.max_channels = config['CHANNELS']
+        self._lock = threading.Lock()
+        self._channels = OrderedDict()
+
+    def _channel(self, channel):
+        # (events, id of the last event)
+        state = self._channels.get(channel)
+        if state is None:
+            state = self._channels[channel] = [deque(maxlen=self.history), _initial_id()]
+            while len(self._channels) > self.max_channels:
+                self._channels.popitem(last=False)
+        return state
+
+    def _append(self, channel, event_type, data):
+        with self._lock:
+            state = self._channel(channel)
+            self._channels.move_to_end(channel)
+            state[1] += 1
+            event = Event(state[1], event_type, data)
+            state[0].append(event)
+            return event
+
+    def last_id(self, channel):
+        with self._lock:
+            return self._channel(channel)[1]
+
+    def since(self, channel, last_id):
+        with self._lock:
+            events, current = self._channel(channel)
+            if last_id >= current:
+                return [] if last_id == current else [Event(current, RESET, {})]
+            first = events[0].id if events else current + 1
+            if last_id < first - 1:
+                return [Event(current, RESET, {})]
+            return [event for event in events if event.id > last_id]
+
+    async def asince(self, channel, last_id):
+        return self.since(channel, last_id)
+
+    async def alast_id(self, channel):
+        return self.last_id(channel)
+
+
+class CacheHub(Hub):
+
+    '''
+        Hub shared between processes through a Django cache (EVENTS['CACHE'],
+        e.g. Redis or memcached): one key per event, numbered with cache.incr, and
+        a counter key per channel. Waiters poll the counter every POLL_INTERVAL
+        seconds, a single cache read, and are woken at once by publishes from
+        their own process.
+    '''
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.cache = caches[config['CACHE']]
+        self.ttl = config['EVENT_TTL']
+        self.poll_interval = config['POLL_INTERVAL']
+
+    def _counter_key(self, channel):
+        return f'events:{channel}:last'
+
+    def _event_key(self, channel, event_id):
+        return f'events:{channel}:{event_id}'
+
+    def _append(self, channel, event_type, data):
+        counter = self._counter_key(channel)
+        self.cache.add(counter, _initial_id(), timeout=None)
+        try:
+            event_id = self.cache.incr(counter)
+        except ValueError:
+            # evicted between add() and incr()
+            self.cache.add(counter, _initial_id(), timeout=None)
+            event_id = self.cache.incr(counter)
+        event = Event(event_id, event_type, data)
+        self.cache.set(self._event_key(channel, event_id), (event_type, data), timeout=self.ttl)
+        return event
+
+    def last_id(self, channel):
+        counter = self._counter_key(channel)
+        self.cache.add(counter, _initial_id(), timeout=None)
+        return self.cache.get(counter)
+
+    def since(self, channel, last_id):
+        current = self.cache.get(self._counter_key(channel))
+        if current is None or last_id > current:
+            return [Event(self.last_id(channel), RESET, {})]
+        if last_id == current:
+            return []
+        if current - last_id > self.history:
+            return [Event(current, RESET, {})]
+        keys = [self._event_key(channel, event_id) for event_id in range(last_id + 1, current + 1)]
+        found = self.cache.get_many(keys)
+        if len(found) < len(keys):
+            # expired, or an incr whose event is not written yet: only the former
+            # is a gap, but both resolve on the client's refetch
+            return [Event(current, RESET, {})]
+        return [Event(event_id, *found[key]) for event_id, key in zip(range(last_id + 1, current + 1), keys)]
+
+
+_hub = None
+
+
+def get_hub():
+    '''
+        The hub configured in EVENTS['BACKEND'], built once per process.
+    '''
+    global _hub
+    if _hub is None:
+        _hub = import_string(settings.EVENTS['BACKEND'])(settings.EVENTS)
+    return _hub
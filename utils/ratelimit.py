@@ -0,0 +1,139 @@
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+_PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    '''
+        Parse "<count>/<period>" where period is s, m, h or d (e.g. "3/m").
+    '''
+    count, period = rate.split('/')
+    return int(count), _PERIODS[period[0]]
+
+
+class RateLimitPolicy:
+
+    '''
+        Base class for cache-backed rate limit policies.
+
+        ``consume`` returns ``(allowed, retry_after_seconds)`` and never touches
+        the database. ``limit`` overrides the configured request count per period;
+        an override of 0 rejects every request.
+    '''
+
+    def __init__(self, cache, rate):
+        self.cache = cache
+        self.limit, self.period = parse_rate(rate)
+
+    def consume(self, key, limit=None, cost=1):
+        raise NotImplementedError
+
+
+class TokenBucket(RateLimitPolicy):
+
+    '''
+        Token bucket holding ``limit`` tokens and refilling ``limit`` per period,
+        stored as a single theoretical-arrival-time value (GCRA). The
+        read-modify-write runs under a cache.add() lock so concurrent requests
+        from one user cannot both spend the last token.
+    '''
+
+    lock_attempts = 50
+
+    @contextmanager
+    def _lock(self, key):
+        lock_key = f'{key}:lock'
+        acquired = False
+        for _ in range(self.lock_attempts):
+            if self.cache.add(lock_key, 1, timeout=1):
+                acquired = True
+                break
+            time.sleep(0.001)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.cache.delete(lock_key)
+
+    def consume(self, key, limit=None, cost=1):
+        if limit is None:
+            limit = self.limit
+        if limit <= 0:
+            return False, self.period
+        interval = self.period / limit
+        key = f'ratelimit:tb:{key}'
+
+        with self._lock(key) as acquired:
+            if not acquired:
+                return False, interval
+            now = time.time()
+            tat = max(self.cache.get(key, now), now)
+            new_tat = tat + interval * cost
+            allow_at = new_tat - self.period
+            if now < allow_at:
+                return False, allow_at - now
+            self.cache.set(key, new_tat, timeout=int(self.period) + 1)
+            return True, 0
+
+
+class SlidingWindow(RateLimitPolicy):
+
+    '''
+        Sliding window approximated from the current and previous fixed-window
+        counters. Counting uses cache.incr(), which is atomic on shared backends.
+    '''
+
+    def consume(self, key, limit=None, cost=1):
+        if limit is None:
+            limit = self.limit
+        now = time.time()
+        window, offset = divmod(now, self.period)
+        current_key = f'ratelimit:sw:{key}:{int(window)}'
+        previous = self.cache.get(f'ratelimit:sw:{key}:{int(window) - 1}', 0)
+
+        self.cache.add(current_key, 0, timeout=int(self.period * 2))
+        try:
+            current = self.cache.incr(current_key, cost)
+        except ValueError:
+            # expired between add() and incr()
+            self.cache.set(current_key, cost, timeout=int(self.period * 2))
+            current = cost
+
+        weight = 1 - offset / self.period
+        if previous * weight + current <= limit:
+            return True, 0
+
+        self.cache.decr(current_key, cost)
+        current -= cost
+        if current + cost > limit or not previous:
+            return False, self.period - offset
+        # wait until enough of the previous window has slid out
+        needed_weight = (limit - current - cost) / previous
+        return False, max((1 - needed_weight) * self.period - offset, 0)
+
+
+POLICIES = {
+    'token_bucket': TokenBucket,
+    'sliding_window': SlidingWindow,
+}
+
+_limiters = {}
+
+
+def get_rate_limiter(scope):
+    '''
+        Build (once per process) the policy configured in RATE_LIMITS[scope].
+    '''
+    if scope not in _limiters:
+        config = settings.RATE_LIMITS[scope]
+        policy = config.get('POLICY', 'token_bucket')
+        policy_class = POLICIES[policy] if policy in POLICIES else import_string(policy)
+        cache = caches[config.get('CACHE', settings.RATE_LIMIT_CACHE)]
+        _limiters[scope] = policy_class(cache, config['RATE'])
+    return _limiters[scope]
@@ -0,0 +1,194 @@
+import asyncio
+import hashlib
+import uuid
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.response import Response
+
+from utils import metrics
+
+
+USERS_VERSION = 'users'
+
+
+def version_cache_key(name):
+    return f'response_cache:version:{name}'
+
+
+def stats_cache_key(scope, outcome):
+    return f'response_cache:stats:{scope}:{outcome}'
+
+
+def _cache():
+    return caches[settings.RESPONSE_CACHE['CACHE']]
+
+
+def _bump(names):
+    _cache().set_many({version_cache_key(name): uuid.uuid4().hex for name in names}, timeout=None)
+
+
+def bump_versions(*names):
+
+    '''
+        Invalidate every cached response depending on the given versions (user ids
+        or USERS_VERSION) by giving them a new random value. O(1) per name: old
+        entries are never looked up again and simply expire.
+
+        Inside a transaction the bump is repeated on commit, so a response computed
+        from the pre-commit rows in the meantime is not served afterwards.
+    '''
+
+    names = set(names)
+    if not names:
+        return
+    _bump(names)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: _bump(names))
+
+
+def get_versions(names):
+    cache = _cache()
+    keys = {version_cache_key(name): name for name in names}
+    found = cache.get_many(keys)
+    for key in keys.keys() - found.keys():
+        # start unknown (or evicted) versions from a fresh value so entries cached
+        # under an earlier value of the same version can never be served
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        found[key] = cache.get(key)
+    return [found[key] for key in keys]
+
+
+async def aget_versions(names):
+    cache = _cache()
+    keys = {version_cache_key(name): name for name in names}
+    found = await cache.aget_many(keys)
+    for key in keys.keys() - found.keys():
+        await cache.aadd(key, uuid.uuid4().hex, timeout=None)
+        found[key] = await cache.aget(key)
+    return [found[key] for key in keys]
+
+
+def record(scope, outcome):
+    metrics.RESPONSE_CACHE.inc(scope, outcome)
+    if not settings.RESPONSE_CACHE['STATS']:
+        return
+    cache = _cache()
+    key = stats_cache_key(scope, outcome)
+    if not cache.add(key, 1, timeout=None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, timeout=None)
+
+
+async def arecord(scope, outcome):
+    metrics.RESPONSE_CACHE.inc(scope, outcome)
+    if not settings.RESPONSE_CACHE['STATS']:
+        return
+    cache = _cache()
+    key = stats_cache_key(scope, outcome)
+    if not await cache.aadd(key, 1, timeout=None):
+        try:
+            await cache.aincr(key)
+        except ValueError:
+            await cache.aset(key, 1, timeout=None)
+
+
+def stats(scopes=None):
+    '''
+        {scope: {'hit': n, 'miss': n}} for the configured scopes.
+    '''
+    scopes = scopes or settings.RESPONSE_CACHE['TTL'].keys()
+    keys = {stats_cache_key(scope, outcome): (scope, outcome) for scope in scopes for outcome in ('hit', 'miss')}
+    found = _cache().get_many(keys)
+    result = {scope: {'hit': 0, 'miss': 0} for scope in scopes}
+    for key, (scope, outcome) in keys.items():
+        result[scope][outcome] = found.get(key, 0)
+    return result
+
+
+def reset_stats(scopes=None):
+    scopes = scopes or settings.RESPONSE_CACHE['TTL'].keys()
+    _cache().delete_many([stats_cache_key(scope, outcome) for scope in scopes for outcome in ('hit', 'miss')])
+
+
+def _response_key(scope, request, versions):
+    return 'response_cache:{}:{}:{}:{}'.format(
+        scope, request.user.pk, ':'.join(versions),
+        hashlib.md5(request.build_absolute_uri().encode()).hexdigest(),
+    )
+
+
+def _bypass(scope, request):
+    config = settings.RESPONSE_CACHE
+    return not config['ENABLED'] or not config['TTL'].get(scope) or request.data
+
+
+def _cached_response(data):
+    response = Response(data=data, status=200)
+    response['X-Cache'] = 'HIT'
+    return response
+
+
+def cache_response(scope, versions):
+
+    '''
+        Cache successful responses of an APIView handler per user and full URL
+        (query string included); requests with a body bypass it. ``versions(request)``
+        names the versions the response depends on; bumping any of them misses every
+        entry cached under the old value. Entries live for RESPONSE_CACHE['TTL'][scope]
+        seconds, which also bounds staleness from changes no version tracks (e.g. a
+        friend's new email). Coroutine handlers get a wrapper using the async cache API.
+    '''
+
+    def decorator(handler):
+        if asyncio.iscoroutinefunction(handler):
+            @wraps(handler)
+            async def async_wrapper(view, request, *args, **kwargs):
+                if _bypass(scope, request):
+                    return await handler(view, request, *args, **kwargs)
+
+                key = _response_key(scope, request, await aget_versions(versions(request)))
+                cached = await _cache().aget(key)
+                if cached is not None:
+                    await arecord(scope, 'hit')
+                    return _cached_response(cached)
+
+                await arecord(scope, 'miss')
+                response = await handler(view, request, *args, **kwargs)
+                if response.status_code == 200:
+                    await _cache().aset(key, response.data, timeout=settings.RESPONSE_CACHE['TTL'][scope])
+                response['X-Cache'] = 'MISS'
+                return response
+            return async_wrapper
+
+        @wraps(handler)
+        def wrapper(view, request, *args, **kwargs):
+            if _bypass(scope, request):
+                return handler(view, request, *args, **kwargs)
+
+            key = _response_key(scope, request, get_versions(versions(request)))
+            cached = _cache().get(key)
+            if cached is not None:
+                record(scope, 'hit')
+                return _cached_response(cached)
+
+            record(scope, 'miss')
+            response = handler(view, request, *args, **kwargs)
+            if response.status_code == 200:
+                _cache().set(key, response.data, timeout=settings.RESPONSE_CACHE['TTL'][scope])
+            response['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+
+def user_graph_version(request):
+    return [request.user.pk]
+
+
+def users_version(request):
+    return [USERS_VERSION]
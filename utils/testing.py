@@ -0,0 +1,27 @@
+from urllib.parse import urlparse
+
+from django.urls import resolve
+
+from utils.instrumentation import record_queries
+
+
+class QueryBudgetMixin:
+
+    '''
+        TestCase mixin enforcing the ``query_budget`` a view declares.
+    '''
+
+    def assertWithinQueryBudget(self, method, path, data=None, **extra):
+        view = resolve(urlparse(path).path).func.view_class
+        budget = getattr(view, 'query_budget', None)
+        self.assertIsNotNone(budget, f'{view.__name__} declares no query_budget')
+
+        with record_queries() as recorder:
+            response = getattr(self.client, method)(path, data, format='json', **extra)
+
+        summary = recorder.summary()
+        self.assertLessEqual(
+            summary['queries'], budget,
+            f'{view.__name__} ran {summary["queries"]} queries (budget {budget}): {summary}'
+        )
+        return response